@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .model import HALTED
+from .model import Simulation
+from .program_format import load_program
+
+BATCH_LOGGER_NAME = "batch_model_logger"
+
+# simulations loaded by this worker process: (program path, simulation class) -> (program, simulation)
+worker_simulations = {}
+
+
+class BatchResult:
+    """
+    Result of one (program, input) run:\n
+    output -- output buffer joined to string\n
+    ticks -- ticks on the moment simulation stopped\n
+    halt_reason -- message of exception that stopped simulation\n
+    halted -- True if simulation was stopped by HLT, False if by error\n
+    wall_time -- seconds spent in run()
+    """
+
+    def __init__(self, program_path, input_path, output, ticks, halt_reason, halted, wall_time):
+        self.program_path = program_path
+        self.input_path = input_path
+        self.output = output
+        self.ticks = ticks
+        self.halt_reason = halt_reason
+        self.halted = halted
+        self.wall_time = wall_time
+
+    def as_dict(self):
+        return {
+            "program": self.program_path,
+            "input": self.input_path,
+            "output": self.output,
+            "ticks": self.ticks,
+            "halt_reason": self.halt_reason,
+            "halted": self.halted,
+            "wall_time": self.wall_time,
+        }
+
+    def __repr__(self):
+        return f'BatchResult({self.as_dict()})'
+
+
+def get_batch_logger():
+    # workers never print state and must not race for the same log folder, so nothing is written
+    logger = logging.getLogger(BATCH_LOGGER_NAME)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def get_worker_simulation(program_path, simulation_class):
+    """
+    :return: program and simulation with it, loaded and pre-decoded only on first call in this process
+    """
+    key = (program_path, simulation_class)
+    if key not in worker_simulations:
+        program = load_program(program_path)
+        simulation = simulation_class(get_batch_logger())
+        simulation.cu.need_print_state = False
+        simulation.reset(program)
+        worker_simulations[key] = (program, simulation)
+
+    return worker_simulations[key]
+
+
+def run_job(job):
+    """
+    Runs one (program path, input path, simulation class) job in worker process
+    """
+    program_path, input_path, simulation_class = job
+    program, simulation = get_worker_simulation(program_path, simulation_class)
+
+    with open(input_path, encoding="utf-8") as input_file:
+        # program is already loaded, so only stacks, RAM, registers and buffers are reset
+        simulation.reset(program, input_file.read())
+
+    start_time = time.perf_counter()
+    result = simulation.run()
+    wall_time = time.perf_counter() - start_time
+
+    return BatchResult(program_path, input_path, ''.join(simulation.cu.output_buffer), simulation.cu.ticks,
+                       str(result.error), result.status == HALTED, wall_time)
+
+
+def run_batch(jobs, max_workers=None, simulation_class=None, chunksize=None):
+    """
+    Runs every (program path, input path) pair of jobs across process pool.
+    Every worker loads each program once and reuses its simulation for all inputs of that program.
+    :return: list of BatchResult in order of jobs
+    """
+    if simulation_class is None:
+        simulation_class = Simulation
+
+    jobs = [(program_path, input_path, simulation_class) for program_path, input_path in jobs]
+    if not jobs:
+        return []
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if chunksize is None:
+        # few big chunks per worker: less pickling, more inputs per loaded program
+        chunksize = max(1, len(jobs) // (max_workers * 4))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_job, jobs, chunksize=chunksize))
+
+
+def run_program_batch(program_path, input_paths, max_workers=None, simulation_class=None, chunksize=None):
+    """
+    Runs one program with every input of input_paths, see run_batch
+    """
+    return run_batch([(program_path, input_path) for input_path in input_paths], max_workers, simulation_class,
+                     chunksize)
+
+
+if __name__ == '__main__':
+    # python -m src.batch <program_file> <input_file> [<input_file> ...]
+    # python -m src.batch --pairs <program_file> <input_file> [<program_file> <input_file> ...]
+    if sys.argv[1] == '--pairs':
+        assert len(sys.argv) % 2 == 0, 'BATCH: every program file must be followed by input file'
+        results = run_batch(zip(sys.argv[2::2], sys.argv[3::2]))
+    else:
+        results = run_program_batch(sys.argv[1], sys.argv[2:])
+
+    for result in results:
+        print(json.dumps(result.as_dict(), ensure_ascii=False))
@@ -0,0 +1,603 @@
+import hashlib
+import importlib.util
+import logging
+import os
+import sys
+
+from .model import OPCODE_BY_NAME
+from .model import OPCODES
+from .model import PROGRAM_START_ADDRESS
+from .model import UNKNOWN_OPCODE
+from .model import Simulation
+from .model import main as model_main
+from .model import opcode_and_offset_to_address
+
+# bump on every change of generated code, so old cached modules are not used
+COMPILER_VERSION = 4
+
+# executed by ControlUnit handlers (state is flushed before and reloaded after)
+FALLBACK_INSTRUCTIONS = ["MUL", "DIV", "MOD", "TMOD", "TDIV", "TSUM", "TGET", "TSET", "TEQ", "TDUP", "READ"]
+CONDITIONAL_JUMPS = {"JZ": "zf", "JL": "nf", "JO": "of"}
+BLOCK_TERMINATORS = ["JMPR", "JZ", "JL", "JO", "JMPA", "JFA", "JFR", "CALL", "RET", "HLT"]
+
+
+def get_program_hash(imem):
+    """
+    :return: sha256 of pre-decoded instructions memory and address tables values
+    """
+    program_hash = hashlib.sha256(f'lab compiler v{COMPILER_VERSION}'.encode())
+    program_hash.update(imem.opcodes.tobytes())
+    program_hash.update(imem.offsets.tobytes())
+    program_hash.update(imem.values.tobytes())
+    program_hash.update(repr(imem.extended_tables).encode())
+    return program_hash.hexdigest()
+
+
+def get_table_value(imem, opcode_name, offset):
+    """
+    :return: 16-bit value stored in address table (same cells, that LOAD/JMPA/CALL read in ControlUnit)
+    and address of its cell. Value is None if cells do not keep bytes (ControlUnit faults on them)
+    """
+    address = opcode_and_offset_to_address(OPCODE_BY_NAME[opcode_name], offset, imem.extended_tables)
+    if not imem.has_table_bytes(OPCODE_BY_NAME[opcode_name], offset):
+        return None, address
+    return (imem.values[address] << 8) + imem.values[address + 1], address
+
+
+class BasicBlock:
+    def __init__(self, start_address):
+        self.start_address = start_address
+        self.addresses = []
+        self.name = f'block_{start_address:04x}'
+
+
+class BlockEmitter:
+    """
+    Generates python source of one basic block.
+    Stack, return stack, flags and RAM address are kept in locals inside block and written back to ControlUnit
+    before block returns (or before ControlUnit handler is called).\n
+    Instructions, that fault in ControlUnit (stack underflow, bad address table cells), are executed by ControlUnit
+    handler in faulting case, so block raises same error with same state.
+    """
+
+    def __init__(self, imem, block):
+        self.imem = imem
+        self.block = block
+        self.body = []
+        self.pending_ticks = 0
+        self.uses_stack = False
+        self.uses_rstack = False
+        self.uses_flags = False
+        self.uses_ram = False
+        # value of instruction memory address after last emitted instruction, as interpreter leaves it
+        self.imem_address = None
+
+    def line(self, text, indent=1):
+        self.body.append('    ' * indent + text)
+
+    def push(self, expr, prefix=''):
+        self.line(f'{prefix}sp = ({prefix}sp + 1) & 0xFFFF')
+        self.line(f'{prefix}d[{prefix}sp] = {prefix}t')
+        self.line(f'{prefix}t = {expr}')
+
+    def pop(self, var, prefix=''):
+        self.line(f'{var} = {prefix}t')
+        self.line(f'{prefix}t = {prefix}d[{prefix}sp]')
+        self.line(f'{prefix}sp = ({prefix}sp - 1) & 0xFFFF')
+
+    def set_zf_nf(self):
+        self.line('zf = t == 0')
+        self.line('nf = t >= 0x80')
+
+    def prologue(self):
+        lines = []
+        if self.uses_stack:
+            lines += ['stack = cu.stack', 'd = stack.data', 'sp = stack.sp', 't = stack.tos']
+        if self.uses_rstack:
+            lines += ['rstack = cu.rstack', 'rd = rstack.data', 'rsp = rstack.sp', 'rt = rstack.tos']
+        if self.uses_flags:
+            lines += ['zf = cu.zf', 'nf = cu.nf', 'of = cu.of']
+        if self.uses_ram:
+            lines += ['ram = cu.ram', 'm = ram.data', 'ad = ram.ad']
+        return ['    ' + line for line in lines]
+
+    def epilogue(self, indent=1):
+        if self.uses_stack:
+            self.line('stack.sp = sp', indent)
+            self.line('stack.tos = t', indent)
+        if self.uses_rstack:
+            self.line('rstack.sp = rsp', indent)
+            self.line('rstack.tos = rt', indent)
+        if self.uses_flags:
+            self.line('cu.zf = zf', indent)
+            self.line('cu.nf = nf', indent)
+            self.line('cu.of = of', indent)
+        if self.uses_ram:
+            self.line('ram.ad = ad', indent)
+        if self.imem_address is not None:
+            self.line(f'cu.imem.address = 0x{self.imem_address:04x}', indent)
+        if self.pending_ticks:
+            self.line(f'cu.ticks += {self.pending_ticks}', indent)
+            self.pending_ticks = 0
+
+    def reload(self):
+        for line in self.prologue():
+            self.line(line.strip())
+
+    def emit(self, address):
+        instruction = OPCODES[self.imem.opcodes[address]] if self.imem.opcodes[address] != UNKNOWN_OPCODE else None
+        offset = self.imem.offsets[address]
+        self.imem_address = address
+
+        if instruction is None:
+            self.epilogue()
+            self.line(f'cu.pc = 0x{address:04x}')
+            self.line('cu.unknown_opcode()')
+        elif instruction in FALLBACK_INSTRUCTIONS:
+            self.epilogue()
+            self.line(f'cu.pc = 0x{address:04x}')
+            self.line(f'cu.{self.fallback_method_name(instruction)}()')
+            self.reload()
+        else:
+            getattr(self, 'emit_' + instruction.lower())(address, offset)
+
+    def fallback_method_name(self, instruction):
+        return {"DIV": "divide"}.get(instruction, instruction.lower())
+
+    def emit_handler_call(self, address, offset, indent=1):
+        """
+        Writes state back and executes instruction at address by ControlUnit handler
+        """
+        self.epilogue(indent)
+        self.line(f'cu.pc = 0x{address:04x}', indent)
+        self.line(f'cu.decoder.opcode = {self.imem.opcodes[address]}', indent)
+        self.line(f'cu.decoder.offset = {offset}', indent)
+        self.line(f'cu.dispatch_table[{self.imem.opcodes[address]}]()', indent)
+
+    def emit_underflow_check(self, address, offset):
+        """
+        Instructions, that read stack[sp] by Stack.get_next(), fault when stack has less than two values:
+        then handler is called to raise same error
+        """
+        pending_ticks = self.pending_ticks
+        self.line('if sp >= 0xFFFE:')
+        self.emit_handler_call(address, offset, 2)
+        self.pending_ticks = pending_ticks
+
+    # LOGICAL OPERATIONS
+    def emit_tor(self, address, offset):
+        self.pop('v')
+        self.push('v', 'r')
+        self.pending_ticks += 1
+
+    def emit_rfrom(self, address, offset):
+        self.pop('v', 'r')
+        self.push('v')
+        self.pending_ticks += 1
+
+    def emit_dup(self, address, offset):
+        self.line('sp = (sp + 1) & 0xFFFF')
+        self.line('d[sp] = t')
+        self.pending_ticks += 1
+
+    def emit_drop(self, address, offset):
+        self.line('t = d[sp]')
+        self.line('sp = (sp - 1) & 0xFFFF')
+        self.pending_ticks += 1
+
+    def emit_over(self, address, offset):
+        self.line('v = (sp + 1) & 0xFFFF')
+        self.line('d[v] = t')
+        self.line('t = d[sp]')
+        self.line('sp = v')
+        self.pending_ticks += 5
+
+    def emit_swap(self, address, offset):
+        self.line('t, d[sp] = d[sp], t')
+        self.pending_ticks += 1
+
+    def emit_rot(self, address, offset):
+        self.emit_tor(address, offset)
+        self.emit_swap(address, offset)
+        self.emit_rfrom(address, offset)
+        self.emit_swap(address, offset)
+
+    def emit_true(self, address, offset):
+        self.push('0xFF')
+        self.pending_ticks += 1
+
+    def emit_false(self, address, offset):
+        self.push('0')
+        self.pending_ticks += 1
+
+    def emit_cmp(self, address, offset):
+        self.line('v = d[sp]')
+        self.line('zf = v == t')
+        self.line('if v & 0x80 and not t & 0x80:')
+        self.line('nf = True', 2)
+        self.line('elif not v & 0x80 and t & 0x80:')
+        self.line('nf = False', 2)
+        self.line('else:')
+        self.line('nf = True if v < t else 0', 2)
+        self.pending_ticks += 1
+
+    def emit_compare(self, address, offset, result):
+        self.emit_cmp(address, offset)
+        self.line(f't = 0xFF if {result} else 0x00')
+        self.line('sp = (sp - 1) & 0xFFFF')
+        self.pending_ticks += 1
+
+    def emit_eq(self, address, offset):
+        self.emit_compare(address, offset, 'zf')
+
+    def emit_lt(self, address, offset):
+        self.emit_compare(address, offset, 'zf or nf')
+
+    def emit_gt(self, address, offset):
+        self.emit_compare(address, offset, 'not (zf or nf)')
+
+    # ARITHMETIC OPERATIONS
+    def emit_inc(self, address, offset):
+        self.line('t += 1')
+        self.line('of = t > 0xFF')
+        self.line('t &= 0xFF')
+        self.set_zf_nf()
+        self.pending_ticks += 1
+
+    def emit_dec(self, address, offset):
+        self.line('t = (t - 1) & 0xFF')
+        self.set_zf_nf()
+        self.pending_ticks += 1
+
+    def emit_sum(self, address, offset):
+        self.emit_underflow_check(address, offset)
+        self.line('t += d[sp]')
+        self.line('of = t > 0xFF')
+        self.line('t &= 0xFF')
+        self.set_zf_nf()
+        self.line('sp = (sp - 1) & 0xFFFF')
+        self.pending_ticks += 1
+
+    def emit_sub(self, address, offset):
+        self.emit_underflow_check(address, offset)
+        self.line('t = (d[sp] - t) & 0xFF')
+        self.set_zf_nf()
+        self.line('of = False')
+        self.line('sp = (sp - 1) & 0xFFFF')
+        self.pending_ticks += 1
+
+    # MEMORY ACCESS
+    def emit_set(self, address, offset):
+        self.pop('v')
+        self.pop('ad')
+        self.line('ad = (ad << 8) + v')
+        self.pop('v')
+        self.line('m[ad] = v')
+        self.pending_ticks += 3
+
+    def emit_get(self, address, offset):
+        self.pop('v')
+        self.pop('ad')
+        self.line('ad = (ad << 8) + v')
+        self.push('m[ad]')
+        self.pending_ticks += 3
+
+    def emit_load(self, address, offset):
+        ram_address, table_address = get_table_value(self.imem, "LOAD", offset)
+        if ram_address is None:
+            self.emit_handler_call(address, offset)
+            self.reload()
+            return
+        self.line(f'ad = 0x{ram_address:04x}')
+        self.push('m[ad]')
+        self.pending_ticks += 5
+        # LOAD leaves instruction memory address at second cell of LOAD table
+        self.imem_address = table_address + 1
+
+    def emit_print(self, address, offset):
+        self.pop('v')
+        self.line('cu.write_output(chr(v))')
+        self.pending_ticks += 1
+
+    # FLOW CONTROL (always last instruction of block)
+    def emit_jmpr(self, address, offset):
+        self.pending_ticks += 1
+        self.epilogue()
+        self.line(f'return 0x{address + offset + 1:04x}')
+
+    def emit_conditional_jump(self, address, offset, flag):
+        self.line(f'taken = {flag}')
+        if flag == 'of':
+            self.line('of = False')
+        self.epilogue()
+        self.line('if taken:')
+        self.line('cu.ticks += 1', 2)
+        self.line(f'return 0x{address + offset + 1:04x}', 2)
+        self.line(f'return 0x{address + 1:04x}')
+
+    def emit_jz(self, address, offset):
+        self.emit_conditional_jump(address, offset, 'zf')
+
+    def emit_jl(self, address, offset):
+        self.emit_conditional_jump(address, offset, 'nf')
+
+    def emit_jo(self, address, offset):
+        self.emit_conditional_jump(address, offset, 'of')
+
+    def emit_table_jump_by_handler(self, address, offset):
+        # address table cell is not valid, handler faults on it (or does not jump, as JFA with TRUE)
+        self.emit_handler_call(address, offset)
+        self.line('return cu.pc + 1')
+
+    def emit_jmpa(self, address, offset):
+        target, table_address = get_table_value(self.imem, "JMPA", offset)
+        if target is None:
+            self.emit_table_jump_by_handler(address, offset)
+            return
+        self.pending_ticks += 4
+        self.imem_address = table_address + 1
+        self.epilogue()
+        self.line(f'return 0x{target + 1:04x}')
+
+    def emit_jump_if_false(self):
+        # flags as after FALSE CMP
+        self.pop('v')
+        self.line('zf = v == 0')
+        self.line('nf = v >= 0x80')
+        self.pending_ticks += 1
+        self.epilogue()
+
+    def emit_jfr(self, address, offset):
+        self.emit_jump_if_false()
+        self.line('if zf:')
+        self.line('cu.ticks += 1', 2)
+        self.line(f'return 0x{address + offset + 1:04x}', 2)
+        self.line(f'return 0x{address + 1:04x}')
+
+    def emit_jfa(self, address, offset):
+        target, table_address = get_table_value(self.imem, "JMPA", offset)
+        if target is None:
+            self.emit_table_jump_by_handler(address, offset)
+            return
+        self.emit_jump_if_false()
+        self.line('if zf:')
+        self.line('cu.ticks += 4', 2)
+        self.line(f'cu.imem.address = 0x{table_address + 1:04x}', 2)
+        self.line(f'return 0x{target + 1:04x}', 2)
+        self.line(f'return 0x{address + 1:04x}')
+
+    def emit_call(self, address, offset):
+        target, table_address = get_table_value(self.imem, "CALL", offset)
+        if target is None:
+            self.emit_table_jump_by_handler(address, offset)
+            return
+        self.push(f'0x{address >> 8:02x}', 'r')
+        self.push(f'0x{address & 0xFF:02x}', 'r')
+        self.pending_ticks += 6
+        self.imem_address = table_address + 1
+        self.epilogue()
+        self.line(f'return 0x{target + 1:04x}')
+
+    def emit_ret(self, address, offset):
+        self.pop('v', 'r')
+        self.pop('w', 'r')
+        self.pending_ticks += 2
+        self.epilogue()
+        self.line('return (w << 8) + v + 1')
+
+    def emit_hlt(self, address, offset):
+        self.epilogue()
+        self.line(f'cu.pc = 0x{address:04x}')
+        self.line('cu.hlt()')
+
+    def generate(self):
+        for address in self.block.addresses:
+            instruction = OPCODES[self.imem.opcodes[address]] if self.imem.opcodes[address] != UNKNOWN_OPCODE else None
+            if instruction in ["RFROM", "TOR", "ROT", "CALL", "RET"]:
+                self.uses_rstack = True
+            if instruction in ["INC", "DEC", "SUM", "SUB", "CMP", "EQ", "LT", "GT", "JZ", "JL", "JO", "JFA", "JFR"]:
+                self.uses_flags = True
+            if instruction in ["SET", "GET", "LOAD"]:
+                self.uses_ram = True
+            if instruction not in ["JMPR", "JZ", "JL", "JO", "JMPA", "CALL", "RET", "HLT", None]:
+                self.uses_stack = True
+
+        for address in self.block.addresses:
+            self.emit(address)
+
+        last_instruction = self.imem.opcodes[self.block.addresses[-1]]
+        if last_instruction != UNKNOWN_OPCODE and OPCODES[last_instruction] not in BLOCK_TERMINATORS:
+            # block ended because next instruction is a leader of other block
+            self.epilogue()
+            self.line(f'return 0x{self.block.addresses[-1] + 1:04x}')
+
+        return [f'def {self.block.name}(cu):'] + self.prologue() + self.body
+
+
+class Compiler:
+    """
+    Splits instructions memory into basic blocks (reachable from PROGRAM_START_ADDRESS)
+    and generates python module with one function per block.
+    Each function takes ControlUnit, executes block and returns address of next instruction.
+    """
+
+    def __init__(self, imem, logger):
+        self.imem = imem
+        self.logger = logger
+        self.leaders = set()
+
+    def get_successors(self, address):
+        opcode = self.imem.opcodes[address]
+        if opcode == UNKNOWN_OPCODE:
+            return []
+
+        instruction = OPCODES[opcode]
+        offset = self.imem.offsets[address]
+
+        if instruction == "JMPR":
+            return [address + offset + 1]
+        if instruction in CONDITIONAL_JUMPS:
+            return [address + offset + 1, address + 1]
+        if instruction == "JFR":
+            return [address + offset + 1, address + 1]
+        if instruction in ["JMPA", "JFA", "CALL"]:
+            target = get_table_value(self.imem, "CALL" if instruction == "CALL" else "JMPA", offset)[0]
+            # on bad table cells JMPA faults, CALL faults too (but its return address stays reachable by RET),
+            # JFA faults only if jump is taken
+            successors = [target + 1] if target is not None else []
+            if instruction != "JMPA":
+                successors.append(address + 1)
+            return successors
+        if instruction in ["RET", "HLT"]:
+            return []
+        return [address + 1]
+
+    def find_leaders(self, start_address):
+        self.leaders = {start_address}
+        visited = set()
+        to_visit = [start_address]
+
+        while to_visit:
+            address = to_visit.pop()
+            if address in visited or not 0x0000 <= address <= 0xFFFF:
+                continue
+            visited.add(address)
+
+            successors = self.get_successors(address)
+            opcode = self.imem.opcodes[address]
+            if opcode != UNKNOWN_OPCODE and OPCODES[opcode] in BLOCK_TERMINATORS:
+                self.leaders.update(successor for successor in successors if 0x0000 <= successor <= 0xFFFF)
+            to_visit.extend(successors)
+
+    def split_to_blocks(self):
+        blocks = []
+        for leader in sorted(self.leaders):
+            block = BasicBlock(leader)
+            address = leader
+            while True:
+                block.addresses.append(address)
+                opcode = self.imem.opcodes[address]
+                if opcode == UNKNOWN_OPCODE or OPCODES[opcode] in BLOCK_TERMINATORS:
+                    break
+                address += 1
+                if address in self.leaders or address > 0xFFFF:
+                    break
+            blocks.append(block)
+        return blocks
+
+    def generate_source(self, program_hash, start_address=PROGRAM_START_ADDRESS):
+        self.find_leaders(start_address)
+        blocks = self.split_to_blocks()
+        self.logger.info(f"Compiled {len(blocks)} basic blocks of program {program_hash}")
+
+        lines = [f'# generated from program {program_hash} by compiler v{COMPILER_VERSION}, do not edit', '', '']
+        for block in blocks:
+            lines += BlockEmitter(self.imem, block).generate()
+            lines += ['', '']
+
+        lines.append('BLOCKS = {')
+        for block in blocks:
+            lines.append(f'    0x{block.start_address:04x}: {block.name},')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+
+def load_compiled_program(imem, logger, cache_folder=None):
+    """
+    :return: dict of {block start address: block function}, generated module is cached in cache_folder by program hash
+    """
+    if cache_folder is None:
+        cache_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'compiled')
+    os.makedirs(cache_folder, exist_ok=True)
+
+    program_hash = get_program_hash(imem)
+    module_name = f'lab_{program_hash[:32]}'
+    module_path = os.path.join(cache_folder, module_name + '.py')
+
+    if os.path.exists(module_path):
+        logger.info(f"Using compiled program from cache: {module_path}")
+    else:
+        source = Compiler(imem, logger).generate_source(program_hash)
+        temp_path = module_path + f'.{os.getpid()}.tmp'
+        with open(temp_path, "w", encoding="utf-8") as module_file:
+            module_file.write(source)
+        os.replace(temp_path, module_path)
+
+    # .pyc is written to __pycache__ next to module by import machinery
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.BLOCKS
+
+
+class CompiledSimulation(Simulation):
+    """
+    Executes program as generated python basic blocks instead of instruction-by-instruction.
+    Ticks, stack, flags and output buffer are the same as in Simulation. Blocks do not print state, so if it must be
+    printed every tick (DEBUG log or trace recorder), program is interpreted.
+    """
+
+    def __init__(self, logger, cache_folder=None):
+        super().__init__(logger)
+        self.cache_folder = cache_folder
+        self.blocks = None
+
+    def reset(self, program=None, input=None, program_hash=None):
+        if self.cu.reset(program, input, program_hash):
+            self.blocks = None
+
+    def compile(self):
+        self.blocks = load_compiled_program(self.cu.imem, self.cu.logger, self.cache_folder)
+        return self.blocks
+
+    def execute_slice(self, tick_limit, instruction_limit):
+        """
+        Limits are checked between blocks, every executed block counts as one instruction
+        """
+        self.cu.update_tracing()
+        if self.cu.profiler is not None or self.cu.tracing:
+            # blocks do not count instructions and do not print state, so profiled or traced program is interpreted
+            return super().execute_slice(tick_limit, instruction_limit)
+
+        if self.blocks is None:
+            self.compile()
+
+        blocks = self.blocks
+        cu = self.cu
+        pc = cu.pc
+        executed = 0
+
+        try:
+            while executed < instruction_limit and cu.ticks < tick_limit:
+                executed += 1
+                try:
+                    block = blocks[pc]
+                except KeyError:
+                    # not statically reachable address (e.g. RET to patched return address) -- interpret one instruction
+                    cu.pc = pc
+                    self.step()
+                    pc = cu.pc
+                    continue
+                pc = block(cu)
+        except Exception as e:
+            # block has stored address of failed instruction in cu.pc
+            return executed - 1, e
+
+        cu.pc = pc
+        return executed, None
+
+
+def main(program_filepath, input_filepath, output_file_path, logging_level=None, logger=None):
+    model_main(program_filepath, input_filepath, output_file_path, logging_level, logger,
+               simulation_class=CompiledSimulation)
+
+
+if __name__ == '__main__':
+    source_code_path_arg = sys.argv[1]
+    input_filepath_arg = sys.argv[2]
+    output_filepath = sys.argv[3]
+    logging_level_arg = sys.argv[4]
+
+    model_debug_level = logging.DEBUG if logging_level_arg != "info" else logging.INFO
+
+    main(source_code_path_arg, input_filepath_arg, output_filepath, logging_level=model_debug_level)
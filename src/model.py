@@ -1,19 +1,404 @@
+import asyncio
+import hashlib
 import json
 import logging
 import shutil
+import struct
+from array import array
 from logging.handlers import RotatingFileHandler
 import os
 import sys
 import time
+import zlib
+
+NON_ADDRESS_INSTRUCTIONS = [
+    "RET", "SWAP", "OVER", "DUP", "DROP", "ROT", "TOR", "RFROM", "SET", "GET", "SUM", "SUB", "DIV", "MUL",
+    "MOD", "INC", "DEC", "HLT", "TRUE", "FALSE", "CMP", "PRINT", "READ", "TMOD", "TDIV", "EQ", "LT", "GT",
+    "TSUM", "TGET", "TSET", "TEQ", "TDUP"
+]
+ADDRESS_INSTRUCTIONS = [
+    "LOAD", "JMPA", "JMPR", "JZ", "JL", "JO", "CALL", "JFA", "JFR"
+]
+
+# integer opcode of instruction is its index in OPCODES
+OPCODES = NON_ADDRESS_INSTRUCTIONS + ADDRESS_INSTRUCTIONS
+OPCODE_BY_NAME = {name: opcode for opcode, name in enumerate(OPCODES)}
+# everything that is not an instruction (address tables cells, void memory, typos) decodes to this opcode
+UNKNOWN_OPCODE = len(OPCODES)
+
+# first instruction executed after address tables
+PROGRAM_START_ADDRESS = 0x00C0
+# cells of LOAD, CALL and JMPA tables for offsets below ADDRESS_TABLE_SIZE are before program,
+# cells for bigger offsets (up to ADDRESS_TABLE_SIZE + EXTENDED_ADDRESS_TABLE_SIZE) are in extended tables
+ADDRESS_TABLE_SIZE = 32
+EXTENDED_ADDRESS_TABLE_SIZE = 2048
+# start addresses of extended LOAD, CALL and JMPA tables, if program does not give them (program["extended_tables"],
+# translator places extended tables right after program code)
+EXTENDED_ADDRESS_TABLES = (0xC000, 0xD000, 0xE000)
+MAX_INPUT_LENGTH = 255
+# value of instructions memory cell (InstructionsMemory.values), that keeps instruction, not integer
+NO_VALUE = -1
+
+# sequences, that translator emits over and over, executed as one handler (when state is not printed every tick).
+# "NAME:offset" -- instruction with exact offset, "NAME*" -- zero or more of instruction
+SUPERINSTRUCTION_PATTERNS = {
+    "CONSTANT": "LOAD LOAD INC* GET",
+    "VARIABLE": "LOAD LOAD INC* OVER OVER INC GET ROT ROT GET SWAP",
+    "EQ": "CMP JZ:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE",
+    "GT": "CMP JZ:5 JL:4 DROP DROP TRUE JMPR:3 DROP DROP FALSE",
+    "LT": "CMP JZ:5 JL:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE",
+    "IF": "FALSE CMP DROP DROP JZ:1 JMPR:1 JMPA",
+    "TSUM": "ROT TOR SWAP TOR SUM JO:1 JMPR:9 SWAP INC SWAP JO:1 JMPR:4 ROT INC ROT ROT "
+            "ROT ROT RFROM SUM JO:1 JMPR:3 SWAP INC SWAP "
+            "SWAP RFROM SUM ROT ROT SWAP",
+}
+SUPERINSTRUCTIONS = list(SUPERINSTRUCTION_PATTERNS)
+# instructions of superinstructions, that read address tables
+TABLE_OPCODES = {OPCODE_BY_NAME["LOAD"], OPCODE_BY_NAME["JMPA"]}
+SUPERINSTRUCTION_OPCODE_BY_NAME = {name: UNKNOWN_OPCODE + 1 + index for index, name in enumerate(SUPERINSTRUCTIONS)}
+
+
+def parse_superinstruction_pattern(pattern):
+    """
+    :return: list of (opcode, offset or None, is repeated)
+    """
+    parsed = []
+    for word in pattern.split():
+        name, _, offset = word.rstrip('*').partition(':')
+        parsed.append((OPCODE_BY_NAME[name], int(offset) if offset else None, word.endswith('*')))
+    return parsed
+
+
+PARSED_SUPERINSTRUCTION_PATTERNS = {name: parse_superinstruction_pattern(pattern)
+                                    for name, pattern in SUPERINSTRUCTION_PATTERNS.items()}
+
+
+def opcode_and_offset_to_address(opcode, offset, extended_tables=EXTENDED_ADDRESS_TABLES):
+    """
+    address structure for offset below ADDRESS_TABLE_SIZE:
+    address bits #15 to #9: 0\n
+    address bits  #8 to #6: OPCODE bits\n
+    address bits  #5 to #1: OFFSET bits\n
+    address bit         #0: 0\n
+    address for bigger offset (extended tables):
+    extended_tables[OPCODE bits] + (OFFSET - ADDRESS_TABLE_SIZE) * 2\n
+    :param extended_tables: start addresses of extended LOAD, CALL and JMPA tables (see get_extended_tables)
+    :return: computed address of address table cell
+    """
+
+    opcode_bit_map = {
+        OPCODE_BY_NAME["LOAD"]: 0b000,
+        OPCODE_BY_NAME["CALL"]: 0b001,
+        OPCODE_BY_NAME["JMPA"]: 0b010,
+        # JFA jumps by cells of JMPA table
+        OPCODE_BY_NAME["JFA"]: 0b010,
+    }
+    if offset >= ADDRESS_TABLE_SIZE:
+        offset_bits = ((offset - ADDRESS_TABLE_SIZE) & 0x7FF) << 1
+        return (extended_tables[opcode_bit_map[opcode]] + offset_bits) & 0xFFFF
+
+    opcode_bits = (opcode_bit_map[opcode] << 6) & 0x1C0
+    offset_bits = (offset & 0x1F) << 1
+
+    return opcode_bits | offset_bits
+
+
+def get_extended_tables(program):
+    """
+    :param program: program as in .lab file
+    :return: start addresses of its extended LOAD, CALL and JMPA tables
+    """
+    return tuple(program.get("extended_tables") or EXTENDED_ADDRESS_TABLES)
+
+
+def get_lab_program_hash(program):
+    """
+    :param program: program as in .lab file
+    :return: sha256 of its instructions and extended tables addresses (data is loaded to RAM on every reset,
+    so it is not hashed). Binary programs keep it in header (program["hash"], see program_format),
+    so they are not serialized
+    """
+    program_hash = program.get("hash")
+    if program_hash is not None:
+        return program_hash
+    program_hash = hashlib.sha256(json.dumps(program["instructions"], sort_keys=True).encode())
+    if program.get("extended_tables") is not None:
+        program_hash.update(json.dumps(program["extended_tables"]).encode())
+    return program_hash.hexdigest()
+
+
+def get_input_buffer(input_string):
+    """
+    :return: input buffer, as READ expects it: characters reversed (first one at the end) and its length on top\n
+    only first MAX_INPUT_LENGTH characters are taken
+    """
+    input_buffer = [ord(character) for character in reversed(input_string[:MAX_INPUT_LENGTH])]
+    input_buffer.append(len(input_buffer))
+    return input_buffer
+
+
+def format_stack_state(sp, cells, tos):
+    """
+    :param cells: values of stack memory at sp-3, sp-2, sp-1 and sp
+    :return: view of top of stack, as it is printed in state on every tick
+    """
+    cells_str = [f'0x{value:02X}' if sp + shift > -1 and value != 0 else '    '
+                 for shift, value in zip(range(-3, 1), cells)]
+    tos_str = f'0x{tos:02X}' if sp != 65534 else '    '
+
+    return f'{cells_str[0]} {cells_str[1]} {cells_str[2]} {cells_str[3]} , {tos_str}'
+
+
+def format_state(ticks, sp, stack_str, rsp, rstack_str, zf, nf, of, imem_address, pc,
+                 related_token_index, related_token, instruction_name):
+    return (f'tick {ticks: >6}: STACK(sp==0x{sp:04X}): |' +
+            stack_str +
+            '|' +
+            f'     RSTACK(sp=={rsp: >5}): |' +
+            rstack_str +
+            '|    ' +
+            f'ZF/NF/OF: {zf:1}/{nf:1}/{of:1}' +
+            f'     IMEM.ADDR: 0x{imem_address:04x}' +
+            f'     PC: 0x{pc:04x}' +
+            f'     rel_inst_index: {related_token_index} ({related_token}, {instruction_name})')
+
+
+# binary trace: header, then one record of 16-bit little-endian words per tick
+TRACE_MAGIC = b'LABTRACE'
+TRACE_VERSION = 4
+TRACE_HEADER_FORMAT = '<8sHH'
+# ticks take 3 words (48 bits), so they wrap only after 2^48 ticks
+TRACE_RECORD_FIELDS = [
+    "ticks_low", "ticks_middle", "ticks_high", "pc", "imem_address", "instruction_address", "sp", "rsp", "tos_and_rtos",
+    "stack_cells_high", "stack_cells_low", "rstack_cells_high", "rstack_cells_low",
+    "flags_and_instruction", "related_token_index"
+]
+TRACE_RECORD_WORDS = len(TRACE_RECORD_FIELDS)
+
+# snapshot: header, then zlib-compressed stack, return stack and RAM memories, then input buffer and output buffer
+SNAPSHOT_MAGIC = b'LABSNAPS'
+SNAPSHOT_VERSION = 1
+# magic, version, program hash, ticks, pc, imem address, flags, sp, tos, rsp, rtos, RAM address,
+# compressed memories length, input buffer length, output buffer length
+SNAPSHOT_HEADER_FORMAT = '<8sH32sQHHBHBHBHIII'
+
+
+# statuses of Simulation.run()
+HALTED = "halted"
+BUDGET_EXHAUSTED = "budget exhausted"
+WAITING_FOR_INPUT = "waiting for input"
+FAULTED = "faulted"
+
+
+class Halt(Exception):
+    """
+    Raised by HLT instruction
+    """
+
+
+class RunResult:
+    """
+    Result of Simulation.run():\n
+    status -- HALTED, BUDGET_EXHAUSTED, WAITING_FOR_INPUT or FAULTED\n
+    ticks -- ticks done in this run\n
+    instructions -- instructions executed in this run\n
+    error -- exception that stopped simulation (None if budget is exhausted)
+    """
+
+    def __init__(self, status, ticks, instructions, error):
+        self.status = status
+        self.ticks = ticks
+        self.instructions = instructions
+        self.error = error
+
+    def __repr__(self):
+        return f'RunResult({self.status!r}, ticks={self.ticks}, instructions={self.instructions}, error={self.error!r})'
+
+
+# returned instead of chunk, when stream or iterable of InputPort has ended
+END_OF_CHUNKS = object()
+
+
+class InputPort:
+    """
+    Source of bytes for READ, that is read lazily by chunks of chunk_size bytes from binary stream
+    (file, pipe, sys.stdin.buffer) or from iterable of chunks (bytes or str, e.g. generator).\n
+    After the end of stream READ gets end_of_stream_value (every time), so programs can test it.
+    Stream is text: end_of_stream_value can not be told apart from data, so such byte in stream is not taken for
+    the end of it -- READ raises ValueError and run() returns FAULTED.\n
+    If stream has no data yet (non-blocking stream returns None, iterable yields None), READ raises BufferError
+    and run() returns WAITING_FOR_INPUT
+    """
+
+    def __init__(self, source, chunk_size=4096, end_of_stream_value=0x00):
+        self.source = source
+        self.chunks = None if hasattr(source, "read") else iter(source)
+        self.chunk_size = chunk_size
+        self.end_of_stream_value = end_of_stream_value
+        self.chunk = b''
+        self.position = 0
+        self.end_of_stream = False
+
+    def read(self):
+        if self.position == len(self.chunk):
+            self.pull()
+            if self.end_of_stream:
+                return self.end_of_stream_value
+
+        value = self.chunk[self.position]
+        if value == self.end_of_stream_value:
+            raise ValueError(f"Input port: byte 0x{value:02X} in stream is the end of stream value, input must be text")
+        self.position += 1
+        return value
+
+    def pull(self):
+        while not self.end_of_stream:
+            if self.chunks is None:
+                chunk = self.source.read(self.chunk_size)
+                if chunk is not None and len(chunk) == 0:
+                    chunk = END_OF_CHUNKS
+            else:
+                chunk = next(self.chunks, END_OF_CHUNKS)
+
+            if chunk is END_OF_CHUNKS:
+                self.end_of_stream = True
+            elif chunk is None:
+                raise BufferError("Input port has no data yet!")
+            elif len(chunk) > 0:
+                self.chunk = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                self.position = 0
+                return
+
+
+# when OutputPort writes its buffer to stream
+FLUSH_EVERY_CHARACTER = "character"
+FLUSH_ON_NEWLINE = "newline"
+FLUSH_ON_FULL_BUFFER = "full"
+
+
+class OutputPort:
+    """
+    Buffered sink for characters printed by PRINT: they are encoded and written to binary stream
+    (file, pipe, io.BytesIO) according to flush_policy:\n
+    FLUSH_EVERY_CHARACTER -- after every character\n
+    FLUSH_ON_NEWLINE -- after every newline\n
+    FLUSH_ON_FULL_BUFFER -- when buffer_size bytes are collected\n
+    Buffer is also flushed when buffer_size bytes are collected (with any policy) and at the end of every run()
+    """
+
+    def __init__(self, stream, flush_policy=FLUSH_ON_NEWLINE, buffer_size=4096, encoding="utf-8"):
+        assert flush_policy in [FLUSH_EVERY_CHARACTER, FLUSH_ON_NEWLINE, FLUSH_ON_FULL_BUFFER], \
+            f'OUTPUT PORT: unknown flush policy {flush_policy}'
+        self.stream = stream
+        self.flush_policy = flush_policy
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.buffer = bytearray()
+
+    def write(self, character):
+        self.buffer += character.encode(self.encoding)
+        if (self.flush_policy == FLUSH_EVERY_CHARACTER
+                or (self.flush_policy == FLUSH_ON_NEWLINE and character == '\n')
+                or len(self.buffer) >= self.buffer_size):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(bytes(self.buffer))
+            self.buffer.clear()
+        self.stream.flush()
+
+
+class TraceRecorder:
+    """
+    Records state of ControlUnit on every tick as fixed-size record (see TRACE_RECORD_FIELDS)
+    into array-backed ring buffer.
+    If file is given, buffer is written to it every time it is full, otherwise oldest records are overwritten.
+    """
+
+    def __init__(self, file=None, capacity=0x10000):
+        self.file = file
+        self.capacity = capacity
+        self.buffer = array('H', [0]) * (capacity * TRACE_RECORD_WORDS)
+        self.position = 0
+        self.wrapped = False
+
+        if self.file is not None:
+            self.file.write(struct.pack(TRACE_HEADER_FORMAT, TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD_WORDS))
+
+    def record(self, cu, instruction_name):
+        stack_data = cu.stack.data
+        sp = cu.stack.sp
+        rstack_data = cu.rstack.data
+        rsp = cu.rstack.sp
+        buffer = self.buffer
+        index = self.position * TRACE_RECORD_WORDS
+
+        buffer[index] = cu.ticks & 0xFFFF
+        buffer[index + 1] = (cu.ticks >> 16) & 0xFFFF
+        buffer[index + 2] = (cu.ticks >> 32) & 0xFFFF
+        buffer[index + 3] = cu.pc
+        buffer[index + 4] = cu.imem.address
+        buffer[index + 5] = cu.decoder.instruction_address
+        buffer[index + 6] = sp
+        buffer[index + 7] = rsp
+        buffer[index + 8] = (cu.stack.tos & 0xFF) | (cu.rstack.tos & 0xFF) << 8
+        buffer[index + 9] = stack_data[(sp - 3) & 0xFFFF] << 8 | stack_data[(sp - 2) & 0xFFFF]
+        buffer[index + 10] = stack_data[(sp - 1) & 0xFFFF] << 8 | stack_data[sp]
+        buffer[index + 11] = rstack_data[(rsp - 3) & 0xFFFF] << 8 | rstack_data[(rsp - 2) & 0xFFFF]
+        buffer[index + 12] = rstack_data[(rsp - 1) & 0xFFFF] << 8 | rstack_data[rsp]
+        buffer[index + 13] = (bool(cu.zf) | bool(cu.nf) << 1 | bool(cu.of) << 2) | OPCODE_BY_NAME[instruction_name] << 8
+        buffer[index + 14] = cu.get_related_token()[0] + 1
+
+        self.position += 1
+        if self.position == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if self.file is None:
+            if self.position == self.capacity:
+                self.position = 0
+                self.wrapped = True
+            return
+
+        block = self.buffer[:self.position * TRACE_RECORD_WORDS]
+        if sys.byteorder == 'big':
+            block.byteswap()
+        block.tofile(self.file)
+        self.position = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.flush()
+
+    def get_records(self):
+        """
+        :return: records that are in buffer (oldest first), as array of words
+        """
+        end = self.position * TRACE_RECORD_WORDS
+        if self.wrapped:
+            return self.buffer[end:] + self.buffer[:end]
+        return self.buffer[:end]
+
+
+# 64 KiB of zeros, memories are reset by copying it, without allocation
+ZERO_MEMORY = bytes(0x10000)
 
 
 class Stack:
     def __init__(self, logger):
-        self.data = [0] * 0x10000  # addresses from 0x0000 to 0xFFFF
+        self.data = bytearray(0x10000)  # addresses from 0x0000 to 0xFFFF
+        self.view = memoryview(self.data)
         self.sp = 0xFFFE
         self.tos = 0x00
         self.logger = logger
 
+    def reset(self):
+        self.view[:] = ZERO_MEMORY
+        self.sp = 0xFFFE
+        self.tos = 0x00
+
     def get_next(self):
         # not exactly next, but returns value from stack by SP
         assert self.sp != 0xFFFE and self.sp != 0xFFFF, f'STACK ERROR: trying to get forbidden address (sp = {self.sp:04X})'
@@ -77,14 +462,22 @@ class Stack:
 
 class RAM:
     def __init__(self):
-        self.data = [0] * 0x10000  # addresses from 0x0000 to 0xFFFF
+        self.data = bytearray(0x10000)  # addresses from 0x0000 to 0xFFFF
+        self.view = memoryview(self.data)
+        self.ad = 0x0000
+
+    def reset(self):
+        self.view[:] = ZERO_MEMORY
         self.ad = 0x0000
 
     def init_data(self, data):
-        data_start = 0x0000
-        for value in data:
-            self.data[data_start] = value
-            data_start += 1
+        """
+        zeroes RAM and copies data to it starting from 0x0000
+        :param data: list of ints or bytes-like object
+        """
+        assert len(data) <= 0x10000, f'RAM: data of length {len(data)} does not fit in memory'
+        self.reset()
+        self.view[:len(data)] = data if isinstance(data, (bytes, bytearray, memoryview)) else bytes(data)
 
     def latch_address(self, address):
         assert 0x0000 <= address <= 0xFFFF, f'RAM: address {hex(address)} out of bounds'
@@ -108,16 +501,115 @@ class RAM:
 
 class InstructionsMemory:
     def __init__(self):
+        self.reset()
+
+    def reset(self):
         self.data = [{"value": 0x00, "related_token": "model imem init",
                       "related_token_index": -1}] * 0x10000  # addresses from 0x0000 to 0xFFFF
         self.address = 0x0000
+        self.extended_tables = EXTENDED_ADDRESS_TABLES
+
+        # pre-decoded image of data: opcodes[address], offsets[address], related_token_indexes[address],
+        # values[address] -- integer value of cell (NO_VALUE for instructions), that address tables are read from
+        self.opcodes = array('B', [UNKNOWN_OPCODE]) * 0x10000
+        self.offsets = array('i', [0]) * 0x10000
+        self.values = array('i', [0]) * 0x10000
+        self.related_token_indexes = array('i', [-1]) * 0x10000
+        # same as opcodes, but with superinstructions at starts of fused sequences (fused_lengths -- their lengths)
+        self.fused_opcodes = array('B', self.opcodes)
+        self.fused_lengths = array('H', [0]) * 0x10000
+
+    def init_data(self, data, extended_tables=EXTENDED_ADDRESS_TABLES):
+        """
+        :param extended_tables: start addresses of extended LOAD, CALL and JMPA tables (see get_extended_tables)
+        """
+        self.extended_tables = extended_tables
+        fill_instructions_memory = getattr(data, "fill_instructions_memory", None)
+        if fill_instructions_memory is not None:
+            # instructions of binary program fill pre-decoded arrays from its records (see program_format)
+            fill_instructions_memory(self)
+            self.fuse()
+            return
 
-    def init_data(self, data):
         data_start = 0x0000
         for value in data:
             self.data[data_start] = value
             data_start += 1
 
+        self.predecode()
+
+    def predecode(self):
+        """
+        data -> opcodes, offsets, related_token_indexes\n
+        done once on program load, so fetch and decode are just indexing in arrays
+        """
+        opcodes = []
+        offsets = []
+        values = []
+        related_token_indexes = []
+        for instruction in self.data:
+            offset = instruction.get("offset")
+            value = instruction["value"]
+
+            opcodes.append(OPCODE_BY_NAME.get(value, UNKNOWN_OPCODE))
+            offsets.append(offset if offset is not None else 0)
+            values.append(value if isinstance(value, int) else NO_VALUE)
+            related_token_indexes.append(instruction.get("related_token_index", -1))
+
+        self.opcodes = array('B', opcodes)
+        self.offsets = array('i', offsets)
+        self.values = array('i', values)
+        self.related_token_indexes = array('i', related_token_indexes)
+
+        self.fuse()
+
+    def match_superinstruction(self, address, pattern):
+        """
+        :return: length of sequence starting at address that matches pattern, 0 if it doesn't match
+        """
+        length = 0
+        for opcode, offset, is_repeated in pattern:
+            if is_repeated:
+                while address + length <= 0xFFFF and self.opcodes[address + length] == opcode:
+                    length += 1
+                continue
+
+            if (address + length > 0xFFFF
+                    or self.opcodes[address + length] != opcode
+                    or (offset is not None and self.offsets[address + length] != offset)
+                    or (opcode in TABLE_OPCODES and not self.has_table_bytes(opcode, self.offsets[address + length]))):
+                return 0
+            length += 1
+        return length
+
+    def has_table_bytes(self, opcode, offset):
+        """
+        :return: True if both cells of LOAD/CALL/JMPA address table cell pair for offset keep bytes
+        (ControlUnit faults on other values, so instructions with such cells are not fused or compiled)
+        """
+        address = opcode_and_offset_to_address(opcode, offset, self.extended_tables)
+        return 0x00 <= self.values[address] <= 0xFF and 0x00 <= self.values[address + 1] <= 0xFF
+
+    def fuse(self):
+        """
+        opcodes -> fused_opcodes, where first instruction of every recognized sequence is replaced with superinstruction.
+        Other instructions of sequence are kept, so jumps into the middle of sequence still work
+        """
+        self.fused_opcodes = array('B', self.opcodes)
+        self.fused_lengths = array('H', [0]) * 0x10000
+
+        address = 0x0000
+        while address <= 0xFFFF:
+            length = 0
+            if self.opcodes[address] != UNKNOWN_OPCODE:
+                for name, pattern in PARSED_SUPERINSTRUCTION_PATTERNS.items():
+                    length = self.match_superinstruction(address, pattern)
+                    if length:
+                        self.fused_opcodes[address] = SUPERINSTRUCTION_OPCODE_BY_NAME[name]
+                        self.fused_lengths[address] = length
+                        break
+            address += length if length else 1
+
     def address_inc(self):
         assert self.address < 0xFFFF, f'PC INC error: out of bounds (pc currently is 0xFFFF)'
         self.address += 1
@@ -137,30 +629,38 @@ class InstructionsMemory:
     def load(self):
         return self.data[self.address]
 
+    def load_value(self):
+        return self.values[self.address]
+
 
 class Decoder:
     def __init__(self):
         self.instruction = None
+        self.instruction_address = None
         self.opcode = None
         self.offset = None
 
-        self.__non_address_instructions_list = [
-            "RET", "SWAP", "OVER", "DUP", "DROP", "ROT", "TOR", "RFROM", "SET", "GET", "SUM", "SUB", "DIV", "MUL",
-            "MOD", "INC", "DEC", "HLT", "TRUE", "FALSE", "CMP", "PRINT", "READ", "TMOD", "TDIV"
-        ]
-        self.__address_instructions_list = [
-            "LOAD", "JMPA", "JMPR", "JZ", "JL", "JO", "CALL"
-        ]
-
     def decode(self):
-        if self.instruction["value"] in self.__address_instructions_list:
-            self.opcode = self.instruction["value"]
+        opcode = OPCODE_BY_NAME.get(self.instruction["value"], UNKNOWN_OPCODE)
+        if opcode == UNKNOWN_OPCODE:
+            self.raise_unknown_opcode()
+
+        self.opcode = opcode
+        if self.instruction["value"] in ADDRESS_INSTRUCTIONS:
             self.offset = self.instruction["offset"]
-        else:
-            if not self.instruction["value"] in self.__non_address_instructions_list:
-                raise ValueError(
-                    f'DECODER: unknown OPCODE: {self.instruction["value"]}, related token: {self.instruction["related_token"]}')
-            self.opcode = self.instruction["value"]
+
+    def decode_predecoded(self, imem):
+        """
+        imem.opcodes[imem.address] -> opcode; imem.offsets[imem.address] -> offset
+        """
+        self.opcode = imem.opcodes[imem.address]
+        self.offset = imem.offsets[imem.address]
+
+    def raise_unknown_opcode(self, related_token=None):
+        if related_token is None:
+            related_token = self.instruction.get("related_token")
+        raise ValueError(
+            f'DECODER: unknown OPCODE: {self.instruction["value"]}, related token: {related_token}')
 
 
 class ControlUnit:
@@ -175,6 +675,7 @@ class ControlUnit:
         self.output_buffer = []
 
         self.decoder = Decoder()
+        self.dispatch_table = self.build_dispatch_table()
 
         self.of = False
         self.zf = False
@@ -182,39 +683,160 @@ class ControlUnit:
 
         self.ticks = 0
         self.need_print_state = True
+        self.use_superinstructions = True
         self.logger = logger
+        self.trace_recorder = None
+        self.tracing = False
+        self.update_tracing()
+        # counts executions and ticks of every instruction address, see profiler.py
+        self.profiler = None
+        # if input port is set, READ takes bytes from it instead of input buffer
+        self.input_port = None
+        # printed characters go to output port (if it is set) and are kept in output buffer (if needed)
+        self.output_port = None
+        self.keep_output_buffer = True
+
+        # program loaded by reset() and sha256 of its instructions
+        self.program = None
+        self.program_hash = None
+        # related tokens of program, if they are not in its instructions (see program_format.DebugInfo)
+        self.debug_info = None
+
+    def reset(self, program=None, input=None, program_hash=None):
+        """
+        Returns ControlUnit to state it has after Simulation creation, in place: stacks and RAM are zeroed, not
+        reallocated.\n
+        program -- program as in .lab file. Instructions memory is reloaded (and pre-decoded) only if its
+        instructions differ from loaded ones, data is loaded to RAM on every reset. If None, loaded program is kept\n
+        input -- input string (see get_input_buffer). If None, input buffer is empty\n
+        program_hash -- get_lab_program_hash(program), if caller already knows it (so program is not hashed again)
+        :return: True if instructions memory was reloaded
+        """
+        reloaded = False
+        if program is not None and program is not self.program:
+            if program_hash is None:
+                program_hash = get_lab_program_hash(program)
+            if program_hash != self.program_hash:
+                self.imem.reset()
+                self.imem.init_data(program["instructions"], get_extended_tables(program))
+                self.program_hash = program_hash
+                reloaded = True
+            self.program = program
+            self.debug_info = program.get("debug_info")
+
+        self.stack.reset()
+        self.rstack.reset()
+        if self.program is not None:
+            self.ram.init_data(self.program["data"])
+        else:
+            self.ram.reset()
 
-    def get_stack_str(self, stack):
-        a = stack.sp - 3 if stack.sp - 3 > -1 else 999999
-        b = stack.sp - 2 if stack.sp - 2 > -1 else 999999
-        c = stack.sp - 1 if stack.sp - 1 > -1 else 999999
-        d = stack.sp if stack.sp > -1 else 999999
+        self.pc = PROGRAM_START_ADDRESS
+        self.imem.address = 0x0000
+        self.of = False
+        self.zf = False
+        self.nf = False
+        self.ticks = 0
 
-        aa = f'0x{stack.data[a]:02X}' if a != 999999 and stack.data[a] != 0 else '    '
-        bb = f'0x{stack.data[b]:02X}' if b != 999999 and stack.data[b] != 0 else '    '
-        cc = f'0x{stack.data[c]:02X}' if c != 999999 and stack.data[c] != 0 else '    '
-        dd = f'0x{stack.data[d]:02X}' if d != 999999 and stack.data[d] != 0 else '    '
+        self.input_buffer = get_input_buffer(input) if input is not None else []
+        self.output_buffer = []
+
+        return reloaded
+
+    def get_snapshot(self):
+        """
+        Taken between instructions, it is enough to continue simulation with same program (see load_snapshot)
+        :return: snapshot of state as bytes (format: SNAPSHOT_HEADER_FORMAT header and data after it)
+        """
+        assert self.program_hash is not None, 'SNAPSHOT: program must be loaded by reset()'
+
+        memories = zlib.compress(bytes(self.stack.data) + bytes(self.rstack.data) + bytes(self.ram.data), 1)
+        input_buffer = array('I', self.input_buffer)
+        if sys.byteorder == 'big':
+            input_buffer.byteswap()
+        output = ''.join(self.output_buffer).encode('latin-1')
+
+        header = struct.pack(SNAPSHOT_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                             bytes.fromhex(self.program_hash), self.ticks, self.pc, self.imem.address,
+                             bool(self.zf) | bool(self.nf) << 1 | bool(self.of) << 2,
+                             self.stack.sp, self.stack.tos, self.rstack.sp, self.rstack.tos, self.ram.ad,
+                             len(memories), len(input_buffer), len(output))
+
+        return header + memories + input_buffer.tobytes() + output
+
+    def load_snapshot(self, snapshot):
+        """
+        Restores state from get_snapshot() result. Program of snapshot must be already loaded by reset()
+        """
+        header_size = struct.calcsize(SNAPSHOT_HEADER_FORMAT)
+        (magic, version, program_hash, ticks, pc, imem_address, flags, sp, tos, rsp, rtos, ram_address,
+         memories_length, input_length, output_length) = struct.unpack_from(SNAPSHOT_HEADER_FORMAT, snapshot)
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f'SNAPSHOT: not a snapshot of version {SNAPSHOT_VERSION}')
+        if program_hash.hex() != self.program_hash:
+            raise ValueError('SNAPSHOT: snapshot was taken with other program')
+
+        position = header_size
+        memories = zlib.decompress(snapshot[position:position + memories_length])
+        position += memories_length
+        assert len(memories) == 3 * 0x10000, 'SNAPSHOT: memories are damaged'
+        self.stack.view[:] = memories[:0x10000]
+        self.rstack.view[:] = memories[0x10000:0x20000]
+        self.ram.view[:] = memories[0x20000:]
+
+        input_buffer = array('I')
+        input_buffer.frombytes(snapshot[position:position + input_length * input_buffer.itemsize])
+        position += input_length * input_buffer.itemsize
+        if sys.byteorder == 'big':
+            input_buffer.byteswap()
+        self.input_buffer = input_buffer.tolist()
+        self.output_buffer = list(bytes(snapshot[position:position + output_length]).decode('latin-1'))
+
+        self.ticks = ticks
+        self.pc = pc
+        self.imem.address = imem_address
+        self.zf = bool(flags & 0b001)
+        self.nf = bool(flags & 0b010)
+        self.of = bool(flags & 0b100)
+        self.stack.sp, self.stack.tos = sp, tos
+        self.rstack.sp, self.rstack.tos = rsp, rtos
+        self.ram.ad = ram_address
+
+    def update_tracing(self):
+        """
+        state is printed every tick only if it is needed and there is a sink for it: trace recorder or logger
+        that does not throw DEBUG records away (checked once, not on every tick)
+        """
+        self.tracing = self.need_print_state and (self.trace_recorder is not None
+                                                  or self.logger.isEnabledFor(logging.DEBUG))
 
-        tos = f'0x{stack.tos:02X}' if stack.sp != 65534 else '    '
+    def get_stack_str(self, stack):
+        cells = [stack.data[(stack.sp + shift) & 0xFFFF] for shift in range(-3, 1)]
+        return format_stack_state(stack.sp, cells, stack.tos)
 
-        return f'{aa} {bb} {cc} {dd} , {tos}'
+    def get_related_token(self):
+        """
+        :return: (token index, token) of decoded instruction, from debug info (loaded on first call) if it is set
+        """
+        if self.debug_info is not None:
+            return self.debug_info.get_related_token(self.decoder.instruction_address)
+        return self.decoder.instruction.get("related_token_index", -1), self.decoder.instruction.get("related_token")
 
     def get_state_str(self, instruction_name):
-        return (f'tick {self.ticks: >6}: STACK(sp==0x{self.stack.sp:04X}): |' +
-                self.get_stack_str(self.stack) +
-                '|' +
-                f'     RSTACK(sp=={self.rstack.sp: >5}): |' +
-                self.get_stack_str(self.rstack) +
-                '|    ' +
-                f'ZF/NF/OF: {self.zf:1}/{self.nf:1}/{self.of:1}' +
-                f'     IMEM.ADDR: 0x{self.imem.address:04x}' +
-                f'     PC: 0x{self.pc:04x}' +
-                f'     rel_inst_index: {self.decoder.instruction["related_token_index"]} ({self.decoder.instruction["related_token"]}, {instruction_name})')
+        related_token_index, related_token = self.get_related_token()
+        return format_state(self.ticks, self.stack.sp, self.get_stack_str(self.stack),
+                            self.rstack.sp, self.get_stack_str(self.rstack),
+                            self.zf, self.nf, self.of, self.imem.address, self.pc,
+                            related_token_index, related_token, instruction_name)
 
     def tick(self, instruction_name):
         self.ticks += 1
-        if self.need_print_state:
-            self.logger.log(logging.DEBUG, self.get_state_str(instruction_name))
+        if self.tracing:
+            if self.trace_recorder is not None:
+                self.trace_recorder.record(self, instruction_name)
+            else:
+                self.logger.log(logging.DEBUG, self.get_state_str(instruction_name))
 
     def latch_pc_low_bits(self, address_low_bits):
         assert 0x00 <= address_low_bits <= 0xFF, f'INSTRUCTION MEMORY: address low bits {hex(address_low_bits)} out of bounds'
@@ -276,9 +898,39 @@ class ControlUnit:
         self.tick("FALSE")
 
     def cmp(self):
-        a = self.stack.data[self.stack.sp]
-        b = self.stack.tos
+        self.set_cmp_flags(self.stack.data[self.stack.sp], self.stack.tos)
+        self.tick("CMP")
+
+    def compare(self, instruction_name, result):
+        """
+        sets flags as CMP;\n
+        sp--; TRUE or FALSE (computed from flags) -> TOS;
+        """
+        self.set_cmp_flags(self.stack.data[self.stack.sp], self.stack.tos)
+        self.tick(instruction_name)
+        self.stack.sp_dec()
+        self.stack.tos = 0xFF if result() else 0x00
+        self.tick(instruction_name)
+
+    def eq(self):
+        """
+        a b -- a==b, same as CMP JZ:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE ("=")
+        """
+        self.compare("EQ", lambda: self.zf)
 
+    def lt(self):
+        """
+        a b -- a<=b, same as CMP JZ:5 JL:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE ("<")
+        """
+        self.compare("LT", lambda: self.zf or self.nf)
+
+    def gt(self):
+        """
+        a b -- a>b, same as CMP JZ:5 JL:4 DROP DROP TRUE JMPR:3 DROP DROP FALSE (">")
+        """
+        self.compare("GT", lambda: not (self.zf or self.nf))
+
+    def set_cmp_flags(self, a, b):
         sign_mask = 0b10000000
 
         sign_a = a & sign_mask
@@ -297,8 +949,6 @@ class ControlUnit:
             # Both numbers have the same sign, compare magnitudes
            self.nf = True if a < b else 0
 
-        self.tick("CMP")
-
     def swap(self):
         """
         stack swap
@@ -492,23 +1142,9 @@ class ControlUnit:
 
     def __opcode_and_address_to_bits(self):
         """
-        address structure:
-        address bits #15 to #9: 0\n
-        address bits  #8 to #6: OPCODE bits\n
-        address bits  #5 to #1: OFFSET bits\n
-        address bit         #0: 0\n
-        :return: computed address
+        :return: address of address table cell computed from decoder OPCODE and OFFSET
         """
-
-        opcode_bit_map = {
-            "LOAD": 0b000,
-            "CALL": 0b001,
-            "JMPA": 0b010,
-        }
-        opcode_bits = (opcode_bit_map[self.decoder.opcode] << 6) & 0x1C0
-        offset_bits = (self.decoder.offset & 0x1F) << 1
-
-        return opcode_bits | offset_bits
+        return opcode_and_offset_to_address(self.decoder.opcode, self.decoder.offset, self.imem.extended_tables)
 
     def jmp_absolute(self):
         """
@@ -520,11 +1156,11 @@ class ControlUnit:
         self.imem.latch_address(self.__opcode_and_address_to_bits())
         self.imem.latch_address(self.__opcode_and_address_to_bits())
         self.tick("JMPA")
-        self.latch_pc_high_bits(self.imem.load()["value"])
+        self.latch_pc_high_bits(self.imem.load_value())
         self.tick("JMPA")
         self.imem.address_inc()
         self.tick("JMPA")
-        self.latch_pc_low_bits(self.imem.load()["value"])
+        self.latch_pc_low_bits(self.imem.load_value())
         self.tick("JMPA")
 
     def jmp_relative(self):
@@ -534,6 +1170,29 @@ class ControlUnit:
         self.pc = self.pc + self.decoder.offset
         self.tick("JMPR")
 
+    def jump_if_false(self, instruction_name, jump):
+        """
+        sets flags as FALSE CMP; TOS -> value; sp--;\n
+        if value == 0: jump
+        """
+        value = self.stack.pop()
+        self.set_cmp_flags(value, 0)
+        self.tick(instruction_name)
+        if self.zf:
+            jump()
+
+    def jfa(self):
+        """
+        a -- ; jump by JMPA table cell (as JMPA) if a == 0, same as FALSE CMP DROP DROP JZ:1 JMPR:1 JMPA
+        """
+        self.jump_if_false("JFA", self.jmp_absolute)
+
+    def jfr(self):
+        """
+        a -- ; PC + OFFSET -> PC if a == 0
+        """
+        self.jump_if_false("JFR", self.jmp_relative)
+
     def jz(self):
         if self.zf:
             self.jmp_relative()
@@ -585,25 +1244,33 @@ class ControlUnit:
         """
         self.imem.latch_address(self.__opcode_and_address_to_bits())
         self.tick("LOAD")
-        self.ram.latch_address_high_bits(self.imem.load()["value"])
+        self.ram.latch_address_high_bits(self.imem.load_value())
         self.tick("LOAD")
         self.imem.address_inc()
         self.tick("LOAD")
-        self.ram.latch_address_low_bits(self.imem.load()["value"])
+        self.ram.latch_address_low_bits(self.imem.load_value())
         self.tick("LOAD")
 
         self.stack.push(self.ram.load())
         self.tick("LOAD")
 
     def print(self):
-        ascii_character = chr(self.stack.pop())
-        self.output_buffer.append(ascii_character)
+        self.write_output(chr(self.stack.pop()))
         self.tick("PRINT")
 
+    def write_output(self, character):
+        if self.output_port is not None:
+            self.output_port.write(character)
+        if self.keep_output_buffer:
+            self.output_buffer.append(character)
+
     def read(self):
-        if len(self.input_buffer) == 0:
-            raise BufferError("Trying to read void input buffer!")
-        self.stack.push(self.input_buffer.pop())
+        if self.input_port is not None:
+            self.stack.push(self.input_port.read())
+        else:
+            if len(self.input_buffer) == 0:
+                raise BufferError("Trying to read void input buffer!")
+            self.stack.push(self.input_buffer.pop())
         self.tick("READ")
 
     def tmod(self):
@@ -655,10 +1322,343 @@ class ControlUnit:
 
             self.tick("TDIV")
 
+    def pop_tnumber(self, instruction_name):
+        """
+        x1 x2 x3 -- ; one tick per byte
+        :return: 24-bit number, x1 is its high byte
+        """
+        number = 0
+        for shift in [0, 8, 16]:
+            number |= self.stack.pop() << shift
+            self.tick(instruction_name)
+        return number
+
+    def push_tnumber(self, instruction_name, number):
+        """
+        -- x1 x2 x3 ; one tick per byte, x1 is high byte of 24-bit number
+        """
+        for shift in [16, 8, 0]:
+            self.stack.push((number >> shift) & 0xFF)
+            self.tick(instruction_name)
+
+    def tsum(self):
+        """
+        aaa bbb -- (aaa+bbb) mod 2^24, same as T+ expansion (flags are not changed)
+        """
+        b = self.pop_tnumber("TSUM")
+        a = self.pop_tnumber("TSUM")
+        self.push_tnumber("TSUM", (a + b) & 0xFFFFFF)
+
+    def teq(self):
+        """
+        aaa bbb -- aaa==bbb, same as T= expansion (flags are not changed)
+        """
+        b = self.pop_tnumber("TEQ")
+        a = self.pop_tnumber("TEQ")
+        self.stack.push(0xFF if a == b else 0x00)
+        self.tick("TEQ")
+
+    def tdup(self):
+        """
+        aaa -- aaa aaa
+        """
+        data = self.stack.data
+        sp = self.stack.sp
+        self.push_tnumber("TDUP", (data[(sp - 1) & 0xFFFF] << 16) | (data[sp] << 8) | self.stack.tos)
+
+    def tget(self):
+        """
+        TOS -> AD_L; sp--;\n
+        TOS -> AD_H; sp--;\n
+        3 times: sp++; RAM[AD] -> TOS; AD++;\n
+        a_h a_l -- RAM[a] RAM[a+1] RAM[a+2], same as T@ expansion
+        """
+        self.ram.latch_address_low_bits(self.stack.pop())
+        self.tick("TGET")
+        self.ram.latch_address_high_bits(self.stack.pop())
+        self.tick("TGET")
+        for index in range(3):
+            if index > 0:
+                self.ram.latch_address((self.ram.ad + 1) & 0xFFFF)
+            self.stack.push(self.ram.load())
+            self.tick("TGET")
+
+    def tset(self):
+        """
+        TOS -> AD_L; sp--;\n
+        TOS -> AD_H; sp--;\n
+        3 times, from AD+2 to AD: TOS -> RAM[AD+i]; sp--;\n
+        x1 x2 x3 a_h a_l -- ; RAM[a] = x1, RAM[a+1] = x2, RAM[a+2] = x3, same as T! expansion
+        """
+        self.ram.latch_address_low_bits(self.stack.pop())
+        self.tick("TSET")
+        self.ram.latch_address_high_bits(self.stack.pop())
+        self.tick("TSET")
+        address = self.ram.ad
+        for shift in [2, 1, 0]:
+            self.ram.latch_address((address + shift) & 0xFFFF)
+            self.ram.save(self.stack.pop())
+            self.tick("TSET")
+
     def hlt(self):
-        raise Exception(f"HLT was raised on tick {self.ticks}")
+        raise Halt(f"HLT was raised on tick {self.ticks}")
 
-    def execute(self, opcode):
+    # SUPERINSTRUCTIONS
+    # each one leaves stacks, RAM, flags, ticks and PC exactly as the fused sequence does (PC -- at its last executed instruction)
+    def get_table_value(self, opcode_name, offset):
+        """
+        :return: 16-bit value from address table cell of LOAD/CALL/JMPA with offset, and address of that cell
+        """
+        address = opcode_and_offset_to_address(OPCODE_BY_NAME[opcode_name], offset, self.imem.extended_tables)
+        return (self.imem.values[address] << 8) + self.imem.values[address + 1], address
+
+    def superinstruction_constant(self):
+        """
+        LOAD LOAD INC*n GET\n
+        a -- a MEM[MEM[LOAD_a]:MEM[LOAD_b]+n]
+        """
+        address = self.pc
+        length = self.imem.fused_lengths[address]
+        incs = length - 3
+        data = self.stack.data
+        sp = self.stack.sp
+
+        high = self.ram.data[self.get_table_value("LOAD", self.imem.offsets[address])[0]]
+        low = self.ram.data[self.get_table_value("LOAD", self.imem.offsets[address + 1])[0]]
+        if incs:
+            low = (low + incs) & 0xFF
+            self.of = self.zf = low == 0
+            self.nf = low >= 0x80
+
+        sp = (sp + 1) & 0xFFFF
+        data[sp] = self.stack.tos
+        data[(sp + 1) & 0xFFFF] = high
+        self.ram.ad = (high << 8) + low
+        self.stack.sp = sp
+        self.stack.tos = self.ram.data[self.ram.ad]
+
+        self.ticks += 13 + incs
+        self.pc = self.imem.address = address + length - 1
+
+    def superinstruction_variable(self):
+        """
+        LOAD LOAD INC*n OVER OVER INC GET ROT ROT GET SWAP\n
+        a -- a MEM[addr] MEM[addr+1], where addr = MEM[LOAD_a]:MEM[LOAD_b]+n
+        """
+        address = self.pc
+        length = self.imem.fused_lengths[address]
+        incs = length - 10
+        data = self.stack.data
+        sp = self.stack.sp
+        ram = self.ram.data
+
+        high = ram[self.get_table_value("LOAD", self.imem.offsets[address])[0]]
+        low = (ram[self.get_table_value("LOAD", self.imem.offsets[address + 1])[0]] + incs) & 0xFF
+        next_low = (low + 1) & 0xFF
+        self.of = self.zf = next_low == 0
+        self.nf = next_low >= 0x80
+
+        data[(sp + 1) & 0xFFFF] = self.stack.tos
+        data[(sp + 2) & 0xFFFF] = ram[(high << 8) + low]
+        data[(sp + 3) & 0xFFFF] = high
+        data[(sp + 4) & 0xFFFF] = high
+        self.rstack.data[(self.rstack.sp + 1) & 0xFFFF] = self.rstack.tos
+        self.ram.ad = (high << 8) + low
+        self.stack.sp = (sp + 2) & 0xFFFF
+        self.stack.tos = ram[(high << 8) + next_low]
+
+        self.ticks += 36 + incs
+        self.pc = self.imem.address = address + length - 1
+
+    def superinstruction_eq(self):
+        """
+        CMP JZ:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE\n
+        a b -- a==b
+        """
+        address = self.pc
+        self.set_cmp_flags(self.stack.data[self.stack.sp], self.stack.tos)
+        self.stack.sp = (self.stack.sp - 1) & 0xFFFF
+        self.stack.tos = 0xFF if self.zf else 0x00
+        self.ticks += 5
+
+        self.imem.address = address + 8 if self.zf else address + 5
+        self.pc = address + 8
+
+    def superinstruction_gt(self):
+        """
+        CMP JZ:5 JL:4 DROP DROP TRUE JMPR:3 DROP DROP FALSE\n
+        a b -- a>b
+        """
+        address = self.pc
+        self.set_cmp_flags(self.stack.data[self.stack.sp], self.stack.tos)
+        jumped = self.zf or self.nf
+        self.stack.sp = (self.stack.sp - 1) & 0xFFFF
+        self.stack.tos = 0x00 if jumped else 0xFF
+        self.ticks += 5
+
+        self.imem.address = address + 9 if jumped else address + 6
+        self.pc = address + 9
+
+    def superinstruction_lt(self):
+        """
+        CMP JZ:5 JL:4 DROP DROP FALSE JMPR:3 DROP DROP TRUE\n
+        a b -- a<=b
+        """
+        address = self.pc
+        self.set_cmp_flags(self.stack.data[self.stack.sp], self.stack.tos)
+        jumped = self.zf or self.nf
+        self.stack.sp = (self.stack.sp - 1) & 0xFFFF
+        self.stack.tos = 0xFF if jumped else 0x00
+        self.ticks += 5
+
+        self.imem.address = address + 9 if jumped else address + 6
+        self.pc = address + 9
+
+    def superinstruction_if(self):
+        """
+        FALSE CMP DROP DROP JZ:1 JMPR:1 JMPA\n
+        a -- ; jump by JMPA table if a == 0, else skip JMPA
+        """
+        address = self.pc
+        sp = self.stack.sp
+        value = self.stack.tos
+
+        self.stack.data[(sp + 1) & 0xFFFF] = value
+        self.set_cmp_flags(value, 0)
+        self.stack.tos = self.stack.data[sp]
+        self.stack.sp = (sp - 1) & 0xFFFF
+
+        if self.zf:
+            target, table_address = self.get_table_value("JMPA", self.imem.offsets[address + 6])
+            self.imem.address = table_address + 1
+            self.pc = target
+            self.ticks += 9
+        else:
+            self.imem.address = address + 5
+            self.pc = address + 6
+            self.ticks += 5
+
+    def superinstruction_tsum(self):
+        """
+        body of T+ (31 instructions)\n
+        a1 a2 a3 b1 b2 b3 -- c1 c2 c3
+        """
+        address = self.pc
+        if self.stack.sp in [0x0000, 0x0001]:
+            # less than 6 values on stack: SUMs fault on underflow, so instructions are executed one by one
+            self.dispatch_table[self.imem.opcodes[address]]()
+            return
+        data = self.stack.data
+        sp = self.stack.sp
+        tos = self.stack.tos
+        rdata = self.rstack.data
+        rsp = self.rstack.sp
+        rtos = self.rstack.tos
+
+        # ROT
+        second = (sp - 1) & 0xFFFF
+        data[second], data[sp], tos = data[sp], tos, data[second]
+        rdata[(rsp + 1) & 0xFFFF] = rtos
+        # TOR
+        rsp = (rsp + 1) & 0xFFFF
+        rdata[rsp], rtos, tos = rtos, tos, data[sp]
+        sp = (sp - 1) & 0xFFFF
+        # SWAP
+        tos, data[sp] = data[sp], tos
+        # TOR
+        rsp = (rsp + 1) & 0xFFFF
+        rdata[rsp], rtos, tos = rtos, tos, data[sp]
+        sp = (sp - 1) & 0xFFFF
+        # SUM
+        tos += data[sp]
+        overflow = tos > 0xFF
+        tos &= 0xFF
+        sp = (sp - 1) & 0xFFFF
+        ticks = 8
+
+        # JO:1 JMPR:9
+        ticks += 1
+        if overflow:
+            # SWAP INC SWAP
+            tos, data[sp] = data[sp], tos
+            tos += 1
+            overflow = tos > 0xFF
+            tos &= 0xFF
+            tos, data[sp] = data[sp], tos
+            ticks += 3
+
+            # JO:1 JMPR:4
+            ticks += 1
+            if overflow:
+                # ROT INC ROT ROT
+                second = (sp - 1) & 0xFFFF
+                data[second], data[sp], tos = data[sp], tos, data[second]
+                tos = (tos + 1) & 0xFF
+                for _ in range(2):
+                    data[second], data[sp], tos = data[sp], tos, data[second]
+                rdata[(rsp + 1) & 0xFFFF] = rtos
+                ticks += 13
+
+        # ROT ROT
+        for _ in range(2):
+            second = (sp - 1) & 0xFFFF
+            data[second], data[sp], tos = data[sp], tos, data[second]
+            rdata[(rsp + 1) & 0xFFFF] = rtos
+        # RFROM
+        sp = (sp + 1) & 0xFFFF
+        data[sp], tos, rtos = tos, rtos, rdata[rsp]
+        rsp = (rsp - 1) & 0xFFFF
+        # SUM
+        tos += data[sp]
+        overflow = tos > 0xFF
+        tos &= 0xFF
+        sp = (sp - 1) & 0xFFFF
+        ticks += 10
+
+        # JO:1 JMPR:3
+        ticks += 1
+        if overflow:
+            # SWAP INC SWAP
+            tos, data[sp] = data[sp], tos
+            tos = (tos + 1) & 0xFF
+            tos, data[sp] = data[sp], tos
+            ticks += 3
+
+        # SWAP RFROM SUM
+        tos, data[sp] = data[sp], tos
+        sp = (sp + 1) & 0xFFFF
+        data[sp], tos, rtos = tos, rtos, rdata[rsp]
+        rsp = (rsp - 1) & 0xFFFF
+        tos += data[sp]
+        self.of = tos > 0xFF
+        tos &= 0xFF
+        self.zf = tos == 0
+        self.nf = tos >= 0x80
+        sp = (sp - 1) & 0xFFFF
+        # ROT ROT SWAP
+        for _ in range(2):
+            second = (sp - 1) & 0xFFFF
+            data[second], data[sp], tos = data[sp], tos, data[second]
+            rdata[(rsp + 1) & 0xFFFF] = rtos
+        tos, data[sp] = data[sp], tos
+        ticks += 12
+
+        self.stack.sp = sp
+        self.stack.tos = tos
+        self.rstack.sp = rsp
+        self.rstack.tos = rtos
+        self.ticks += ticks
+        self.pc = self.imem.address = address + 30
+
+    def unknown_opcode(self):
+        self.decoder.instruction = self.imem.data[self.pc]
+        self.decoder.instruction_address = self.pc
+        self.decoder.raise_unknown_opcode(self.get_related_token()[1])
+
+    def build_dispatch_table(self):
+        """
+        :return: list of handlers, where index is integer opcode (UNKNOWN_OPCODE handler is followed by superinstructions)
+        """
         opcode_mapping = {
             "TOR": self.tor,
             "RFROM": self.rfrom,
@@ -682,23 +1682,38 @@ class ControlUnit:
             "JZ": self.jz,
             "JL": self.jl,
             "JO": self.jo,
+            "JFA": self.jfa,
+            "JFR": self.jfr,
             "CALL": self.call,
             "RET": self.ret,
             "HLT": self.hlt,
             "FALSE": self.false,
             "TRUE": self.true,
             "CMP": self.cmp,
+            "EQ": self.eq,
+            "LT": self.lt,
+            "GT": self.gt,
             "PRINT": self.print,
             "READ": self.read,
             "TMOD": self.tmod,
-            "TDIV": self.tdiv
+            "TDIV": self.tdiv,
+            "TSUM": self.tsum,
+            "TGET": self.tget,
+            "TSET": self.tset,
+            "TEQ": self.teq,
+            "TDUP": self.tdup
         }
 
-        if opcode not in opcode_mapping:
+        return ([opcode_mapping[name] for name in OPCODES]
+                + [self.unknown_opcode]
+                + [getattr(self, 'superinstruction_' + name.lower()) for name in SUPERINSTRUCTIONS])
+
+    def execute(self, opcode):
+        if not 0 <= opcode < len(self.dispatch_table):
             raise ValueError(f"Invalid opcode: {opcode}")
 
         # Call the corresponding method based on the opcode
-        opcode_mapping[opcode]()
+        self.dispatch_table[opcode]()
 
 
 class Simulation:
@@ -707,15 +1722,30 @@ class Simulation:
         self.cu.input_buffer = []
         self.cu.output_buffer = []
 
-        self.cu.pc = 0x00C0
+        self.cu.pc = PROGRAM_START_ADDRESS
         self.cu.imem.address = 0x0000
 
+    def reset(self, program=None, input=None, program_hash=None):
+        """
+        Prepares simulation to run again, see ControlUnit.reset
+        """
+        self.cu.reset(program, input, program_hash)
+
+    def load_snapshot(self, snapshot, program=None):
+        """
+        Loads program (if given) and restores state from snapshot, then simulate() continues from it
+        """
+        if program is not None:
+            self.reset(program)
+        self.cu.load_snapshot(snapshot)
+
     def instruction_fetch(self):
         self.cu.imem.latch_address(self.cu.pc)
         self.cu.decoder.instruction = self.cu.imem.load()
+        self.cu.decoder.instruction_address = self.cu.pc
 
     def decode(self):
-        self.cu.decoder.decode()
+        self.cu.decoder.decode_predecoded(self.cu.imem)
 
     def execute(self):
         self.cu.execute(self.cu.decoder.opcode)
@@ -723,12 +1753,161 @@ class Simulation:
     def increment_program_counter(self):
         self.cu.pc += 1
 
-    def simulate(self):
+    def step(self):
+        self.instruction_fetch()
+        self.decode()
+        self.execute()
+        self.increment_program_counter()
+
+    def run(self, max_ticks=None, max_instructions=None):
+        """
+        Executes program until it stops or at most max_ticks ticks / max_instructions instructions are done
+        (budget is checked between instructions, superinstruction counts as one instruction and may finish after
+        max_ticks). If waiting for input, READ is not executed, so run() can be called again after input is added.
+        :return: RunResult
+        """
+        cu = self.cu
+        start_ticks = cu.ticks
+        tick_limit = start_ticks + max_ticks if max_ticks is not None else sys.maxsize
+        instruction_limit = max_instructions if max_instructions is not None else sys.maxsize
+
+        instructions, error = self.execute_slice(tick_limit, instruction_limit)
+        if cu.output_port is not None:
+            cu.output_port.flush()
+
+        if error is None:
+            status = BUDGET_EXHAUSTED
+        elif isinstance(error, Halt):
+            status = HALTED
+        elif isinstance(error, BufferError):
+            status = WAITING_FOR_INPUT
+        else:
+            status = FAULTED
+
+        return RunResult(status, cu.ticks - start_ticks, instructions, error)
+
+    async def run_async(self, max_ticks=None, max_instructions=None, slice_instructions=10000):
+        """
+        Same as run(), but executes program by slices of slice_instructions instructions and yields to event loop
+        between them
+        """
+        ticks = 0
+        instructions = 0
         while True:
-            self.instruction_fetch()
-            self.decode()
-            self.execute()
-            self.increment_program_counter()
+            slice_limit = slice_instructions
+            if max_instructions is not None:
+                slice_limit = min(slice_limit, max_instructions - instructions)
+            result = self.run(max_ticks - ticks if max_ticks is not None else None, slice_limit)
+
+            ticks += result.ticks
+            instructions += result.instructions
+            budget_exhausted = ((max_ticks is not None and ticks >= max_ticks)
+                                or (max_instructions is not None and instructions >= max_instructions))
+            if result.status != BUDGET_EXHAUSTED or budget_exhausted:
+                return RunResult(result.status, ticks, instructions, result.error)
+
+            await asyncio.sleep(0)
+
+    def execute_slice(self, tick_limit, instruction_limit):
+        """
+        Same as calling step() in loop, but with all lookups hoisted out of it
+        :return: number of executed instructions and exception that stopped execution (None if limit is reached)
+        """
+        cu = self.cu
+        cu.update_tracing()
+        if cu.profiler is not None:
+            return self.execute_profiled_slice(tick_limit, instruction_limit)
+
+        imem = cu.imem
+        decoder = cu.decoder
+        instructions = imem.data
+        offsets = imem.offsets
+        dispatch_table = cu.dispatch_table
+        executed = 0
+
+        try:
+            if cu.tracing:
+                opcodes = imem.opcodes
+                while executed < instruction_limit and cu.ticks < tick_limit:
+                    pc = cu.pc
+                    imem.address = pc
+                    decoder.instruction = instructions[pc]
+                    decoder.instruction_address = pc
+                    decoder.opcode = opcode = opcodes[pc]
+                    decoder.offset = offsets[pc]
+                    dispatch_table[opcode]()
+                    cu.pc += 1
+                    executed += 1
+                return executed, None
+
+            # fast path: nothing is printed, so decoder.instruction is not needed and superinstructions can be used
+            opcodes = imem.fused_opcodes if cu.use_superinstructions else imem.opcodes
+            while executed < instruction_limit and cu.ticks < tick_limit:
+                pc = cu.pc
+                imem.address = pc
+                decoder.opcode = opcode = opcodes[pc]
+                decoder.offset = offsets[pc]
+                dispatch_table[opcode]()
+                cu.pc += 1
+                executed += 1
+            return executed, None
+        except Exception as e:
+            return executed, e
+
+    def execute_profiled_slice(self, tick_limit, instruction_limit):
+        """
+        Same as execute_slice(), but without superinstructions and with executions and ticks of every instruction
+        address added to cu.profiler, which is also notified about every CALL and RET
+        """
+        cu = self.cu
+        profiler = cu.profiler
+        counts = profiler.counts
+        address_ticks = profiler.ticks
+        call_opcode = OPCODE_BY_NAME["CALL"]
+        ret_opcode = OPCODE_BY_NAME["RET"]
+
+        imem = cu.imem
+        decoder = cu.decoder
+        instructions = imem.data
+        opcodes = imem.opcodes
+        offsets = imem.offsets
+        dispatch_table = cu.dispatch_table
+        executed = 0
+        pc = cu.pc
+        start_ticks = cu.ticks
+        profiler.flush(cu.ticks)
+
+        try:
+            while executed < instruction_limit and cu.ticks < tick_limit:
+                pc = cu.pc
+                start_ticks = cu.ticks
+                counts[pc] += 1
+                imem.address = pc
+                decoder.instruction = instructions[pc]
+                decoder.instruction_address = pc
+                decoder.opcode = opcode = opcodes[pc]
+                decoder.offset = offsets[pc]
+                dispatch_table[opcode]()
+                address_ticks[pc] += cu.ticks - start_ticks
+                if opcode == call_opcode:
+                    profiler.call((cu.pc + 1) & 0xFFFF, cu.ticks)
+                elif opcode == ret_opcode:
+                    profiler.ret(cu.ticks)
+                cu.pc += 1
+                executed += 1
+            error = None
+        except Exception as e:
+            address_ticks[pc] += cu.ticks - start_ticks
+            error = e
+
+        profiler.flush(cu.ticks)
+        return executed, error
+
+    def simulate(self):
+        """
+        Runs program until it stops and raises exception that stopped it (Halt on HLT), see run()
+        """
+        raise self.run().error
 
 
 def configure_logger(logging_level, logger_name=None, log_folder=None):
@@ -767,21 +1946,41 @@ def configure_logger(logging_level, logger_name=None, log_folder=None):
     return configured_logger
 
 
-def main(program_filepath, input_filepath, output_file_path, logging_level=None, logger=None):
+def main(program_filepath, input_filepath, output_file_path, logging_level=None, logger=None, simulation_class=None,
+         trace_file_path=None, output_flush_policy=FLUSH_ON_NEWLINE, stream_input=False, keep_output_buffer=True):
+    """
+    :param keep_output_buffer: if False, output goes only to output file (memory does not grow with output)
+    and is not logged character by character
+    """
     if logging_level is None:
         logging_level = logging.INFO
 
+    if simulation_class is None:
+        simulation_class = Simulation
+
     if logger is None:
         logger = configure_logger(logging_level=logging_level)
 
-    with open(input_filepath, encoding="utf-8") as input_file:
-        with open(program_filepath, encoding="utf-8") as program_file:
-            program = json.loads(program_file.read())
-
-            simulation = Simulation(logger)
-            simulation.cu.imem.init_data(program["instructions"])
-            simulation.cu.ram.data = program["data"]
+    # program_format imports opcodes from this module
+    from .program_format import load_program
 
+    with open(input_filepath, encoding="utf-8") as input_file:
+        # JSON .lab or binary program
+        program = load_program(program_filepath)
+
+        simulation = simulation_class(logger)
+        simulation.cu.imem.init_data(program["instructions"], get_extended_tables(program))
+        simulation.cu.ram.init_data(program["data"])
+        simulation.cu.debug_info = program.get("debug_info")
+        if trace_file_path is not None:
+            # state of every tick goes to binary trace instead of log, see trace_renderer.py to render it
+            simulation.cu.trace_recorder = TraceRecorder(open(trace_file_path, "wb"))
+
+        if stream_input:
+            # input is not read here, READ pulls it from file by chunks and gets 0 at the end of file (text only)
+            input_file_string = f'<streamed from {input_filepath}>'
+            simulation.cu.input_port = InputPort(input_file.buffer)
+        else:
             input_file_string = input_file.read()
             for character in input_file_string:
                 simulation.cu.input_buffer.append(ord(character))
@@ -791,52 +1990,73 @@ def main(program_filepath, input_filepath, output_file_path, logging_level=None,
             simulation.cu.input_buffer.reverse()
             simulation.cu.input_buffer.append(len(simulation.cu.input_buffer))
 
-            try:
-                logger.log(logging.INFO, f'Original input: "{input_file_string}"')
-                logger.info("Reversed input buffer:")
-                for index, character in enumerate(simulation.cu.input_buffer):
-                    logger.log(logging.INFO, f"    {index}: {character}")
-                logger.log(logging.INFO, ']')
-
-                logger.info("\nNot void imem:")
-                for i, instr in enumerate(simulation.cu.imem.data):
-                    if instr["value"] != 0:
-                        try:
-                            int(instr["value"])
-                            logger.info(f'0x{i:04X} | 0x{instr["value"]:04X}')
-                        except ValueError:
-                            logger.info(f'0x{i:04X} | {instr["value"]}')
-
-                start_time = time.time()
-                logger.log(logging.INFO, f"\n=== Simulation start ===")
-                simulation.simulate()
-            except Exception as e:
-                logger.log(logging.INFO, e)
-                logger.log(logging.INFO,
-                            f"=== Simulation end. Ticks: {simulation.cu.ticks}. ===")
-
-                logger.log(logging.INFO, "\nStack printed:")
-                simulation.cu.stack.print_stack()
-
-                logger.log(logging.INFO, "\nOutput buffer: [")
-                for index, character in enumerate(simulation.cu.output_buffer):
-                    logger.log(logging.INFO, f"    {index}: {character}")
-                logger.log(logging.INFO, ']')
-                logger.log(logging.INFO, f'Output buffer jointed: "{''.join(simulation.cu.output_buffer)}"')
-
-                with open(output_file_path, "w", encoding="utf-8") as output_file:
-                    output_file.write(''.join(simulation.cu.output_buffer))
+        # output is written to file while program runs, so it is not lost if simulation is killed
+        output_file = open(output_file_path, "wb")
+        simulation.cu.output_port = OutputPort(output_file, output_flush_policy)
+        simulation.cu.keep_output_buffer = keep_output_buffer
+
+        try:
+            logger.log(logging.INFO, f'Original input: "{input_file_string}"')
+            logger.info("Reversed input buffer:")
+            for index, character in enumerate(simulation.cu.input_buffer):
+                logger.log(logging.INFO, f"    {index}: {character}")
+            logger.log(logging.INFO, ']')
+
+            logger.info("\nNot void imem:")
+            for i, instr in enumerate(simulation.cu.imem.data):
+                if instr["value"] != 0:
+                    try:
+                        int(instr["value"])
+                        logger.info(f'0x{i:04X} | 0x{instr["value"]:04X}')
+                    except ValueError:
+                        logger.info(f'0x{i:04X} | {instr["value"]}')
+
+            start_time = time.time()
+            logger.log(logging.INFO, f"\n=== Simulation start ===")
+            stop_reason = simulation.run().error
+        except Exception as e:
+            stop_reason = e
+
+        logger.log(logging.INFO, stop_reason)
+        logger.log(logging.INFO,
+                    f"=== Simulation end. Ticks: {simulation.cu.ticks}. ===")
+
+        logger.log(logging.INFO, "\nStack printed:")
+        simulation.cu.stack.print_stack()
+
+        if keep_output_buffer:
+            logger.log(logging.INFO, "\nOutput buffer: [")
+            for index, character in enumerate(simulation.cu.output_buffer):
+                logger.log(logging.INFO, f"    {index}: {character}")
+            logger.log(logging.INFO, ']')
+            logger.log(logging.INFO, f'Output buffer jointed: "{''.join(simulation.cu.output_buffer)}"')
+        else:
+            logger.log(logging.INFO, f"\nOutput is not kept, it is written to {output_file_path}")
+
+        simulation.cu.output_port.flush()
+        output_file.close()
+
+        if simulation.cu.trace_recorder is not None:
+            simulation.cu.trace_recorder.close()
+            simulation.cu.trace_recorder.file.close()
 
     logger.handlers[0].flush()
     logging.shutdown()
 
 
 if __name__ == '__main__':
-    source_code_path_arg = sys.argv[1]
-    input_filepath_arg = sys.argv[2]
-    output_filepath = sys.argv[3]
-    logging_level_arg = sys.argv[4]
+    # python -m src.model <program_file> <input_file> <output_file> <info|debug> [trace_file]
+    # [--stream-input] [--no-output-buffer]
+    flags = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    source_code_path_arg = args[0]
+    input_filepath_arg = args[1]
+    output_filepath = args[2]
+    logging_level_arg = args[3]
+    trace_filepath_arg = args[4] if len(args) > 4 else None
 
     model_debug_level = logging.DEBUG if logging_level_arg != "info" else logging.INFO
 
-    main(source_code_path_arg, input_filepath_arg, output_filepath, logging_level=model_debug_level)
+    main(source_code_path_arg, input_filepath_arg, output_filepath, logging_level=model_debug_level,
+         trace_file_path=trace_filepath_arg, stream_input='--stream-input' in flags,
+         keep_output_buffer='--no-output-buffer' not in flags)
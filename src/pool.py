@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .model import Simulation
+from .model import get_lab_program_hash
+
+
+class SimulationPool:
+    """
+    Keeps idle simulations with already loaded and pre-decoded programs, keyed by program hash,
+    so running a program again costs a reset (zeroing stacks and RAM) instead of building a new Simulation.\n
+    At most max_idle simulations are kept, the least recently released program is dropped first.\n
+    Hashes of last max_hashed program objects are remembered, so acquiring same program object again
+    does not serialize and hash it.
+    """
+
+    def __init__(self, logger, simulation_class=None, max_idle=8, max_hashed=64):
+        if simulation_class is None:
+            simulation_class = Simulation
+
+        self.logger = logger
+        self.simulation_class = simulation_class
+        self.max_idle = max_idle
+        self.idle = OrderedDict()  # program hash -> idle simulations, least recently released program first
+        self.idle_count = 0
+        self.max_hashed = max_hashed
+        # id of program -> (program, its hash), program is kept so its id is not reused by another object
+        self.program_hashes = OrderedDict()
+
+    def get_program_hash(self, program):
+        """
+        :return: get_lab_program_hash(program), computed once per program object
+        """
+        entry = self.program_hashes.get(id(program))
+        if entry is not None and entry[0] is program:
+            self.program_hashes.move_to_end(id(program))
+            return entry[1]
+
+        program_hash = get_lab_program_hash(program)
+        self.program_hashes[id(program)] = (program, program_hash)
+        if len(self.program_hashes) > self.max_hashed:
+            self.program_hashes.popitem(last=False)
+        return program_hash
+
+    def acquire(self, program, input=None):
+        """
+        :param program: program as in .lab file
+        :param input: input string, see ControlUnit.reset
+        :return: simulation with program loaded, reset and ready to simulate()
+        """
+        program_hash = self.get_program_hash(program)
+        simulations = self.idle.get(program_hash)
+        if simulations:
+            simulation = simulations.pop()
+            self.idle_count -= 1
+            if not simulations:
+                del self.idle[program_hash]
+        else:
+            simulation = self.simulation_class(self.logger)
+
+        simulation.reset(program, input, program_hash)
+        return simulation
+
+    def release(self, simulation):
+        """
+        Returns simulation to pool, it must not be used after that
+        """
+        program_hash = simulation.cu.program_hash
+        if program_hash is None or self.max_idle == 0:
+            return
+
+        self.idle.setdefault(program_hash, []).append(simulation)
+        self.idle.move_to_end(program_hash)
+        self.idle_count += 1
+
+        while self.idle_count > self.max_idle:
+            oldest_hash, oldest_simulations = next(iter(self.idle.items()))
+            oldest_simulations.pop(0)
+            self.idle_count -= 1
+            if not oldest_simulations:
+                del self.idle[oldest_hash]
+
+    @contextmanager
+    def lease(self, program, input=None):
+        """
+        with pool.lease(program, input) as simulation: ... -- acquire() and release() after block
+        """
+        simulation = self.acquire(program, input)
+        try:
+            yield simulation
+        finally:
+            self.release(simulation)
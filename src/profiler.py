@@ -0,0 +1,301 @@
+import json
+import logging
+import sys
+from array import array
+
+from .model import EXTENDED_ADDRESS_TABLES
+from .model import OPCODE_BY_NAME
+from .model import Simulation
+from .model import configure_logger
+from .model import get_extended_tables
+from .model import opcode_and_offset_to_address
+from .program_format import get_annotated_instructions
+from .program_format import load_program
+from .translatorv2 import Translator
+
+# name of frame at bottom of every call stack: code outside of functions
+ROOT_FRAME_NAME = "(program)"
+
+
+class Profiler:
+    """
+    Executions and ticks of every instruction address, filled by Simulation.execute_profiled_slice()
+    when set as ControlUnit.profiler
+    """
+
+    def __init__(self):
+        self.counts = array('Q', [0]) * 0x10000
+        self.ticks = array('Q', [0]) * 0x10000
+
+    def reset(self):
+        self.counts = array('Q', [0]) * 0x10000
+        self.ticks = array('Q', [0]) * 0x10000
+
+    def call(self, function_address, ticks):
+        """
+        Called after CALL instruction to function starting at function_address
+        """
+
+    def ret(self, ticks):
+        """
+        Called after RET instruction
+        """
+
+    def flush(self, ticks):
+        """
+        Called on start and end of every profiled slice
+        """
+
+    def get_report(self, instructions, token_lines=None, source_lines=None):
+        """
+        :param instructions: instructions of program (as in .lab file)
+        :param token_lines: source line (from 1) of every token, see Translator.get_token_lines()
+        :param source_lines: source code lines, to show them in report
+        :return: totals and statistics per opcode, per token and per source line (if token_lines are given),
+        every list is sorted by ticks
+        """
+        opcodes = {}
+        tokens = {}
+        lines = {}
+        total_count = 0
+        total_ticks = 0
+
+        for address, count in enumerate(self.counts):
+            if count == 0:
+                continue
+            ticks = self.ticks[address]
+            total_count += count
+            total_ticks += ticks
+
+            if address < len(instructions):
+                instruction = instructions[address]
+            else:
+                instruction = {"value": 0, "related_token_index": -1, "related_token": "model imem init"}
+            name = str(instruction["value"])
+            token_index = instruction["related_token_index"]
+
+            opcode_entry = opcodes.setdefault(name, {"opcode": name, "count": 0, "ticks": 0})
+            opcode_entry["count"] += count
+            opcode_entry["ticks"] += ticks
+
+            line = None
+            if token_lines is not None and 0 <= token_index < len(token_lines):
+                line = token_lines[token_index]
+
+            token_entry = tokens.setdefault(token_index, {"token_index": token_index,
+                                                          "token": instruction["related_token"],
+                                                          "line": line, "count": 0, "ticks": 0})
+            token_entry["count"] += count
+            token_entry["ticks"] += ticks
+
+            if token_lines is not None:
+                source = None
+                if line is not None and source_lines is not None and line <= len(source_lines):
+                    source = source_lines[line - 1].strip()
+                line_entry = lines.setdefault(line, {"line": line, "source": source, "count": 0, "ticks": 0})
+                line_entry["count"] += count
+                line_entry["ticks"] += ticks
+
+        def by_ticks(entries):
+            return sorted(entries, key=lambda entry: (-entry["ticks"], -entry["count"]))
+
+        return {
+            "ticks": total_ticks,
+            "instructions": total_count,
+            "opcodes": by_ticks(opcodes.values()),
+            "tokens": by_ticks(tokens.values()),
+            "lines": by_ticks(lines.values()),
+        }
+
+
+def get_function_names(instructions, extended_tables=EXTENDED_ADDRESS_TABLES):
+    """
+    :param extended_tables: start addresses of extended LOAD, CALL and JMPA tables (see model.get_extended_tables)
+    :return: start address -> name of every function that is called by CALL instruction
+    (name is token of CALL, start address is computed from CALL table)
+    """
+    function_names = {}
+    for instruction in instructions:
+        if instruction["value"] != "CALL":
+            continue
+        cell = opcode_and_offset_to_address(OPCODE_BY_NAME["CALL"], instruction["offset"], extended_tables)
+        # CALL table keeps address before function start, PC is incremented after CALL
+        start_address = ((instructions[cell]["value"] << 8) + instructions[cell + 1]["value"] + 1) & 0xFFFF
+        function_names[start_address] = instruction["related_token"]
+
+    return function_names
+
+
+class CallGraphProfiler(Profiler):
+    """
+    Profiler, that also keeps shadow call stack (changed on every CALL and RET)
+    and attributes ticks to stacks of called functions (Forth words)
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.stack = []  # (function address, ticks on call) of every active call
+        self.path = ()  # function addresses of active calls
+        self.active = {}  # function address -> number of its active calls (for recursion)
+        self.last_ticks = None
+        self.collapsed = {}  # path -> exclusive ticks
+        self.calls = {}  # function address -> calls
+        self.inclusive = {}  # function address -> inclusive ticks of finished calls
+
+    def flush(self, ticks):
+        if self.last_ticks is not None:
+            self.collapsed[self.path] = self.collapsed.get(self.path, 0) + ticks - self.last_ticks
+        self.last_ticks = ticks
+
+    def call(self, function_address, ticks):
+        # ticks of CALL itself belong to caller
+        self.flush(ticks)
+        self.stack.append((function_address, ticks))
+        self.path += (function_address,)
+        self.active[function_address] = self.active.get(function_address, 0) + 1
+        self.calls[function_address] = self.calls.get(function_address, 0) + 1
+
+    def ret(self, ticks):
+        # ticks of RET belong to callee
+        self.flush(ticks)
+        if not self.stack:
+            return
+
+        function_address, call_ticks = self.stack.pop()
+        self.path = self.path[:-1]
+        self.active[function_address] -= 1
+        if self.active[function_address] == 0:
+            # only outermost call of recursive function is counted, so its ticks are not counted twice
+            self.inclusive[function_address] = self.inclusive.get(function_address, 0) + ticks - call_ticks
+
+    def get_report(self, instructions, token_lines=None, source_lines=None, extended_tables=EXTENDED_ADDRESS_TABLES):
+        """
+        Same as Profiler.get_report(), with "words" (calls, inclusive and exclusive ticks of every function,
+        sorted by inclusive ticks) and "collapsed" (collapsed stacks: "(program);WORD;OTHER_WORD ticks" lines)
+        """
+        report = super().get_report(instructions, token_lines, source_lines)
+        function_names = get_function_names(instructions, extended_tables)
+
+        def name(function_address):
+            return function_names.get(function_address, f'0x{function_address:04X}')
+
+        inclusive = dict(self.inclusive)
+        counted = set()
+        for function_address, call_ticks in self.stack:
+            # calls that are not finished (e.g. HLT or budget inside function) are counted to the last tick
+            if function_address not in counted:
+                inclusive[function_address] = inclusive.get(function_address, 0) + self.last_ticks - call_ticks
+                counted.add(function_address)
+
+        exclusive = {}
+        for path, ticks in self.collapsed.items():
+            if path:
+                exclusive[path[-1]] = exclusive.get(path[-1], 0) + ticks
+
+        words = [{"word": name(function_address), "address": function_address, "calls": calls,
+                  "inclusive_ticks": inclusive.get(function_address, 0),
+                  "exclusive_ticks": exclusive.get(function_address, 0)}
+                 for function_address, calls in self.calls.items()]
+        report["words"] = sorted(words, key=lambda word: (-word["inclusive_ticks"], word["word"]))
+        report["collapsed"] = [';'.join([ROOT_FRAME_NAME] + [name(function_address) for function_address in path])
+                               + f' {ticks}'
+                               for path, ticks in sorted(self.collapsed.items()) if ticks > 0]
+        return report
+
+
+def format_report(report, top=20):
+    """
+    :return: report as text tables, tokens and lines tables are cut to top entries
+    """
+    total_ticks = max(report["ticks"], 1)
+
+    def row(name, entry):
+        return f'{name:<40} {entry["count"]:>10} {entry["ticks"]:>10} {100 * entry["ticks"] / total_ticks:>7.2f}%'
+
+    header = f'{"":<40} {"count":>10} {"ticks":>10} {"ticks %":>8}'
+    text = [f'Total: {report["ticks"]} ticks, {report["instructions"]} instructions', '', 'OPCODES:', header]
+    text += [row(entry["opcode"], entry) for entry in report["opcodes"]]
+
+    text += ['', f'TOKENS (top {top}):', header]
+    for entry in report["tokens"][:top]:
+        token = ' '.join(str(entry["token"]).split())
+        location = f'line {entry["line"]}' if entry["line"] is not None else 'no line'
+        text.append(row(f'#{entry["token_index"]} {token[:20]} ({location})', entry))
+
+    if report["lines"]:
+        text += ['', f'LINES (top {top}):', header]
+        for entry in report["lines"][:top]:
+            if entry["line"] is None:
+                name = 'no line (initialization)'
+            else:
+                name = f'{entry["line"]:>4}: {entry["source"] or ""}'
+            text.append(row(name[:40], entry))
+
+    if report.get("words"):
+        total_ticks = max(report["ticks"], 1)
+        text += ['', 'WORDS:', f'{"":<40} {"calls":>10} {"inclusive":>10} {"exclusive":>10} {"incl. %":>8}']
+        for word in report["words"]:
+            text.append(f'{word["word"]:<40} {word["calls"]:>10} {word["inclusive_ticks"]:>10} '
+                        f'{word["exclusive_ticks"]:>10} {100 * word["inclusive_ticks"] / total_ticks:>7.2f}%')
+
+    return '\n'.join(text)
+
+
+def profile(program, input_string, logger, source_code=None):
+    """
+    Runs program with profiler
+    :param program: program as in .lab file
+    :param source_code: source code program was translated from, to map ticks to its lines (if not given,
+    lines are taken from debug info of binary program)
+    :return: report (see Profiler.get_report) and RunResult
+    """
+    simulation = Simulation(logger)
+    simulation.cu.need_print_state = False
+    simulation.cu.profiler = CallGraphProfiler()
+    simulation.reset(program, input_string)
+    result = simulation.run()
+
+    token_lines = None
+    source_lines = None
+    if source_code is not None:
+        token_lines = Translator(source_code, logger).get_token_lines()
+        source_lines = source_code.split('\n')
+    elif program.get("debug_info") is not None:
+        token_lines = program["debug_info"].get_token_lines()
+
+    return simulation.cu.profiler.get_report(get_annotated_instructions(program), token_lines, source_lines,
+                                             get_extended_tables(program)), result
+
+
+if __name__ == '__main__':
+    # python -m src.profiler <program_file> <input_file> [<source_file>] [<json_report_file>] [<collapsed_file>]
+    program_filepath_arg = sys.argv[1]
+    input_filepath_arg = sys.argv[2]
+    source_filepath_arg = sys.argv[3] if len(sys.argv) > 3 else None
+    report_filepath_arg = sys.argv[4] if len(sys.argv) > 4 else None
+    collapsed_filepath_arg = sys.argv[5] if len(sys.argv) > 5 else None
+
+    program_arg = load_program(program_filepath_arg)
+    with open(input_filepath_arg, encoding="utf-8") as input_file:
+        input_string_arg = input_file.read()
+    source_code_arg = None
+    if source_filepath_arg is not None:
+        with open(source_filepath_arg, encoding="utf-8") as source_file:
+            source_code_arg = source_file.read()
+
+    profiler_logger = configure_logger(logging_level=logging.INFO, logger_name="profiler_logger")
+    profile_report, run_result = profile(program_arg, input_string_arg, profiler_logger, source_code_arg)
+
+    print(f'{run_result.status}: {run_result.error}')
+    print(format_report(profile_report))
+    if report_filepath_arg is not None:
+        with open(report_filepath_arg, "w", encoding="utf-8") as report_file:
+            report_file.write(json.dumps(profile_report, indent=4))
+    if collapsed_filepath_arg is not None:
+        # input of flamegraph.pl, speedscope, etc.
+        with open(collapsed_filepath_arg, "w", encoding="utf-8") as collapsed_file:
+            collapsed_file.write('\n'.join(profile_report["collapsed"]) + '\n')
@@ -0,0 +1,560 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+
+from .model import NO_VALUE
+from .model import OPCODE_BY_NAME
+from .model import OPCODES
+from .model import UNKNOWN_OPCODE
+from .model import get_lab_program_hash
+
+# Binary program (.labbin):\n
+# header -- PROGRAM_HEADER_FORMAT\n
+# instructions -- segments (runs of imem cells from 0x0000, that are not VOID_INSTRUCTION):
+# PROGRAM_RANGE_FORMAT (start address, length) of every segment, then columns of all segments cells one after another:
+# kinds (PROGRAM_KIND_TYPE, padded to 4 bytes), offsets and values (PROGRAM_COLUMN_TYPE)\n
+# data -- non-zero ranges of RAM: PROGRAM_RANGE_FORMAT (start address, length) followed by its bytes\n
+# strings -- string values of instructions (not opcodes): PROGRAM_STRING_FORMAT length followed by utf-8 bytes\n
+# debug info -- DEBUG_INFO_HEADER_FORMAT, then arrays of DebugInfo and interned related tokens as strings
+PROGRAM_MAGIC = b'LABPROG\0'
+PROGRAM_VERSION = 6
+# magic, version, sha256 of instructions (get_lab_program_hash), start addresses of extended LOAD, CALL and JMPA
+# tables (zeroes if program has no program["extended_tables"]), instructions count, segments count,
+# data ranges count, strings count, segments section size, data section size, strings section size,
+# debug info section size (0 if program has no debug info)
+PROGRAM_HEADER_FORMAT = '<8sH32sHHHIIIIIIII'
+PROGRAM_RANGE_FORMAT = '<II'
+# kind of cell: opcode or INTEGER_VALUE_KIND / STRING_VALUE_KIND, with HAS_OFFSET_FLAG
+PROGRAM_KIND_TYPE = 'B'
+# offset of cell (0 if it has none) and value (int, index in strings or NO_VALUE for opcodes), little-endian
+PROGRAM_COLUMN_TYPE = 'i'
+PROGRAM_STRING_FORMAT = '<I'
+# strings count, tokens count (length of token_lines and token_columns)
+DEBUG_INFO_HEADER_FORMAT = '<II'
+BINARY_PROGRAM_EXTENSION = '.labbin'
+RAM_SIZE = 0x10000
+
+# kinds of instruction record that are not opcodes: value is int or index in strings
+INTEGER_VALUE_KIND = 0x7F
+STRING_VALUE_KIND = 0x7E
+HAS_OFFSET_FLAG = 0x80
+# kind -> opcode, as InstructionsMemory pre-decodes it (table for bytes.translate)
+KIND_OPCODES = bytes((kind & ~HAS_OFFSET_FLAG) if (kind & ~HAS_OFFSET_FLAG) < len(OPCODES) else UNKNOWN_OPCODE
+                     for kind in range(0x100))
+# cell, that is not stored in segments
+VOID_INSTRUCTION = {"value": 0, "offset": None}
+# zeroes between non-zero bytes are stored in range, if they are shorter than header of new range
+MAX_RANGE_GAP = struct.calcsize(PROGRAM_RANGE_FORMAT)
+# related token of addresses out of program, same as in InstructionsMemory.reset()
+VOID_RELATED_TOKEN = "model imem init"
+VOID_MEMORY_INSTRUCTION = {"value": 0x00, "related_token": VOID_RELATED_TOKEN, "related_token_index": -1}
+
+
+class DebugInfo:
+    """
+    Source mapping of program, kept apart from its instructions:\n
+    strings -- interned related tokens, every token string is kept once\n
+    token_indexes[address], string_ids[address] -- index and string (index in strings, -1 for None) of token
+    instruction was generated from\n
+    token_lines[token index], token_columns[token index] -- position of token in source code (from 1, 0 if unknown)\n
+    If loader is given, it fills fields on first lookup, so runs that never trace, profile or fail don't read them
+    """
+
+    def __init__(self, loader=None):
+        self.strings = []
+        self.token_indexes = array('i')
+        self.string_ids = array('i')
+        self.token_lines = array('i')
+        self.token_columns = array('i')
+        self.loader = loader
+
+    def load(self):
+        if self.loader is not None:
+            loader, self.loader = self.loader, None
+            loader(self)
+
+    def get_related_token(self, address):
+        """
+        :return: (token index, token) of instruction at address
+        """
+        self.load()
+        if address is None or not 0 <= address < len(self.token_indexes):
+            return -1, VOID_RELATED_TOKEN
+        string_id = self.string_ids[address]
+        return self.token_indexes[address], self.strings[string_id] if string_id >= 0 else None
+
+    def get_position(self, token_index):
+        """
+        :return: (line, column) of token in source code, None if unknown
+        """
+        self.load()
+        if not 0 <= token_index < len(self.token_lines) or self.token_lines[token_index] == 0:
+            return None
+        return self.token_lines[token_index], self.token_columns[token_index]
+
+    def get_token_lines(self):
+        """
+        :return: source line of every token (as Translator.get_token_lines()), None if positions are unknown
+        """
+        self.load()
+        if not any(self.token_lines):
+            return None
+        return [line if line != 0 else None for line in self.token_lines]
+
+    def annotate(self, instructions):
+        """
+        :return: copies of instructions with related_token_index and related_token (as in .lab file)
+        """
+        annotated = []
+        for address, instruction in enumerate(instructions):
+            related_token_index, related_token = self.get_related_token(address)
+            annotated.append(dict(instruction, related_token_index=related_token_index, related_token=related_token))
+        return annotated
+
+    @staticmethod
+    def from_instructions(instructions, token_positions=None):
+        """
+        :param instructions: instructions as in .lab file
+        :param token_positions: (line, column) of every token, see Translator.get_token_positions()
+        """
+        debug_info = DebugInfo()
+        string_ids = {}
+        for instruction in instructions:
+            related_token = instruction.get("related_token")
+            if related_token is None:
+                string_id = -1
+            else:
+                string_id = string_ids.setdefault(related_token, len(string_ids))
+            debug_info.token_indexes.append(instruction.get("related_token_index", -1))
+            debug_info.string_ids.append(string_id)
+        debug_info.strings = [sys.intern(string) for string in string_ids]
+
+        for line, column in token_positions or []:
+            debug_info.token_lines.append(line)
+            debug_info.token_columns.append(column)
+        return debug_info
+
+
+def get_column(view, typecode):
+    """
+    :return: little-endian column of values as memoryview of buffer (copied only on big-endian hosts)
+    """
+    if sys.byteorder == 'big':
+        values = array(typecode)
+        values.frombytes(view)
+        values.byteswap()
+        return memoryview(values)
+    return view.cast(typecode)
+
+
+class BinaryInstructions(Sequence):
+    """
+    Instructions of binary program, read from its segments in buffer (which is kept while instructions are used).\n
+    Instruction is built as dict (as in .lab file, without related tokens) only on lookup,
+    InstructionsMemory copies columns of segments to its pre-decoded arrays as is (see fill_instructions_memory).\n
+    size -- length of sequence, cells from instructions count to size are VOID_MEMORY_INSTRUCTION
+    """
+
+    def __init__(self, buffer, segments, kinds, offsets, values, strings, count, size=None):
+        self.buffer = buffer
+        self.segments = segments  # (start address, length, position in columns) of every segment
+        self.starts = [start for start, _, _ in segments]
+        self.kinds = kinds
+        self.offsets = offsets
+        self.values = values
+        self.strings = strings
+        self.count = count
+        self.size = count if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, address):
+        if isinstance(address, slice):
+            return [self[index] for index in range(*address.indices(self.size))]
+        if address < 0:
+            address += self.size
+        if not 0 <= address < self.size:
+            raise IndexError('PROGRAM: instruction address out of range')
+        if address >= self.count:
+            return VOID_MEMORY_INSTRUCTION
+
+        index = bisect_right(self.starts, address) - 1
+        if index < 0:
+            return dict(VOID_INSTRUCTION)
+        start, length, position = self.segments[index]
+        if address >= start + length:
+            return dict(VOID_INSTRUCTION)
+
+        position += address - start
+        kind = self.kinds[position]
+        offset = self.offsets[position] if kind & HAS_OFFSET_FLAG else None
+        kind &= ~HAS_OFFSET_FLAG
+        if kind == INTEGER_VALUE_KIND:
+            value = self.values[position]
+        elif kind == STRING_VALUE_KIND:
+            value = self.strings[self.values[position]]
+        else:
+            value = OPCODES[kind]
+        return {"value": value, "offset": offset}
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    __hash__ = None
+
+    def fill_instructions_memory(self, imem):
+        """
+        Copies segments to pre-decoded arrays of InstructionsMemory (zeroed by its reset()) without building
+        instructions, imem.data becomes these instructions for whole memory
+        """
+        opcodes = memoryview(imem.opcodes)
+        offsets = memoryview(imem.offsets)
+        values = memoryview(imem.values)
+        for start, length, position in self.segments:
+            end = start + length
+            opcodes[start:end] = self.kinds[position:position + length].tobytes().translate(KIND_OPCODES)
+            offsets[start:end] = self.offsets[position:position + length]
+            values[start:end] = self.values[position:position + length]
+
+        # string values are not integers, only their cells are fixed after copy
+        if self.strings:
+            for start, length, position in self.segments:
+                for index, kind in enumerate(self.kinds[position:position + length]):
+                    if kind & ~HAS_OFFSET_FLAG == STRING_VALUE_KIND:
+                        values[start + index] = NO_VALUE
+
+        imem.data = BinaryInstructions(self.buffer, self.segments, self.kinds, self.offsets, self.values,
+                                       self.strings, self.count, 0x10000)
+
+
+def get_segments(instructions):
+    """
+    :return: list of (start address, end address) of runs of instructions, that are not VOID_INSTRUCTION
+    """
+    segments = []
+    start = None
+    for address, instruction in enumerate(instructions):
+        value = instruction["value"]
+        is_void = value == 0 and not isinstance(value, (str, bool)) and instruction["offset"] is None
+        if not is_void and start is None:
+            start = address
+        elif is_void and start is not None:
+            segments.append((start, address))
+            start = None
+    if start is not None:
+        segments.append((start, len(instructions)))
+    return segments
+
+
+def get_data_ranges(data):
+    """
+    :return: list of (start address, end address) of non-zero parts of data
+    """
+    ranges = []
+    start = None
+    zeroes = 0
+    for address, value in enumerate(data):
+        if value != 0:
+            if start is None:
+                start = address
+            zeroes = 0
+        elif start is not None:
+            zeroes += 1
+            if zeroes > MAX_RANGE_GAP:
+                ranges.append((start, address - zeroes + 1))
+                start = None
+                zeroes = 0
+    if start is not None:
+        ranges.append((start, len(data) - zeroes))
+    return ranges
+
+
+def dump_strings(strings):
+    encoded_strings = []
+    for string in strings:
+        encoded = string.encode("utf-8")
+        encoded_strings.append(struct.pack(PROGRAM_STRING_FORMAT, len(encoded)))
+        encoded_strings.append(encoded)
+    return b''.join(encoded_strings)
+
+
+def parse_strings(view, position, count):
+    """
+    :return: strings and position after them
+    """
+    strings = []
+    for _ in range(count):
+        (length,) = struct.unpack_from(PROGRAM_STRING_FORMAT, view, position)
+        position += struct.calcsize(PROGRAM_STRING_FORMAT)
+        strings.append(sys.intern(str(view[position:position + length], "utf-8")))
+        position += length
+    return strings, position
+
+
+def little_endian(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def dump_debug_info(debug_info):
+    header = struct.pack(DEBUG_INFO_HEADER_FORMAT, len(debug_info.strings), len(debug_info.token_lines))
+    return b''.join([header, little_endian(debug_info.token_indexes), little_endian(debug_info.string_ids),
+                     little_endian(debug_info.token_lines), little_endian(debug_info.token_columns),
+                     dump_strings(debug_info.strings)])
+
+
+def parse_debug_info(debug_info, view, position, instructions_count):
+    """
+    Fills debug_info from debug info section starting at position
+    """
+    strings_count, tokens_count = struct.unpack_from(DEBUG_INFO_HEADER_FORMAT, view, position)
+    position += struct.calcsize(DEBUG_INFO_HEADER_FORMAT)
+
+    for name, count in [("token_indexes", instructions_count), ("string_ids", instructions_count),
+                        ("token_lines", tokens_count), ("token_columns", tokens_count)]:
+        values = array('i')
+        values.frombytes(view[position:position + count * values.itemsize])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        setattr(debug_info, name, values)
+        position += count * values.itemsize
+
+    debug_info.strings, _ = parse_strings(view, position, strings_count)
+
+
+def dump_segments(instructions, strings):
+    """
+    :param strings: dict of string values -- their indexes, filled by string values of instructions
+    :return: segments section and number of segments
+    """
+    segments = get_segments(instructions)
+    kinds = array(PROGRAM_KIND_TYPE)
+    offsets = array(PROGRAM_COLUMN_TYPE)
+    values = array(PROGRAM_COLUMN_TYPE)
+    for start, end in segments:
+        for instruction in instructions[start:end]:
+            value = instruction["value"]
+            if isinstance(value, str):
+                if value in OPCODE_BY_NAME:
+                    kind, value = OPCODE_BY_NAME[value], NO_VALUE
+                else:
+                    kind, value = STRING_VALUE_KIND, strings.setdefault(value, len(strings))
+            else:
+                kind = INTEGER_VALUE_KIND
+            offset = instruction["offset"]
+            kinds.append(kind | HAS_OFFSET_FLAG if offset is not None else kind)
+            offsets.append(offset or 0)
+            values.append(value)
+
+    kinds_padding = b'\0' * (-len(kinds) % offsets.itemsize)
+    ranges = b''.join(struct.pack(PROGRAM_RANGE_FORMAT, start, end - start) for start, end in segments)
+    return b''.join([ranges, kinds.tobytes(), kinds_padding, little_endian(offsets), little_endian(values)]), \
+        len(segments)
+
+
+def parse_segments(view, position, segments_count):
+    """
+    :return: segments (start address, length, position in columns), kinds, offsets and values columns
+    """
+    segments = []
+    cells = 0
+    for start, length in struct.iter_unpack(PROGRAM_RANGE_FORMAT, view[position:position + segments_count
+                                                                       * struct.calcsize(PROGRAM_RANGE_FORMAT)]):
+        segments.append((start, length, cells))
+        cells += length
+    position += segments_count * struct.calcsize(PROGRAM_RANGE_FORMAT)
+
+    column_size = cells * array(PROGRAM_COLUMN_TYPE).itemsize
+    kinds = view[position:position + cells]
+    position += cells + (-cells % array(PROGRAM_COLUMN_TYPE).itemsize)
+    offsets = get_column(view[position:position + column_size], PROGRAM_COLUMN_TYPE)
+    position += column_size
+    values = get_column(view[position:position + column_size], PROGRAM_COLUMN_TYPE)
+    return segments, kinds, offsets, values
+
+
+def dump_binary_program(program):
+    """
+    :param program: program as in .lab file. Its debug info is program["debug_info"] if it is given,
+    otherwise it is taken from related tokens of instructions
+    :return: bytes of binary program
+    """
+    instructions = program["instructions"]
+    strings = {}
+    segments_section, segments_count = dump_segments(instructions, strings)
+    # hash of instructions as they are loaded from binary program (without related tokens)
+    program_hash = program.get("hash")
+    if program_hash is None:
+        program_hash = get_lab_program_hash({"instructions": [{"value": instruction["value"],
+                                                               "offset": instruction["offset"]}
+                                                              for instruction in instructions],
+                                             "extended_tables": program.get("extended_tables")})
+    extended_tables = program.get("extended_tables") or [0, 0, 0]
+
+    data = bytes(program["data"])
+    ranges = []
+    for start, end in get_data_ranges(data):
+        ranges.append(struct.pack(PROGRAM_RANGE_FORMAT, start, end - start))
+        ranges.append(data[start:end])
+    data_section = b''.join(ranges)
+    strings_section = dump_strings(strings)
+
+    debug_info = program.get("debug_info")
+    if debug_info is None:
+        debug_info = DebugInfo.from_instructions(program["instructions"])
+    debug_info.load()
+    debug_info_section = dump_debug_info(debug_info)
+
+    header = struct.pack(PROGRAM_HEADER_FORMAT, PROGRAM_MAGIC, PROGRAM_VERSION, bytes.fromhex(program_hash),
+                         *extended_tables, len(instructions), segments_count, len(ranges) // 2, len(strings), len(segments_section),
+                         len(data_section), len(strings_section), len(debug_info_section))
+    return b''.join([header, segments_section, data_section, strings_section, debug_info_section])
+
+
+def save_binary_program(program, program_path):
+    """
+    File is replaced atomically (temporary file and os.replace), so programs already mapped from it
+    keep their contents
+    """
+    temp_path = program_path + f'.{os.getpid()}.tmp'
+    with open(temp_path, "wb") as program_file:
+        program_file.write(dump_binary_program(program))
+    os.replace(temp_path, program_path)
+
+
+def parse_binary_program_header(view):
+    """
+    :return: header fields and start positions of sections: segments, data, strings, debug info
+    """
+    header_size = struct.calcsize(PROGRAM_HEADER_FORMAT)
+    if len(view) < header_size or bytes(view[:len(PROGRAM_MAGIC)]) != PROGRAM_MAGIC:
+        raise ValueError('PROGRAM: not a binary program')
+    header = struct.unpack_from(PROGRAM_HEADER_FORMAT, view)
+    magic, version, _, _, _, _, _, _, _, _, segments_size, data_size, strings_size, _ = header
+    if version != PROGRAM_VERSION:
+        raise ValueError(f'PROGRAM: not a binary program of version {PROGRAM_VERSION}')
+
+    data_start = header_size + segments_size
+    return header, (header_size, data_start, data_start + data_size, data_start + data_size + strings_size)
+
+
+def parse_binary_program(buffer, debug_info=None):
+    """
+    :param buffer: bytes-like object (e.g. mmap) with binary program, it is not copied: instructions are read
+    from it while they are used
+    :param debug_info: DebugInfo to put in program, if None -- it is parsed from buffer (if program has it)
+    :return: program as in .lab file, but instructions are BinaryInstructions (without related tokens),
+    data is bytearray up to the last non-zero byte, related tokens are in program["debug_info"]
+    (None if program has no debug info), sha256 of instructions is program["hash"]
+    """
+    view = memoryview(buffer)
+    header, (segments_start, data_start, strings_start, debug_info_start) = parse_binary_program_header(view)
+    _, _, program_hash, *extended_tables, instructions_count, segments_count, ranges_count, strings_count, \
+        _, _, _, debug_info_size = header
+
+    strings, _ = parse_strings(view, strings_start, strings_count)
+    segments, kinds, offsets, values = parse_segments(view, segments_start, segments_count)
+    instructions = BinaryInstructions(buffer, segments, kinds, offsets, values, strings, instructions_count)
+
+    ranges = []
+    position = data_start
+    for _ in range(ranges_count):
+        start, length = struct.unpack_from(PROGRAM_RANGE_FORMAT, view, position)
+        position += struct.calcsize(PROGRAM_RANGE_FORMAT)
+        ranges.append((start, view[position:position + length]))
+        position += length
+    data = bytearray(max((start + len(values) for start, values in ranges), default=0))
+    for start, values in ranges:
+        data[start:start + len(values)] = values
+
+    if debug_info_size == 0:
+        debug_info = None
+    elif debug_info is None:
+        debug_info = DebugInfo()
+        parse_debug_info(debug_info, view, debug_info_start, instructions_count)
+
+    program = {"instructions": instructions, "data": data, "debug_info": debug_info, "hash": program_hash.hex()}
+    if any(extended_tables):
+        program["extended_tables"] = extended_tables
+    return program
+
+
+def load_binary_program(program_path):
+    """
+    Binary program is memory-mapped, only its segments table and data ranges are read, mapping is kept open
+    while its instructions are used (they are read from it).
+    Debug info is read from the same mapping on first lookup in it, so it belongs to the loaded program
+    even if file was removed or replaced since
+    """
+    with open(program_path, "rb") as program_file:
+        buffer = mmap.mmap(program_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def load_debug_info(debug_info):
+        view = memoryview(buffer)
+        header, sections = parse_binary_program_header(view)
+        parse_debug_info(debug_info, view, sections[3], header[6])
+
+    return parse_binary_program(buffer, DebugInfo(load_debug_info))
+
+
+def is_binary_program(program_path):
+    with open(program_path, "rb") as program_file:
+        return program_file.read(len(PROGRAM_MAGIC)) == PROGRAM_MAGIC
+
+
+def load_program(program_path, with_related_tokens=False):
+    """
+    :param with_related_tokens: if True, instructions of binary program get related tokens from debug info
+    (needed by tools that read instructions themselves: trace renderer, profiler)
+    :return: program as in .lab file, from JSON .lab or binary program (detected by magic)
+    """
+    if not is_binary_program(program_path):
+        with open(program_path, encoding="utf-8") as program_file:
+            return json.loads(program_file.read())
+
+    program = load_binary_program(program_path)
+    if with_related_tokens:
+        program["instructions"] = get_annotated_instructions(program)
+    return program
+
+
+def get_annotated_instructions(program):
+    """
+    :return: instructions of program with related tokens, taken from its debug info if it has one
+    """
+    if program.get("debug_info") is None:
+        return list(program["instructions"])
+    return program["debug_info"].annotate(program["instructions"])
+
+
+def save_program(program, program_path):
+    """
+    Saves binary program if program_path ends with BINARY_PROGRAM_EXTENSION, JSON .lab otherwise
+    """
+    if program_path.endswith(BINARY_PROGRAM_EXTENSION):
+        save_binary_program(program, program_path)
+    else:
+        # JSON .lab keeps whole RAM, as translator writes it
+        data = list(program["data"])
+        data += [0] * (RAM_SIZE - len(data))
+        json_program = {"instructions": get_annotated_instructions(program), "data": data}
+        if program.get("extended_tables") is not None:
+            json_program["extended_tables"] = list(program["extended_tables"])
+        with open(program_path, "w", encoding="utf-8") as program_file:
+            program_file.write(json.dumps(json_program, indent=4))
+
+
+if __name__ == '__main__':
+    # python -m src.program_format <program_file> <converted_program_file>
+    # converts JSON .lab to binary program (or back, format is chosen by extension of converted file)
+    save_program(load_program(sys.argv[1]), sys.argv[2])
@@ -0,0 +1,79 @@
+import mmap
+import struct
+import sys
+
+from .model import OPCODES
+from .model import TRACE_HEADER_FORMAT
+from .model import TRACE_MAGIC
+from .model import TRACE_RECORD_WORDS
+from .model import TRACE_VERSION
+from .model import format_stack_state
+from .model import format_state
+from .program_format import load_program
+
+
+def render_record(record, instructions):
+    """
+    :param record: TRACE_RECORD_WORDS words of one tick, written by TraceRecorder
+    :param instructions: instructions of program (as in .lab file), to get related tokens from
+    :return: same line, as ControlUnit.get_state_str() returns on that tick
+    """
+    ticks = record[0] | record[1] << 16 | record[2] << 32
+    pc, imem_address, instruction_address, sp, rsp = record[3:8]
+    tos, rtos = record[8] & 0xFF, record[8] >> 8
+    stack_cells = [record[9] >> 8, record[9] & 0xFF, record[10] >> 8, record[10] & 0xFF]
+    rstack_cells = [record[11] >> 8, record[11] & 0xFF, record[12] >> 8, record[12] & 0xFF]
+    flags, instruction_name = record[13] & 0xFF, OPCODES[record[13] >> 8]
+    related_token_index = record[14] - 1
+
+    if instruction_address < len(instructions):
+        related_token = instructions[instruction_address]["related_token"]
+    else:
+        related_token = "model imem init"
+
+    return format_state(ticks, sp, format_stack_state(sp, stack_cells, tos),
+                        rsp, format_stack_state(rsp, rstack_cells, rtos),
+                        bool(flags & 0b001), bool(flags & 0b010), bool(flags & 0b100), imem_address, pc,
+                        related_token_index, related_token, instruction_name)
+
+
+def render(trace_path, program_path, first_tick=None, last_tick=None, output=None):
+    """
+    Writes lines of ticks [first_tick; last_tick] of binary trace to output (stdout by default).
+    Trace file is memory-mapped and only records of requested ticks are read.
+    """
+    if output is None:
+        output = sys.stdout
+
+    instructions = load_program(program_path, with_related_tokens=True)["instructions"]
+
+    header_size = struct.calcsize(TRACE_HEADER_FORMAT)
+    with open(trace_path, "rb") as trace_file:
+        with mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ) as trace:
+            magic, version, record_words = struct.unpack_from(TRACE_HEADER_FORMAT, trace)
+            if magic != TRACE_MAGIC or version != TRACE_VERSION or record_words != TRACE_RECORD_WORDS:
+                raise ValueError(f'TRACE: {trace_path} is not a trace of version {TRACE_VERSION}')
+
+            record_format = f'<{record_words}H'
+            record_size = struct.calcsize(record_format)
+            records_count = (len(trace) - header_size) // record_size
+            if records_count == 0:
+                return
+
+            ticks_low, ticks_middle, ticks_high = struct.unpack_from('<HHH', trace, header_size)
+            start_tick = ticks_low | ticks_middle << 16 | ticks_high << 32
+            first = 0 if first_tick is None else max(first_tick - start_tick, 0)
+            last = records_count - 1 if last_tick is None else min(last_tick - start_tick, records_count - 1)
+
+            for index in range(first, last + 1):
+                record = struct.unpack_from(record_format, trace, header_size + index * record_size)
+                output.write(render_record(record, instructions) + '\n')
+
+
+if __name__ == '__main__':
+    trace_path_arg = sys.argv[1]
+    program_path_arg = sys.argv[2]
+    first_tick_arg = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    last_tick_arg = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    render(trace_path_arg, program_path_arg, first_tick_arg, last_tick_arg)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from .program_format import BINARY_PROGRAM_EXTENSION
+from .program_format import load_program
+from .program_format import save_binary_program
+from .translatorv2 import TRANSLATOR_VERSION
+from .translatorv2 import Translator
+from .translatorv2 import main as translator_main
+
+TRANSLATION_CACHE_LOGGER_NAME = "translation_cache_logger"
+DEFAULT_MAX_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def get_translation_key(source_code, options=None):
+    """
+    :param options: keyword arguments of Translator
+    :return: sha256 of translator version, options and source code
+    """
+    translation_key = hashlib.sha256(f'lab translator v{TRANSLATOR_VERSION}'.encode())
+    translation_key.update(json.dumps(options or {}, sort_keys=True).encode())
+    translation_key.update(source_code.encode("utf-8"))
+    return translation_key.hexdigest()
+
+
+def get_translation_cache_logger():
+    # translation log is not needed for cached programs, so nothing is written
+    logger = logging.getLogger(TRANSLATION_CACHE_LOGGER_NAME)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+class TranslationCache:
+    """
+    Binary programs (see program_format.py) translated from sources, kept in cache_folder under
+    get_translation_key(), so same source with same translator version and options is translated once.\n
+    At most max_size bytes of programs are kept, the least recently used are removed first
+    (every cache hit updates modification time of program file).
+    """
+
+    def __init__(self, cache_folder=None, max_size=DEFAULT_MAX_CACHE_SIZE, logger=None):
+        if cache_folder is None:
+            cache_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'translated')
+        if logger is None:
+            logger = get_translation_cache_logger()
+
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.logger = logger
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def get_path(self, translation_key):
+        return os.path.join(self.cache_folder, translation_key + BINARY_PROGRAM_EXTENSION)
+
+    def lookup(self, source_code, options=None):
+        """
+        :return: path of cached program, None if source was not translated with these options
+        """
+        program_path = self.get_path(get_translation_key(source_code, options))
+        try:
+            os.utime(program_path)
+        except FileNotFoundError:
+            return None
+        return program_path
+
+    def store(self, source_code, program, options=None):
+        """
+        Saves program translated from source_code and removes least recently used programs over max_size
+        :return: path of cached program
+        """
+        program_path = self.get_path(get_translation_key(source_code, options))
+        # replaced atomically, programs loaded from previous file keep their mapping
+        save_binary_program(program, program_path)
+        self.evict(keep_path=program_path)
+        return program_path
+
+    def evict(self, keep_path=None):
+        """
+        Removes least recently used programs until cache fits max_size, program at keep_path is never removed
+        """
+        entries = []
+        total_size = 0
+        with os.scandir(self.cache_folder) as scanned:
+            for entry in scanned:
+                if entry.name.endswith(BINARY_PROGRAM_EXTENSION):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def get_program_path(self, source_code, options=None):
+        """
+        Translates source_code only if it is not in cache
+        :return: path of cached binary program, it can be passed to model.main() or load_program() as is
+        """
+        program_path = self.lookup(source_code, options)
+        if program_path is not None:
+            self.logger.info(f"Using translated program from cache: {program_path}")
+            return program_path
+
+        translator = Translator(source_code, self.logger, **(options or {}))
+        translator.translate()
+        program_path = self.store(source_code, translator.get_program(), options)
+        self.logger.info(f"Translated program saved to cache: {program_path}")
+        return program_path
+
+    def get_program(self, source_code, options=None):
+        """
+        :return: program as in .lab file (memory-mapped binary program, see program_format.load_program())
+        """
+        return load_program(self.get_program_path(source_code, options))
+
+
+if __name__ == '__main__':
+    # python -m src.translation_cache <source_file> <target_file>
+    # same as translator, but source is translated only if it is not in cache
+    translator_main(sys.argv[1], sys.argv[2], translation_cache=TranslationCache())
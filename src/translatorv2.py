@@ -1,19 +1,66 @@
-import json
 import logging
 import os
 import re
 import shutil
 from logging.handlers import RotatingFileHandler
+from typing import Dict
 from typing import List
 from typing import Tuple
 
+from .model import ADDRESS_TABLE_SIZE
+from .model import EXTENDED_ADDRESS_TABLE_SIZE
+from .model import OPCODE_BY_NAME
+from .model import opcode_and_offset_to_address
+from .program_format import BINARY_PROGRAM_EXTENSION
+from .program_format import DebugInfo
+from .program_format import load_program
+from .program_format import save_program
+
+# tokens are separated by whitespaces, string literals are tokens even with whitespaces inside
+TOKEN_SPLIT_PATTERN = r'(\s+|"[^"]+")'
+# bump on every change of generated code, so old cached translations are not used (see translation_cache.py)
+TRANSLATOR_VERSION = 5
+RESERVED_WORDS = frozenset([
+    '+', '-', '/', '*', '%', '>', '<', '=', 'SWAP', 'DUP', 'DROP', 'OVER', 'ROT', '!', '@', '.', 'READ',
+    ':function_name', ';', 'IF', 'THEN', 'BEGIN', 'UNTIL', 'VARIABLE'
+])
+
+# sequences of translator output that do nothing (or have shorter equivalent), replaced by
+# Translator.optimize_peephole(). DEC keeps OF, while SUB resets it, but every JO is emitted right after
+# SUM or INC, whose overflow it checks
+PEEPHOLE_RULES = {
+    ("SWAP", "SWAP"): (),
+    ("ROT", "ROT", "ROT"): (),
+    ("DUP", "DROP"): (),
+    ("OVER", "DROP"): (),
+    ("TOR", "RFROM"): (),
+    ("RFROM", "TOR"): (),
+    ("FALSE", "INC", "SUM"): ("INC",),
+    ("FALSE", "INC", "SUB"): ("DEC",),
+}
+RELATIVE_JUMP_INSTRUCTIONS = frozenset(["JMPR", "JZ", "JL", "JO", "JFR"])
+# triple-length token -> instruction, that replaces its expansion with native_triple
+TRIPLE_INSTRUCTIONS = {"T+": "TSUM", "T@": "TGET", "T!": "TSET", "T=": "TEQ", "TDUP": "TDUP"}
+# instructions of IF, that jump by JMPA table cell written when THEN label is known
+IF_JUMP_INSTRUCTIONS = frozenset(["JMPA", "JFA"])
+# comparison token -> instruction, that replaces its CMP, jumps and DROPs with native_compare
+COMPARE_INSTRUCTIONS = {"=": "EQ", "<": "LT", ">": "GT"}
+
 
 class AddressTable:
-    def __init__(self, size, start_address, name, logger):
+    def __init__(self, opcode_name, name, logger, size=ADDRESS_TABLE_SIZE, extended_size=EXTENDED_ADDRESS_TABLE_SIZE):
+        """
+        Cells of offsets from size are written to extended table (see model.opcode_and_offset_to_address),
+        it is placed after program code (extended_address is known after Translator.merge_address_tables())
+        """
         self.data: List[int] = [0] * (size * 2)
-        self.max_size: int = size
+        self.extended_data: List[int] = []
+        self.extended_address: int = -1
+        self.size: int = size
+        self.max_size: int = size + extended_size
         self.reserved_count: int = 0
-        self.start_address: int = start_address
+        self.opcode = OPCODE_BY_NAME[opcode_name]
+        self.start_address: int = opcode_and_offset_to_address(self.opcode, 0)
         self.name = name
         self.logger = logger
 
@@ -23,13 +70,36 @@ class AddressTable:
         self.reserved_count += 1
         return reserved_offset
 
+    def get_cell_address(self, offset) -> int:
+        if offset >= self.size:
+            assert self.extended_address != -1, f'EXTENDED TABLE OF {self.start_address:04X} IS NOT PLACED YET'
+            return self.extended_address + (offset - self.size) * 2
+        return opcode_and_offset_to_address(self.opcode, offset)
+
     def write_to_offset(self, offset, value):
+        if offset < self.size:
+            data, index = self.data, offset * 2
+            cells = [f'imem[{self.get_cell_address(offset) + shift:04X}]' for shift in range(2)]
+        else:
+            # address of extended table is not known yet, cells are named by index in it
+            data, index = self.extended_data, (offset - self.size) * 2
+            if len(data) < index + 2:
+                data.extend([0] * (index + 2 - len(data)))
+            cells = [f'extended[{index + shift:04X}]' for shift in range(2)]
+
         self.logger.info(
-            f"Writing to table {self.name} offset {offset}: imem[{self.start_address + offset * 2:04X}] = {(value >> 8) & 0xFF:02X}")
-        self.data[offset * 2] = (value >> 8) & 0xFF
+            f"Writing to table {self.name} offset {offset}: {cells[0]} = {(value >> 8) & 0xFF:02X}")
+        data[index] = (value >> 8) & 0xFF
         self.logger.info(
-            f"Writing to table {self.name} offset {offset}: imem[{self.start_address + offset * 2 + 1:04X}] = {value & 0xFF:02X}")
-        self.data[offset * 2 + 1] = value & 0xFF
+            f"Writing to table {self.name} offset {offset}: {cells[1]} = {value & 0xFF:02X}")
+        data[index + 1] = value & 0xFF
+
+    def read_from_offset(self, offset) -> int:
+        if offset < self.size:
+            data, index = self.data, offset * 2
+        else:
+            data, index = self.extended_data, (offset - self.size) * 2
+        return (data[index] << 8) + data[index + 1]
 
     def print(self):
         self.logger.info('----------------')
@@ -44,6 +114,12 @@ class AddressTable:
 
         return instructions_data
 
+    def get_extended_as_instructions_data(self):
+        """
+        :return: extended table cells, from address of offset size, empty if there are no such offsets
+        """
+        return [Instruction(value, -1, "initialization") for value in self.extended_data]
+
 
 class Instruction:
     def __init__(self, value, related_token_index: int, related_token: str = None, offset: int = None):
@@ -78,21 +154,39 @@ class Variable:
 
 
 class Translator:
-    def __init__(self, sourcecode, logger=None):
+    def __init__(self, sourcecode, logger=None, constant_pool=False, direct_variables=False, peephole=False,
+                 native_compare=False, jump_if_false=False, native_triple=False):
+        """
+        :param constant_pool: if True, every distinct constant is stored once and pushed by one LOAD through its own
+        LOAD table cell (in extended LOAD table after first ADDRESS_TABLE_SIZE cells), instead of LOAD LOAD INC... GET
+        of new slot for every literal
+        :param direct_variables: if True, address of variable is known at translation time and pushed as two pooled
+        constants, instead of reading it from variables addresses table after 2 * index INC
+        :param peephole: if True, sequences of PEEPHOLE_RULES are removed or shortened after functions are placed,
+        see optimize_peephole()
+        :param native_compare: if True, "=", "<" and ">" are translated to one EQ, LT or GT instruction (2 ticks)
+        instead of CMP, conditional jumps, DROPs and TRUE or FALSE
+        :param jump_if_false: if True, IF is translated to one JFA and UNTIL to one JFR (pop TOS and jump if it is 0)
+        instead of FALSE CMP DROP DROP JZ JMPR JMPA
+        :param native_triple: if True, "T+", "T@", "T!", "T=" and "TDUP" are translated to one TSUM, TGET, TSET, TEQ
+        or TDUP instruction (3-9 ticks) instead of expansions of 14-100+ instructions
+        """
         self.logger = logger if logger is not None else configure_logger(logging_level=logging.INFO, logger_name="default_logger")
 
         self.source: str = sourcecode
         self.current_token = None
         self.current_token_index = -1
 
-        self.load = AddressTable(32, 0x0000, "LOAD table", self.logger)
-        self.call = AddressTable(32, 0x0040, "CALL table", self.logger)
-        self.jmp = AddressTable(32, 0x0080, "JMPA table", self.logger)
+        self.load = AddressTable("LOAD", "LOAD table", self.logger)
+        self.call = AddressTable("CALL", "CALL table", self.logger)
+        self.jmp = AddressTable("JMPA", "JMPA table", self.logger)
 
         self.instructions: List[Instruction] = []
         self.instruction_counter = 0
 
         self.functions: List[Function] = []
+        # name -> function, same functions as in self.functions
+        self.function_by_name: Dict[str, Function] = {}
         self.currently_defining_function_with_name = None
 
         self.recursion_level_if = 0
@@ -109,7 +203,22 @@ class Translator:
         self.init_addresses_in_data()
         self.init_load()
 
+        self.constant_pool = constant_pool
+        self.direct_variables = direct_variables
+        self.peephole = peephole
+        self.native_compare = native_compare
+        self.jump_if_false = jump_if_false
+        self.native_triple = native_triple
+        # value -> RAM address of constant (tconstant) in pool, RAM address -> LOAD table offset that points to it
+        self.pooled_constants: Dict[int, int] = {}
+        self.pooled_tconstants: Dict[int, int] = {}
+        self.load_offset_by_address: Dict[int, int] = {}
+        # start addresses of extended LOAD, CALL and JMPA tables, None if program has no extended cells
+        self.extended_tables = None
+
         self.variables: List[Variable] = []
+        # name (FUNC.name for variables of functions) -> variable, same variables as in self.variables
+        self.variable_by_name: Dict[str, Variable] = {}
         self.number_of_constants = 0
         self.number_of_tconstants = 0
         self.number_of_strings = 0
@@ -135,6 +244,7 @@ class Translator:
                     self.logger.info(
                         f"Assigning to variable with address 0x{self.variables[-1].address:04X} name {variable_name}")
                     self.variables[-1].name = variable_name
+                    self.variable_by_name.setdefault(variable_name, self.variables[-1])
                 else:
                     raise SyntaxError(f"Variable with name {variable_name} already defined or clashes with reserved word")
 
@@ -149,6 +259,8 @@ class Translator:
             elif token == "%":
                 self.append("MOD")
 
+            elif token in COMPARE_INSTRUCTIONS and self.native_compare:
+                self.append(COMPARE_INSTRUCTIONS[token])
             elif token == "=":
                 self.append("CMP")
                 self.append("JZ", offset=4)
@@ -180,7 +292,7 @@ class Translator:
                 self.append("JMPR", offset=3)
                 self.append("DROP")
                 self.append("DROP")
-                self.append("TRUE ")
+                self.append("TRUE")
 
             elif token in ['SWAP', 'DUP', 'DROP', 'OVER', 'ROT']:
                 self.append(token)
@@ -210,6 +322,9 @@ class Translator:
             elif token == ';':
                 self.currently_defining_function_with_name = None
 
+            elif token == 'IF' and self.jump_if_false:
+                self.append("JFA", offset=-1)
+                self.recursion_level_if_inc()
             elif token == 'IF':
                 self.append("FALSE")
                 self.append("CMP")
@@ -230,6 +345,8 @@ class Translator:
                 else:
                     func = self.get_function_by_name(self.currently_defining_function_with_name)
                     func.begin_last_label_stack.append(func.instructions_counter)
+            elif token == 'UNTIL' and self.jump_if_false:
+                self.append_until_jump_if_false()
             elif token == 'UNTIL':
                 if self.currently_defining_function_with_name is None:
                     self.process_until_for_regular()
@@ -270,6 +387,8 @@ class Translator:
             elif token == "FALSE":
                 self.append("FALSE")
 
+            elif token in TRIPLE_INSTRUCTIONS and self.native_triple:
+                self.append(TRIPLE_INSTRUCTIONS[token])
             elif token == "T+":
                 self.append_tsum_instructions()
 
@@ -322,6 +441,9 @@ class Translator:
                 self.VARIABLES_VALUES_ADDRESS += 3
                 self.VARIABLES_ADDRESSES_ADDRESS += 2
 
+            elif self.get_variable_by_name(token) is not None and self.direct_variables:
+                self.push_variable_address_on_top(self.get_variable_by_name(token))
+
             elif self.get_variable_by_name(token) is not None:
                 variables_addresses_offset_index = 4
                 self.append("LOAD", offset=variables_addresses_offset_index)
@@ -356,6 +478,9 @@ class Translator:
         self.postprocess_shift_functions_jmpa()
         self.process_if_statements_for_functions()
 
+        if self.peephole:
+            self.optimize_peephole()
+
         self.merge_address_tables()
 
         return self.instructions, self.data
@@ -391,9 +516,7 @@ class Translator:
         self.source = cleaned_code
 
     def tokenize(self) -> List[str]:
-        pattern = r'(\s+|"[^"]+")'
-
-        result = re.split(pattern, self.source)
+        result = re.split(TOKEN_SPLIT_PATTERN, self.source)
         result = [item for item in result if item.strip() != '' and item != '\n']
         for i, token in enumerate(result):
             if token[0] != '"':
@@ -401,6 +524,45 @@ class Translator:
 
         return result
 
+    def get_token_lines(self) -> List[int]:
+        """
+        :return: number of source code line (from 1) of every token, in same order as tokenize() returns tokens
+        """
+        return [line for line, _ in self.get_token_positions()]
+
+    def get_token_positions(self) -> List[Tuple[int, int]]:
+        """
+        :return: (line, column) of first character (both from 1) of every token, in same order as tokenize()
+        returns tokens
+        """
+        source = '\n'.join(line.split('#')[0] for line in self.source.split('\n'))
+
+        token_positions = []
+        line = 1
+        column = 1
+        for item in re.split(TOKEN_SPLIT_PATTERN, source):
+            if item.strip() != '' and item != '\n':
+                token_positions.append((line, column))
+            if '\n' in item:
+                line += item.count('\n')
+                column = len(item) - item.rindex('\n')
+            else:
+                column += len(item)
+
+        return token_positions
+
+    def get_program(self):
+        """
+        :return: program as in .lab file with its debug info (see program_format.DebugInfo),
+        must be called after translate()
+        """
+        instructions_list = self.convert_instructions_to_list()
+        program = {"instructions": instructions_list, "data": self.data,
+                   "debug_info": DebugInfo.from_instructions(instructions_list, self.get_token_positions())}
+        if self.extended_tables is not None:
+            program["extended_tables"] = self.extended_tables
+        return program
+
     def convert_instructions_to_list(self):
         instr_list = []
         for instr in self.instructions:
@@ -413,13 +575,12 @@ class Translator:
         return instr_list
 
     def reserve_function(self, name):
-        self.functions.append(Function(name, self.call.reserve()))
+        function = Function(name, self.call.reserve())
+        self.functions.append(function)
+        self.function_by_name.setdefault(name, function)
 
     def get_function_by_name(self, name):
-        for func in self.functions:
-            if func.name == name:
-                return func
-        return None
+        return self.function_by_name.get(name)
 
     def add_instruction(self, instruction):
         if self.currently_defining_function_with_name is None:
@@ -468,14 +629,25 @@ class Translator:
                 + self.instructions
         )
 
+        # extended tables (only if some table has cells over its size) follow program code without gaps,
+        # their start addresses are given to model by program["extended_tables"]
+        program_size = len(self.instructions)
+        for table in [self.load, self.call, self.jmp]:
+            table.extended_address = len(self.instructions)
+            self.instructions += table.get_extended_as_instructions_data()
+        assert len(self.instructions) <= 0x10000, \
+            f'PROGRAM OF {len(self.instructions)} INSTRUCTIONS DOES NOT FIT INSTRUCTIONS MEMORY'
+        if len(self.instructions) > program_size:
+            self.extended_tables = [table.extended_address for table in [self.load, self.call, self.jmp]]
+
     def get_address_tables_size(self):
-        return self.load.max_size * 2 + self.call.max_size * 2 + self.jmp.max_size * 2
+        return self.load.size * 2 + self.call.size * 2 + self.jmp.size * 2
 
     def process_if_statements_for_regular(self):
         sorted_labels = sorted(self.labels, key=lambda pair: (pair[0], pair[1]))
 
         for instr in self.instructions:
-            if instr.value == "JMPA" and len(sorted_labels) > 0:
+            if instr.value in IF_JUMP_INSTRUCTIONS and len(sorted_labels) > 0:
                 reserved_offset = self.jmp.reserve()
                 relative_jmp_address = sorted_labels.pop(0)[1]  # ~ instruction counter
                 shift = self.get_address_tables_size()
@@ -489,7 +661,7 @@ class Translator:
             sorted_labels = sorted(func.labels, key=lambda pair: (pair[0], pair[1]))
 
             for instr in func.instructions:
-                if instr.value == "JMPA" and instr.offset == -1:
+                if instr.value in IF_JUMP_INSTRUCTIONS and instr.offset == -1:
                     assert func.start_address != -1, f'FUNC START ADDRESS {func.start_address}'
 
                     try:
@@ -542,6 +714,17 @@ class Translator:
         func.jmpa_instructions_and_reserved_offset_and_relative_shift.append(
             (func.instructions[-1], reserved_jmp_offset, address_to_jmp_relative))
 
+    def append_until_jump_if_false(self):
+        """
+        UNTIL as one JFR back to first instruction after BEGIN, its offset does not depend on where function is placed
+        """
+        if self.currently_defining_function_with_name is None:
+            begin, counter = self.begin_last_label_stack.pop(), self.instruction_counter
+        else:
+            func = self.get_function_by_name(self.currently_defining_function_with_name)
+            begin, counter = func.begin_last_label_stack.pop(), func.instructions_counter
+        self.append("JFR", offset=begin - counter - 1)
+
     def postprocess_shift_functions_jmpa(self):
         for func in self.functions:
             self.logger.info(f"Post-processing UNTIL token inside of function {func.name}: ")
@@ -573,6 +756,81 @@ class Translator:
             # save to call table addresses of func start
             self.call.write_to_offset(func.call_offset, function_start - 1)
 
+    def get_jump_targets(self):
+        """
+        :return: indexes in self.instructions (before merge with address tables) of instructions that relative jumps
+        and JMPA and CALL table cells lead to
+        """
+        shift = self.get_address_tables_size()
+        targets = set()
+        for index, instruction in enumerate(self.instructions):
+            if instruction.value in RELATIVE_JUMP_INSTRUCTIONS:
+                targets.add(index + 1 + instruction.offset)
+        for table in [self.jmp, self.call]:
+            for offset in range(table.reserved_count):
+                # table cell keeps address before target, PC is incremented after jump
+                targets.add(table.read_from_offset(offset) + 1 - shift)
+        return targets
+
+    def optimize_peephole(self):
+        """
+        Replaces sequences of PEEPHOLE_RULES in self.instructions (functions are already appended to them) until
+        there are none. Sequence is replaced only if no jump leads inside of it (jump to its first instruction leads
+        to replacement or next instruction), then offsets of relative jumps and JMPA and CALL table cells
+        are moved to new addresses
+        """
+        shift = self.get_address_tables_size()
+        changed = True
+        while changed:
+            changed = False
+            targets = self.get_jump_targets()
+
+            optimized: List[Instruction] = []
+            # old index -> new index of same instruction (or of next one if it is removed)
+            new_indexes: List[int] = []
+            jumps: List[Tuple[Instruction, int]] = []
+            index = 0
+            while index < len(self.instructions):
+                instruction = self.instructions[index]
+                for pattern, replacement in PEEPHOLE_RULES.items():
+                    end = index + len(pattern)
+                    if (pattern[0] == instruction.value
+                            and tuple(item.value for item in self.instructions[index:end]) == pattern
+                            and targets.isdisjoint(range(index + 1, end))):
+                        break
+                else:
+                    if instruction.value in RELATIVE_JUMP_INSTRUCTIONS:
+                        jumps.append((instruction, index))
+                    new_indexes.append(len(optimized))
+                    optimized.append(instruction)
+                    index += 1
+                    continue
+
+                last = self.instructions[end - 1]
+                self.logger.info(f"Peephole: {' '.join(pattern)} -> {' '.join(replacement) or 'nothing'} "
+                                 f"at 0x{index + shift:04X} (token '{last.related_token}')")
+                new_indexes += [len(optimized)] * len(pattern)
+                optimized += [Instruction(name, last.related_token_index, last.related_token) for name in replacement]
+                index = end
+                changed = True
+            new_indexes.append(len(optimized))
+
+            if not changed:
+                break
+
+            for instruction, old_index in jumps:
+                instruction.offset = new_indexes[old_index + 1 + instruction.offset] - new_indexes[old_index] - 1
+            for table in [self.jmp, self.call]:
+                for offset in range(table.reserved_count):
+                    target = table.read_from_offset(offset) + 1 - shift
+                    if 0 <= target < len(new_indexes) and new_indexes[target] != target:
+                        table.write_to_offset(offset, new_indexes[target] - 1 + shift)
+            for func in self.functions:
+                func.start_address = new_indexes[func.start_address - shift] + shift
+
+            self.instructions = optimized
+            self.instruction_counter = len(optimized)
+
     def append_tsum_instructions(self):
         self.append("ROT")
         self.append("TOR")
@@ -794,10 +1052,69 @@ class Translator:
         self.push_constant_on_top(string_start_address_h)
         self.push_constant_on_top(string_start_address_l)
 
+    def push_ram_byte_on_top(self, address):
+        """
+        Pushes RAM[address] by one LOAD through its LOAD table cell (reserved on first push of address,
+        in extended LOAD table when first ADDRESS_TABLE_SIZE cells are taken), so every push takes same ticks
+        """
+        if address not in self.load_offset_by_address:
+            if self.load.reserved_count >= self.load.max_size:
+                raise SyntaxError(f"Too many different pooled constants and variables addresses "
+                                  f"(LOAD table of {self.load.max_size} cells is full), token {self.current_token}")
+            load_offset = self.load.reserve()
+            self.load.write_to_offset(load_offset, address)
+            self.load_offset_by_address[address] = load_offset
+
+        self.append("LOAD", offset=self.load_offset_by_address[address])
+
+    def push_pooled_constant_on_top(self, constant):
+        if constant not in self.pooled_constants:
+            self.data[self.CONSTANTS_START_ADDRESS] = constant
+            self.logger.info(f'self.data[{self.CONSTANTS_START_ADDRESS:04X}] = {constant:02X}')
+            self.pooled_constants[constant] = self.CONSTANTS_START_ADDRESS
+            self.CONSTANTS_START_ADDRESS += 1
+            self.number_of_constants += 1
+
+        address = self.pooled_constants[constant]
+        self.push_ram_byte_on_top(address)
+
+    def push_pooled_tconstant_on_top(self, constant):
+        if constant not in self.pooled_tconstants:
+            if (self.TCONSTANTS_START_ADDRESS + 2) >> 8 != self.get_data_address(self.START_ADDRESS_OF_ADDRESSES + 2) >> 8:
+                raise SyntaxError(f"Too many different triple-length constants, token {self.current_token}")
+            for shift, byte in enumerate([constant >> 16, (constant >> 8) & 0xFF, constant & 0xFF]):
+                self.data[self.TCONSTANTS_START_ADDRESS + shift] = byte
+                self.logger.info(f'self.data[{self.TCONSTANTS_START_ADDRESS + shift:04X}] = {byte:02X}')
+            self.pooled_tconstants[constant] = self.TCONSTANTS_START_ADDRESS
+            self.TCONSTANTS_START_ADDRESS += 3
+            self.number_of_tconstants += 1
+
+        # high, mid, low -- same order as push_tconstant_on_top() leaves on stack
+        address = self.pooled_tconstants[constant]
+        for shift in range(3):
+            self.push_ram_byte_on_top(address + shift)
+
+    def push_variable_address_on_top(self, variable):
+        """
+        Pushes high and low bytes of variable address, same as reading them from variables addresses table
+        """
+        self.push_pooled_constant_on_top(variable.address >> 8)
+        self.push_pooled_constant_on_top(variable.address & 0xFF)
+
+    def get_data_address(self, address):
+        """
+        :return: 16-bit address stored in data at address (high byte first)
+        """
+        return (self.data[address] << 8) + self.data[address + 1]
+
     def push_constant_on_top(self, constant):
         if not 0 <= constant <= 255:
             raise ValueError(f"Unsigned constant {constant} out of bounds [0; 255]!")
 
+        if self.constant_pool:
+            self.push_pooled_constant_on_top(constant)
+            return
+
         self.data[self.CONSTANTS_START_ADDRESS] = constant
         self.logger.info(f'self.data[{self.CONSTANTS_START_ADDRESS:04X}] = {constant:02X}')
         self.append("LOAD", offset=0)
@@ -815,6 +1132,10 @@ class Translator:
         if not 0 <= constant <= 16777216:
             raise ValueError(f"Unsigned tconstant {constant} out of bounds [0; 16777216]!")
 
+        if self.constant_pool:
+            self.push_pooled_tconstant_on_top(constant)
+            return
+
         constant_high = constant >> 16
         constant_mid = (constant >> 8) & 0xFF
         constant_low = constant & 0xFF
@@ -852,9 +1173,7 @@ class Translator:
         self.number_of_constants += 1
 
     def is_reserved_word(self, word):
-        operators = ['+', '-', '/', '*', '%', '>', '<', '=', 'SWAP', 'DUP', 'DROP', 'OVER', 'ROT', '!', '@', '.',
-                     'READ', ':function_name', ';', 'IF', 'THEN', 'BEGIN', 'UNTIL', 'VARIABLE']
-        return word in operators
+        return word in RESERVED_WORDS
 
     def int_to_eight_bit(self, value):
         """
@@ -881,10 +1200,7 @@ class Translator:
         if self.currently_defining_function_with_name is not None:
             variable_name = self.currently_defining_function_with_name + "." + variable_name
 
-        for var in self.variables:
-            if var.name == variable_name:
-                return var
-        return None
+        return self.variable_by_name.get(variable_name)
 
     def is_name_valid(self, name):
         if (self.get_variable_by_name(name) is not None
@@ -937,28 +1253,47 @@ def configure_logger(logging_level, logger_name=None, log_folder=None):
     return configured_logger
 
 
-def main(source_path, output_path, configured_logger=None):
+def main(source_path, output_path, configured_logger=None, translation_cache=None, translator_options=None):
+    """
+    :param translation_cache: TranslationCache (see translation_cache.py), if given -- source is translated only if
+    it is not in cache, and translation is not logged
+    :param translator_options: keyword arguments of Translator (e.g. {"constant_pool": True})
+    """
+    if translator_options is None:
+        translator_options = {}
+
     if configured_logger is None:
         configured_logger = configure_logger(logging_level=logging.INFO, logger_name='default_translator_logger')
 
     with open(source_path, "r", encoding="utf-8") as source_file:
         source_code = source_file.read()
 
+        if translation_cache is not None:
+            cached_path = translation_cache.get_program_path(source_code, translator_options)
+            configured_logger.info(f"Translated program: {cached_path}")
+            if output_path.endswith(BINARY_PROGRAM_EXTENSION):
+                shutil.copyfile(cached_path, output_path)
+            else:
+                save_program(load_program(cached_path), output_path)
+            configured_logger.handlers[0].flush()
+            logging.shutdown()
+            return
+
         configured_logger.info("SOURCE CODE:")
         configured_logger.info(source_code)
 
         configured_logger.info("\n===== translation start =====")
-        translator = Translator(source_code, configured_logger)
+        translator = Translator(source_code, configured_logger, **translator_options)
 
         try:
             instructions, data = translator.translate()
             configured_logger.info("===== translation end =====\n")
             configured_logger.info(f"Total number of translated instructions: {len(translator.instructions) - 0x00C0}")
 
-            program = {"instructions": translator.convert_instructions_to_list(), "data": data}
+            program = translator.get_program()
 
-            with open(output_path, "w", encoding="utf-8") as bin_file:
-                bin_file.write(json.dumps(program, indent=4))
+            # binary program if output_path ends with .labbin, JSON .lab otherwise
+            save_program(program, output_path)
 
         except SyntaxError as syntax_error:
             configured_logger.info(f'TRANSLATION SYNTAX ERROR: {syntax_error}')
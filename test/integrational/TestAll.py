@@ -75,4 +75,32 @@ class TestAll(unittest.TestCase):
             model_main(target_file_path, input_file_path, output_file_path, logging.INFO)
 
             with open(output_file_path) as file:
-                assert file.read() == "\nWhat is your name?\n> Hello, Ivan!\n"
\ No newline at end of file
+                assert file.read() == "\nWhat is your name?\n> Hello, Ivan!\n"
+
+    def test_translator_options(self):
+        """Every program gives same output when translated with optimizing options"""
+        examples = [("cat.forth", "input.txt", "foo bar 42"),
+                    ("hello_world.forth", "input.txt", "Hello world!"),
+                    ("prob1.forth", "input.txt", "233168"),
+                    ("hello_user_name.forth", "hello_user_name_input.txt", "\nWhat is your name?\n> Hello, Ivan!\n")]
+        options = [{"constant_pool": True}, {"direct_variables": True},
+                   {"constant_pool": True, "direct_variables": True}, {"peephole": True},
+                   {"constant_pool": True, "direct_variables": True, "peephole": True}, {"native_compare": True},
+                   {"jump_if_false": True}, {"native_triple": True},
+                   {"constant_pool": True, "direct_variables": True, "peephole": True, "native_compare": True,
+                    "jump_if_false": True, "native_triple": True}]
+
+        for translator_options in options:
+            for source_name, input_name, expected_output in examples:
+                with self.subTest(source=source_name, options=translator_options):
+                    with tempfile.TemporaryDirectory() as tmpdir:
+                        input_file_path = os.path.join(self.script_directory, 'examples', input_name)
+                        target_file_path = os.path.join(tmpdir, 'program.lab')
+                        output_file_path = os.path.join(tmpdir, "output.txt")
+                        source_file_path = os.path.join(self.script_directory, 'examples', source_name)
+
+                        translator_main(source_file_path, target_file_path, translator_options=translator_options)
+                        model_main(target_file_path, input_file_path, output_file_path, logging.INFO)
+
+                        with open(output_file_path) as file:
+                            self.assertEqual(file.read(), expected_output)
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+from src.batch import run_batch
+from src.batch import run_program_batch
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        golden_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden')
+        self.programs_directory = os.path.join(golden_directory, 'programs')
+        self.input_path = os.path.join(golden_directory, 'examples', 'input.txt')
+
+    def test_pairs(self):
+        """Results of (program, input) pairs are returned in order of jobs"""
+        jobs = [(os.path.join(self.programs_directory, program_name), self.input_path)
+                for program_name in ['cat.lab', 'hello_world.lab', 'hello_user_name.lab', 'cat.lab']]
+
+        results = run_batch(jobs, max_workers=2, chunksize=1)
+
+        self.assertEqual([result.program_path for result in results], [program for program, _ in jobs])
+        self.assertEqual([result.ticks for result in results], [207, 5232, 13204, 207])
+        self.assertEqual(results[1].output, "Hello world!")
+        self.assertEqual(results[0].output, results[3].output)
+        for result in results:
+            self.assertTrue(result.halted)
+            self.assertTrue(result.halt_reason.startswith("HLT"))
+            self.assertGreater(result.wall_time, 0)
+
+    def test_one_program_many_inputs(self):
+        """Simulation reused by worker is reset between inputs"""
+        with tempfile.TemporaryDirectory() as folder:
+            input_paths = []
+            for index, name in enumerate(["Alice", "Bob", "", "Alice"]):
+                input_path = os.path.join(folder, f'input_{index}.txt')
+                with open(input_path, "w", encoding="utf-8") as input_file:
+                    input_file.write(name)
+                input_paths.append(input_path)
+
+            results = run_program_batch(os.path.join(self.programs_directory, 'hello_user_name.lab'), input_paths,
+                                        max_workers=1)
+
+        self.assertEqual([result.input_path for result in results], input_paths)
+        self.assertTrue(results[0].output.endswith("Hello, Alice!\n"))
+        self.assertTrue(results[1].output.endswith("Hello, Bob!\n"))
+        self.assertEqual(results[0].output, results[3].output)
+        self.assertEqual(results[0].ticks, results[3].ticks)
+        self.assertNotEqual(results[0].ticks, results[1].ticks)
+
+
+if __name__ == '__main__':
+    unittest.main()
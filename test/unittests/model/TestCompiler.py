@@ -0,0 +1,194 @@
+import io
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from src.compiler import CompiledSimulation
+from src.model import BUDGET_EXHAUSTED
+from src.model import FAULTED
+from src.model import HALTED
+from src.model import OutputPort
+from src.model import Simulation
+from src.model import TraceRecorder
+from src.model import configure_logger
+from src.translatorv2 import Translator
+
+
+class TestCompiler(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.logger = configure_logger(logging_level=logging.INFO, logger_name="test_compiler_logger")
+        self.programs_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden',
+                                               'programs')
+
+    def run_simulation(self, simulation, program_name):
+        with open(os.path.join(self.programs_directory, program_name)) as program_file:
+            program = json.loads(program_file.read())
+
+        simulation.cu.need_print_state = False
+        simulation.cu.imem.init_data(program["instructions"])
+        simulation.cu.ram.init_data(program["data"])
+        simulation.cu.input_buffer = [ord(character) for character in reversed("foo")] + [3]
+
+        with self.assertRaises(Exception) as context:
+            simulation.simulate()
+        self.assertTrue(str(context.exception).startswith("HLT"))
+
+        return simulation.cu
+
+    def test_traced_program_is_interpreted(self):
+        """State requested every tick (trace recorder or DEBUG log) is recorded by compiled simulation too"""
+        with open(os.path.join(self.programs_directory, 'hello_user_name.lab')) as program_file:
+            program = json.loads(program_file.read())
+
+        records = []
+        for simulation in [Simulation(self.logger), CompiledSimulation(self.logger)]:
+            simulation.cu.trace_recorder = TraceRecorder(capacity=0x10000)
+            simulation.reset(program, "foo")
+            self.assertEqual(simulation.run().status, HALTED)
+            records.append(simulation.cu.trace_recorder.get_records())
+        self.assertEqual(len(records[1]), len(records[0]))
+        self.assertEqual(records[1], records[0])
+        self.assertIsNone(simulation.blocks)
+
+        debug_logger = configure_logger(logging_level=logging.DEBUG, logger_name="test_compiler_debug_logger")
+        simulation = CompiledSimulation(debug_logger)
+        simulation.reset(program, "foo")
+        self.assertEqual(simulation.run(max_instructions=10).status, BUDGET_EXHAUSTED)
+        self.assertTrue(simulation.cu.tracing)
+        self.assertIsNone(simulation.blocks)
+
+    def test_same_as_interpreter(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            for program_name in ['hello_world.lab', 'hello_user_name.lab']:
+                interpreted = self.run_simulation(Simulation(self.logger), program_name)
+                compiled = self.run_simulation(CompiledSimulation(self.logger, cache_folder), program_name)
+
+                self.assertEqual(compiled.ticks, interpreted.ticks)
+                self.assertEqual(compiled.output_buffer, interpreted.output_buffer)
+                self.assertEqual(compiled.stack.sp, interpreted.stack.sp)
+                self.assertEqual(compiled.stack.tos, interpreted.stack.tos)
+                self.assertEqual(compiled.rstack.sp, interpreted.rstack.sp)
+                self.assertEqual((compiled.zf, compiled.nf, compiled.of), (interpreted.zf, interpreted.nf, interpreted.of))
+
+    def test_compare_instructions(self):
+        source = ' '.join(f'{a} {b} = . {a} {b} < . {a} {b} > .' for a, b in [(3, 4), (4, 4), (-3, 4), (4, -3)])
+        self.assert_translated_same_as_interpreter(source, native_compare=True)
+
+    def test_jump_if_false(self):
+        source = (':count VARIABLE i 3 i ! BEGIN i @ 48 + . i @ 2 = IF 33 . THEN i @ 1 - i ! i @ 0 = UNTIL ; '
+                  '0 IF 78 . THEN 255 IF 89 . THEN count')
+        self.assert_translated_same_as_interpreter(source, jump_if_false=True)
+
+    def test_triple_instructions(self):
+        source = ('1 2 3 1 127 T! 1 127 T@ . . . 1 127 127 0 0 2 T+ . . . '
+                  '1 2 3 1 2 3 T= . 1 2 3 1 2 4 T= . 5 6 7 TDUP . . . . . .')
+        self.assert_translated_same_as_interpreter(source, native_triple=True)
+
+    def test_faults_same_as_interpreter(self):
+        # stack underflow in SUM and SUB (also inside T+ superinstruction)
+        for source in ['+ .', '1 2 + + .', '5 - .', '1 2 3 T+ . . .']:
+            with self.subTest(source=source):
+                self.assertEqual(self.assert_translated_same_as_interpreter(source)[0], FAULTED)
+
+        # bad address table cells: instruction instead of address, value that is not a byte
+        for jump_if_false in [False, True]:
+            for cell, value in [(0x0000, "DUP"), (0x0001, 0x100), (0x0080, "HLT"), (0x0081, -1)]:
+                with self.subTest(jump_if_false=jump_if_false, cell=cell, value=value):
+                    translator = Translator('1 . 0 IF 2 . THEN 3 .', self.logger, jump_if_false=jump_if_false)
+                    translator.translate()
+                    program = translator.get_program()
+                    program["instructions"][cell] = dict(program["instructions"][cell], value=value)
+                    results = self.assert_same_as_interpreter(program)
+                    self.assertEqual(results[0], FAULTED)
+
+    def assert_translated_same_as_interpreter(self, source, **translator_options):
+        translator = Translator(source, self.logger, **translator_options)
+        translator.translate()
+        return self.assert_same_as_interpreter(translator.get_program())
+
+    def assert_same_as_interpreter(self, program):
+        """
+        :return: status, error, ticks and state after run, same for both engines
+        """
+        with tempfile.TemporaryDirectory() as cache_folder:
+            results = []
+            for simulation in [Simulation(self.logger), CompiledSimulation(self.logger, cache_folder)]:
+                simulation.cu.need_print_state = False
+                simulation.reset(program, "")
+                result = simulation.run()
+                cu = simulation.cu
+                results.append((result.status, repr(result.error), result.ticks, cu.output_buffer,
+                                (cu.zf, cu.nf, cu.of), cu.stack.sp, cu.stack.tos, cu.rstack.sp, cu.pc,
+                                cu.imem.address))
+
+        self.assertEqual(results[1], results[0])
+        return results[0]
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            self.run_simulation(CompiledSimulation(self.logger, cache_folder), 'cat.lab')
+            cached_modules = [name for name in os.listdir(cache_folder) if name.endswith('.py')]
+            self.assertEqual(len(cached_modules), 1)
+
+            cu = self.run_simulation(CompiledSimulation(self.logger, cache_folder), 'cat.lab')
+            self.assertEqual(''.join(cu.output_buffer), "foo")
+            self.assertEqual(os.listdir(cache_folder).count(cached_modules[0]), 1)
+
+    def test_reset(self):
+        with tempfile.TemporaryDirectory() as cache_folder:
+            simulation = CompiledSimulation(self.logger, cache_folder)
+            simulation.cu.need_print_state = False
+            for program_name, expected_output in [('cat.lab', "bar"), ('cat.lab', "bar"),
+                                                  ('hello_world.lab', "Hello world!")]:
+                with open(os.path.join(self.programs_directory, program_name)) as program_file:
+                    simulation.reset(json.loads(program_file.read()), "bar")
+
+                with self.assertRaises(Exception) as context:
+                    simulation.simulate()
+                self.assertTrue(str(context.exception).startswith("HLT"))
+                self.assertEqual(''.join(simulation.cu.output_buffer), expected_output)
+
+    def test_resume_from_snapshot(self):
+        with open(os.path.join(self.programs_directory, 'hello_user_name.lab')) as program_file:
+            program = json.loads(program_file.read())
+
+        interpreted = Simulation(self.logger)
+        interpreted.cu.need_print_state = False
+        interpreted.reset(program, "foo")
+        # stop in the middle of some basic block
+        for _ in range(1001):
+            interpreted.step()
+
+        with tempfile.TemporaryDirectory() as cache_folder:
+            compiled = CompiledSimulation(self.logger, cache_folder)
+            compiled.load_snapshot(interpreted.cu.get_snapshot(), program)
+
+            for simulation in [interpreted, compiled]:
+                with self.assertRaises(Exception) as context:
+                    simulation.simulate()
+                self.assertTrue(str(context.exception).startswith("HLT"))
+
+        self.assertEqual(compiled.cu.ticks, interpreted.cu.ticks)
+        self.assertEqual(compiled.cu.output_buffer, interpreted.cu.output_buffer)
+
+    def test_run_budget(self):
+        with open(os.path.join(self.programs_directory, 'hello_user_name.lab')) as program_file:
+            program = json.loads(program_file.read())
+
+        with tempfile.TemporaryDirectory() as cache_folder:
+            simulation = CompiledSimulation(self.logger, cache_folder)
+            simulation.cu.output_port = OutputPort(io.BytesIO())
+            simulation.reset(program, "foo")
+
+            results = [simulation.run(max_ticks=500)]
+            while results[-1].status == BUDGET_EXHAUSTED:
+                results.append(simulation.run(max_ticks=500))
+
+        self.assertGreater(len(results), 20)
+        self.assertEqual(results[-1].status, HALTED)
+        self.assertEqual(sum(result.ticks for result in results), 13057)
+        self.assertEqual(''.join(simulation.cu.output_buffer)[-12:], "Hello, foo!\n")
+        self.assertEqual(simulation.cu.output_port.stream.getvalue().decode(), ''.join(simulation.cu.output_buffer))
@@ -1,3 +1,4 @@
+import io
 import json
 import logging
 import unittest
@@ -5,8 +6,22 @@ import unittest
 import tempfile
 import os
 import shutil
+import asyncio
+from src.model import BUDGET_EXHAUSTED
+from src.model import FAULTED
+from src.model import FLUSH_EVERY_CHARACTER
+from src.model import FLUSH_ON_FULL_BUFFER
+from src.model import FLUSH_ON_NEWLINE
+from src.model import HALTED
+from src.model import InputPort
+from src.model import OutputPort
+from src.model import WAITING_FOR_INPUT
 from src.model import Simulation
 from src.model import configure_logger
+from src.model import main
+from src.model import OPCODE_BY_NAME
+from src.model import UNKNOWN_OPCODE
+from src.translatorv2 import Translator
 
 
 class TestModel(unittest.TestCase):
@@ -97,6 +112,85 @@ class TestModel(unittest.TestCase):
         self.assertEqual(simulation.cu.zf, True)
         self.assertEqual(simulation.cu.nf, False)
 
+    def test_compare_instructions(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        simulation.cu.stack.push(3)
+        simulation.cu.stack.push(4)
+        sp = simulation.cu.stack.sp
+        simulation.cu.lt()
+        self.assertEqual((simulation.cu.stack.tos, simulation.cu.stack.sp, simulation.cu.ticks),
+                         (0xFF, (sp - 1) & 0xFFFF, 2))
+        self.assertEqual((simulation.cu.zf, simulation.cu.nf), (False, True))
+
+        # same results and flags as CMP, jumps and DROPs that translator emits without native_compare
+        pairs = [(3, 4), (4, 4), (4, 3), (-3, 4), (4, -3), (-3, -4), (127, -128)]
+        source = ' '.join(f'{a} {b} = . {a} {b} < . {a} {b} > .' for a, b in pairs)
+        results = []
+        for native_compare in [False, True]:
+            translator = Translator(source, self.logger, native_compare=native_compare)
+            translator.translate()
+            simulation = Simulation(self.logger)
+            simulation.cu.need_print_state = False
+            simulation.reset(translator.get_program(), "")
+            ticks = simulation.run().ticks
+            cu = simulation.cu
+            results.append((ticks, cu.output_buffer, (cu.zf, cu.nf, cu.of), cu.stack.sp, cu.stack.tos))
+
+        self.assertLess(results[1][0], results[0][0])
+        self.assertEqual(results[1][1:], results[0][1:])
+
+    def test_triple_instructions(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        for value in [0x01, 0x02, 0x03, 0x12, 0xFF]:
+            simulation.cu.stack.push(value)
+        simulation.cu.tset()
+        self.assertEqual((list(simulation.cu.ram.data[0x12FF:0x1302]), simulation.cu.ticks), ([1, 2, 3], 5))
+
+        for value in [0x12, 0xFF]:
+            simulation.cu.stack.push(value)
+        simulation.cu.tget()
+        simulation.cu.tdup()
+        simulation.cu.tsum()
+        sp = simulation.cu.stack.sp
+        self.assertEqual([simulation.cu.stack.data[(sp - 1) & 0xFFFF], simulation.cu.stack.data[sp],
+                          simulation.cu.stack.tos], [0x02, 0x04, 0x06])
+        self.assertEqual(simulation.cu.ticks, 5 + 5 + 3 + 9)
+
+        # same output, stack and RAM as expansions that translator emits without native_triple
+        source = ('1 2 3 1 127 T! 1 127 T@ . . . 1 127 127 0 0 2 T+ . . . '
+                  '1 2 3 1 2 3 T= . 1 2 3 1 2 4 T= . 5 6 7 TDUP . . . . . .')
+        results = []
+        for native_triple in [False, True]:
+            translator = Translator(source, self.logger, native_triple=native_triple)
+            translator.translate()
+            simulation = Simulation(self.logger)
+            simulation.cu.need_print_state = False
+            simulation.reset(translator.get_program(), "")
+            ticks = simulation.run().ticks
+            cu = simulation.cu
+            results.append((ticks, cu.output_buffer, cu.stack.sp, cu.stack.tos, bytes(cu.ram.data)))
+
+        self.assertLess(results[1][0], results[0][0])
+        self.assertEqual(results[1][1:], results[0][1:])
+
+    def test_jump_if_false(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        for value, pc, ticks in [(0, 0x0100 + 5, 2), (7, 0x0100, 1)]:
+            simulation.cu.reset()
+            sp = simulation.cu.stack.sp
+            simulation.cu.stack.push(value)
+            simulation.cu.pc = 0x0100
+            simulation.cu.decoder.offset = 5
+            simulation.cu.jfr()
+            self.assertEqual((simulation.cu.pc, simulation.cu.ticks, simulation.cu.zf), (pc, ticks, value == 0))
+            self.assertEqual(simulation.cu.stack.sp, sp)
+
     def test_sum_overflow(self):
         simulation = Simulation(self.logger)
         simulation.cu.need_print_state = False
@@ -109,3 +203,340 @@ class TestModel(unittest.TestCase):
         self.assertEqual(simulation.cu.zf, False)
         self.assertEqual(simulation.cu.nf, False)
         self.assertEqual(simulation.cu.of, True)
+
+    def test_predecode(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        simulation.cu.imem.init_data([
+            {"value": 7, "related_token_index": -1, "related_token": "initialization", "offset": None},
+            {"value": "JZ", "related_token_index": 3, "related_token": "=", "offset": 4},
+            {"value": "TRUE ", "related_token_index": 5, "related_token": "<", "offset": None},
+        ])
+
+        self.assertEqual(simulation.cu.imem.opcodes[0], UNKNOWN_OPCODE)
+        self.assertEqual(simulation.cu.imem.opcodes[1], OPCODE_BY_NAME["JZ"])
+        self.assertEqual(simulation.cu.imem.offsets[1], 4)
+        self.assertEqual(simulation.cu.imem.related_token_indexes[1], 3)
+
+        simulation.cu.pc = 2
+        with self.assertRaises(ValueError):
+            simulation.step()
+
+    def run_translated(self, source, use_superinstructions):
+        translator = Translator(source, self.logger)
+        translator.translate()
+
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+        simulation.cu.use_superinstructions = use_superinstructions
+        simulation.cu.imem.init_data(translator.convert_instructions_to_list())
+        simulation.cu.ram.init_data(translator.data)
+
+        with self.assertRaises(Exception) as context:
+            simulation.simulate()
+        self.assertTrue(str(context.exception).startswith("HLT"))
+
+        return simulation.cu
+
+    def test_superinstructions(self):
+        source = '''
+            variable a 3 a ! tvariable big 70000 big t!
+            3 4 < . 4 4 < . 3 4 > . 4 3 > . 4 4 = . 4 5 = .
+            big t@ 0 255 255 t+ big t! big t@ . . .
+            begin a @ 1 - a ! a @ if 65 . then a @ 0 = until
+        '''
+        unfused = self.run_translated(source, False)
+        fused = self.run_translated(source, True)
+
+        self.assertTrue(any(opcode > UNKNOWN_OPCODE for opcode in fused.imem.fused_opcodes))
+        self.assertEqual(fused.ticks, unfused.ticks)
+        self.assertEqual(fused.output_buffer, unfused.output_buffer)
+        self.assertEqual((fused.zf, fused.nf, fused.of), (unfused.zf, unfused.nf, unfused.of))
+        self.assertEqual((fused.stack.sp, fused.stack.tos, fused.stack.data),
+                         (unfused.stack.sp, unfused.stack.tos, unfused.stack.data))
+        self.assertEqual((fused.rstack.sp, fused.rstack.tos, fused.rstack.data),
+                         (unfused.rstack.sp, unfused.rstack.tos, unfused.rstack.data))
+        self.assertEqual(fused.ram.data, unfused.ram.data)
+
+    def test_stack_and_ram_reset(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        simulation.cu.stack.push(1)
+        simulation.cu.stack.push(2)
+        simulation.cu.stack.push(3)
+        self.assertEqual(simulation.cu.stack.sp, 0x0001)
+        self.assertEqual(simulation.cu.stack.get_next(), 2)
+
+        simulation.cu.stack.reset()
+        self.assertEqual((simulation.cu.stack.sp, simulation.cu.stack.tos), (0xFFFE, 0))
+        self.assertEqual(simulation.cu.stack.data.count(0), 0x10000)
+
+        simulation.cu.ram.init_data([1, 2, 3])
+        simulation.cu.ram.latch_address(0x0002)
+        self.assertEqual(simulation.cu.ram.load(), 3)
+
+        simulation.cu.ram.init_data(bytes([7]))
+        self.assertEqual(bytes(simulation.cu.ram.view[:3]), bytes([7, 0, 0]))
+
+    def load_golden_program(self, program_name):
+        programs_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden',
+                                          'programs')
+        with open(os.path.join(programs_directory, program_name)) as program_file:
+            return json.loads(program_file.read())
+
+    def run_program(self, simulation, program_name, input_string):
+        simulation.reset(self.load_golden_program(program_name), input_string)
+        with self.assertRaises(Exception) as context:
+            simulation.simulate()
+        self.assertTrue(str(context.exception).startswith("HLT"))
+
+        return simulation.cu.ticks, ''.join(simulation.cu.output_buffer)
+
+    def test_control_unit_reset(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+
+        foo = self.run_program(simulation, 'hello_user_name.lab', "foo")
+        imem_data = simulation.cu.imem.data
+        self.assertEqual(self.run_program(simulation, 'hello_user_name.lab', "bar")[1][-12:], "Hello, bar!\n")
+        self.assertIs(simulation.cu.imem.data, imem_data)
+        self.assertEqual(self.run_program(simulation, 'hello_user_name.lab', "foo"), foo)
+
+        cat = self.run_program(simulation, 'cat.lab', "foo")
+        self.assertIsNot(simulation.cu.imem.data, imem_data)
+        self.assertEqual(cat, self.run_program(Simulation(self.logger), 'cat.lab', "foo"))
+
+        simulation.reset()
+        self.assertEqual((simulation.cu.pc, simulation.cu.ticks, simulation.cu.input_buffer), (0x00C0, 0, []))
+        self.assertEqual((simulation.cu.stack.sp, simulation.cu.stack.data.count(0)), (0xFFFE, 0x10000))
+
+    def test_snapshot(self):
+        program = self.load_golden_program('hello_user_name.lab')
+
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+        simulation.reset(program, "foo")
+        for _ in range(3000):
+            simulation.step()
+        snapshot = simulation.cu.get_snapshot()
+        self.assertLess(len(snapshot), 2000)
+
+        resumed = Simulation(self.logger)
+        resumed.cu.need_print_state = False
+        resumed.load_snapshot(snapshot, program)
+        self.assertEqual(resumed.cu.get_snapshot(), snapshot)
+
+        for each_simulation in [simulation, resumed]:
+            with self.assertRaises(Exception) as context:
+                each_simulation.simulate()
+            self.assertTrue(str(context.exception).startswith("HLT"))
+
+        self.assertEqual(resumed.cu.ticks, simulation.cu.ticks)
+        self.assertEqual(resumed.cu.output_buffer, simulation.cu.output_buffer)
+        self.assertEqual(resumed.cu.get_snapshot(), simulation.cu.get_snapshot())
+
+        resumed.reset(self.load_golden_program('cat.lab'))
+        with self.assertRaises(ValueError):
+            resumed.load_snapshot(snapshot)
+
+    def test_run_budgets(self):
+        program = self.load_golden_program('hello_user_name.lab')
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+        simulation.reset(program, "foo")
+
+        result = simulation.run(max_instructions=100)
+        self.assertEqual((result.status, result.instructions, result.error), (BUDGET_EXHAUSTED, 100, None))
+        self.assertEqual(result.ticks, simulation.cu.ticks)
+
+        result = simulation.run(max_ticks=1000)
+        self.assertEqual(result.status, BUDGET_EXHAUSTED)
+        self.assertGreaterEqual(result.ticks, 1000)
+
+        total_ticks = simulation.cu.ticks
+        while result.status == BUDGET_EXHAUSTED:
+            result = simulation.run(max_ticks=777, max_instructions=500)
+            total_ticks += result.ticks
+        self.assertEqual(result.status, HALTED)
+        self.assertEqual(str(result.error), "HLT was raised on tick 13057")
+        self.assertEqual(total_ticks, 13057)
+        self.assertEqual(''.join(simulation.cu.output_buffer), "\nWhat is your name?\n> Hello, foo!\n")
+
+    def test_run_waiting_for_input_and_faulted(self):
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+        simulation.reset(self.load_golden_program('cat.lab'), "")
+        simulation.cu.input_buffer = [2]
+
+        result = simulation.run()
+        self.assertEqual(result.status, WAITING_FOR_INPUT)
+        self.assertEqual(simulation.cu.imem.opcodes[simulation.cu.pc], OPCODE_BY_NAME["READ"])
+
+        simulation.cu.input_buffer = [ord('b'), ord('a')]
+        result = simulation.run()
+        self.assertEqual(result.status, HALTED)
+        self.assertEqual(''.join(simulation.cu.output_buffer), "ab")
+
+        simulation.reset()
+        simulation.cu.pc = 0x1000
+        result = simulation.run()
+        self.assertEqual((result.status, result.instructions), (FAULTED, 0))
+        self.assertIsInstance(result.error, ValueError)
+
+    def test_run_async(self):
+        program = self.load_golden_program('hello_user_name.lab')
+        simulations = [Simulation(self.logger) for _ in range(3)]
+        for simulation, name in zip(simulations, ["foo", "bar", "baz"]):
+            simulation.cu.need_print_state = False
+            simulation.reset(program, name)
+
+        async def run_all():
+            return await asyncio.gather(*[simulation.run_async(slice_instructions=100)
+                                          for simulation in simulations])
+
+        results = asyncio.run(run_all())
+        self.assertEqual([result.status for result in results], [HALTED] * 3)
+        self.assertEqual([result.ticks for result in results], [13057] * 3)
+        self.assertEqual(''.join(simulations[1].cu.output_buffer)[-12:], "Hello, bar!\n")
+
+        simulation = simulations[0]
+        simulation.reset(program, "foo")
+        result = asyncio.run(simulation.run_async(max_instructions=250, slice_instructions=100))
+        self.assertEqual((result.status, result.instructions), (BUDGET_EXHAUSTED, 250))
+
+    def test_output_port(self):
+        class RecordingStream(io.BytesIO):
+            def __init__(self):
+                super().__init__()
+                self.writes = []
+
+            def write(self, data):
+                self.writes.append(data)
+                return super().write(data)
+
+        program = self.load_golden_program('hello_user_name.lab')
+        expected_output = b"\nWhat is your name?\n> Hello, foo!\n"
+        expected_writes = {
+            FLUSH_EVERY_CHARACTER: [bytes([character]) for character in expected_output],
+            # full buffer is flushed with any policy
+            FLUSH_ON_NEWLINE: [b"\n", b"What is your nam", b"e?\n", b"> Hello, foo!\n"],
+            FLUSH_ON_FULL_BUFFER: [expected_output[:16], expected_output[16:32], expected_output[32:]],
+        }
+
+        for flush_policy, writes in expected_writes.items():
+            simulation = Simulation(self.logger)
+            simulation.cu.need_print_state = False
+            simulation.cu.keep_output_buffer = False
+            stream = RecordingStream()
+            simulation.cu.output_port = OutputPort(stream, flush_policy, buffer_size=16)
+            simulation.reset(program, "foo")
+
+            self.assertEqual(simulation.run().status, HALTED)
+            self.assertEqual(stream.getvalue(), expected_output)
+            self.assertEqual(stream.writes, writes)
+            self.assertEqual(simulation.cu.output_buffer, [])
+
+    def test_input_port(self):
+        # cat, that reads until the end of stream (0) instead of reading length first
+        source = 'read begin . read dup 0 = until'
+        translator = Translator(source, self.logger)
+        translator.translate()
+        program = {"instructions": translator.convert_instructions_to_list(), "data": translator.data}
+
+        simulation = Simulation(self.logger)
+        simulation.cu.need_print_state = False
+        simulation.reset(program)
+        simulation.cu.input_port = InputPort(iter(["he", b"", "llo"]))
+        self.assertEqual(simulation.run().status, HALTED)
+        self.assertEqual(''.join(simulation.cu.output_buffer), "hello")
+
+        # longer than 255 characters of length-prefixed input, read by small chunks
+        long_input = bytes(ord('a') + index % 26 for index in range(1000))
+        simulation.reset(program)
+        simulation.cu.input_port = InputPort(io.BytesIO(long_input), chunk_size=64)
+        self.assertEqual(simulation.run().status, HALTED)
+        self.assertEqual(''.join(simulation.cu.output_buffer).encode(), long_input)
+
+        # no data yet: READ waits, then continues
+        def chunks():
+            yield "a"
+            yield None
+            yield "b"
+
+        simulation.reset(program)
+        simulation.cu.input_port = InputPort(chunks())
+        self.assertEqual(simulation.run().status, WAITING_FOR_INPUT)
+        self.assertEqual(simulation.run().status, HALTED)
+        self.assertEqual(''.join(simulation.cu.output_buffer), "ab")
+
+        # byte equal to end of stream value is not taken for the end of stream
+        simulation.reset(program)
+        simulation.cu.input_port = InputPort(iter([b"a\0b"]))
+        result = simulation.run()
+        self.assertEqual(result.status, FAULTED)
+        self.assertIsInstance(result.error, ValueError)
+        self.assertEqual(''.join(simulation.cu.output_buffer), "a")
+
+        with tempfile.TemporaryDirectory() as folder:
+            program_path = os.path.join(folder, 'program.lab')
+            input_path = os.path.join(folder, 'input.txt')
+            output_path = os.path.join(folder, 'output.txt')
+            with open(program_path, "w") as program_file:
+                program_file.write(json.dumps(program))
+            with open(input_path, "wb") as input_file:
+                input_file.write(long_input)
+
+            logger = configure_logger(logging_level=logging.INFO, logger_name="test_model_stream_logger",
+                                      log_folder=os.path.join(folder, 'log'))
+            main(program_path, input_path, output_path, logger=logger, stream_input=True)
+            with open(output_path, "rb") as output_file:
+                self.assertEqual(output_file.read(), long_input)
+
+    def test_main_without_output_buffer(self):
+        # cat of streamed input, output is as long as input
+        translator = Translator('read begin . read dup 0 = until', self.logger)
+        translator.translate()
+        program = {"instructions": translator.convert_instructions_to_list(), "data": translator.data}
+        long_input = bytes(ord('a') + index % 26 for index in range(5000))
+
+        simulations = []
+
+        class RecordedSimulation(Simulation):
+            def __init__(self, logger):
+                super().__init__(logger)
+                simulations.append(self)
+
+        with tempfile.TemporaryDirectory() as folder:
+            program_path = os.path.join(folder, 'program.lab')
+            input_path = os.path.join(folder, 'input.txt')
+            output_path = os.path.join(folder, 'output.txt')
+            with open(program_path, "w") as program_file:
+                program_file.write(json.dumps(program))
+            with open(input_path, "wb") as input_file:
+                input_file.write(long_input)
+
+            log_folder = os.path.join(folder, 'log')
+            logger = configure_logger(logging_level=logging.INFO, logger_name="test_model_output_logger",
+                                      log_folder=log_folder)
+            main(program_path, input_path, output_path, logger=logger, simulation_class=RecordedSimulation,
+                 stream_input=True, keep_output_buffer=False)
+            with open(output_path, "rb") as output_file:
+                self.assertEqual(output_file.read(), long_input)
+            with open(os.path.join(log_folder, 'test_model_output_logger.log'), encoding="utf-8") as log_file:
+                self.assertNotIn("Output buffer", log_file.read())
+
+        self.assertEqual(simulations[0].cu.output_buffer, [])
+
+    def test_tracing_only_if_debug_enabled(self):
+        simulation = Simulation(self.logger)
+        self.assertFalse(simulation.cu.tracing)
+
+        debug_logger = configure_logger(logging_level=logging.DEBUG, logger_name="test_model_debug_logger")
+        simulation = Simulation(debug_logger)
+        self.assertTrue(simulation.cu.tracing)
+
+        simulation.cu.need_print_state = False
+        simulation.cu.update_tracing()
+        self.assertFalse(simulation.cu.tracing)
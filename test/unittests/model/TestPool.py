@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import unittest
+from unittest import mock
+
+from src.model import configure_logger
+from src.model import get_lab_program_hash
+from src.pool import SimulationPool
+
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.logger = configure_logger(logging_level=logging.INFO, logger_name="test_pool_logger")
+        programs_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden',
+                                          'programs')
+        self.programs = {}
+        for program_name in ['cat.lab', 'hello_world.lab']:
+            with open(os.path.join(programs_directory, program_name)) as program_file:
+                self.programs[program_name] = json.loads(program_file.read())
+
+    def simulate(self, simulation):
+        simulation.cu.need_print_state = False
+        with self.assertRaises(Exception) as context:
+            simulation.simulate()
+        self.assertTrue(str(context.exception).startswith("HLT"))
+        return simulation.cu.ticks, ''.join(simulation.cu.output_buffer)
+
+    def test_warm_simulation_reused(self):
+        """Released simulation is given again for same program and gives same results"""
+        pool = SimulationPool(self.logger)
+
+        with pool.lease(self.programs['cat.lab'], "foo") as simulation:
+            first = self.simulate(simulation)
+
+        # equal program, but not same object: found by hash
+        with pool.lease(json.loads(json.dumps(self.programs['cat.lab'])), "foo") as warm_simulation:
+            self.assertIs(warm_simulation, simulation)
+            self.assertEqual(self.simulate(warm_simulation), first)
+
+        with pool.lease(self.programs['hello_world.lab']) as other_simulation:
+            self.assertIsNot(other_simulation, simulation)
+            self.assertEqual(self.simulate(other_simulation)[1], "Hello world!")
+
+    def test_max_idle(self):
+        """Least recently released programs are dropped first"""
+        pool = SimulationPool(self.logger, max_idle=2)
+
+        cat_simulations = [pool.acquire(self.programs['cat.lab']) for _ in range(2)]
+        hello_simulation = pool.acquire(self.programs['hello_world.lab'])
+        for simulation in cat_simulations + [hello_simulation]:
+            pool.release(simulation)
+
+        self.assertEqual(pool.idle_count, 2)
+        self.assertIs(pool.acquire(self.programs['hello_world.lab']), hello_simulation)
+        self.assertIs(pool.acquire(self.programs['cat.lab']), cat_simulations[1])
+        self.assertEqual(pool.idle_count, 0)
+
+    def test_program_hashed_once(self):
+        """Same program object is serialized and hashed once, not on every acquire and reset"""
+        pool = SimulationPool(self.logger)
+        with mock.patch('src.pool.get_lab_program_hash', side_effect=get_lab_program_hash) as pool_hash, \
+                mock.patch('src.model.get_lab_program_hash', side_effect=get_lab_program_hash) as reset_hash:
+            for _ in range(3):
+                with pool.lease(self.programs['cat.lab'], "foo") as simulation:
+                    self.assertEqual(self.simulate(simulation)[1], "foo")
+            with pool.lease(self.programs['hello_world.lab']) as simulation:
+                self.assertEqual(self.simulate(simulation)[1], "Hello world!")
+
+        self.assertEqual(pool_hash.call_count, 2)
+        self.assertEqual(reset_hash.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+import unittest
+
+from src.model import HALTED
+from src.model import configure_logger
+from src.profiler import format_report
+from src.profiler import profile
+from src.translatorv2 import Translator
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.logger = configure_logger(logging_level=logging.INFO, logger_name="test_profiler_logger")
+
+    def test_profile(self):
+        """Ticks of profiled program are split by opcodes, tokens and source lines"""
+        source = 'variable a\n3 a !\nbegin\n    a @ 1 - a !\n    a @ 0 =\nuntil\n65 .'
+        translator = Translator(source, self.logger)
+        translator.translate()
+        program = {"instructions": translator.convert_instructions_to_list(), "data": translator.data}
+
+        report, result = profile(program, "", self.logger, source)
+
+        self.assertEqual(result.status, HALTED)
+        self.assertEqual(report["ticks"], int(str(result.error).split()[-1]))
+        self.assertEqual(sum(entry["ticks"] for entry in report["opcodes"]), report["ticks"])
+        self.assertEqual(sum(entry["count"] for entry in report["tokens"]), report["instructions"])
+        self.assertEqual(sum(entry["ticks"] for entry in report["lines"]), report["ticks"])
+        self.assertEqual([entry["ticks"] for entry in report["opcodes"]],
+                         sorted([entry["ticks"] for entry in report["opcodes"]], reverse=True))
+
+        lines = {entry["line"]: entry for entry in report["lines"]}
+        self.assertEqual(lines[4]["source"], "a @ 1 - a !")
+        # body of loop is executed 3 times with same instructions
+        self.assertEqual((lines[4]["count"] % 3, lines[4]["ticks"] % 3), (0, 0))
+        self.assertEqual([entry["opcode"] for entry in report["opcodes"]].count("HLT"), 1)
+
+        json.dumps(report)
+        text = format_report(report)
+        self.assertIn("OPCODES:", text)
+        self.assertIn("   4: a @ 1 - a !", text)
+
+    def test_call_graph(self):
+        """Ticks are attributed to Forth words by shadow call stack"""
+        source = ':inner 1 + ;\n:outer inner inner ;\n60 outer outer inner .'
+        translator = Translator(source, self.logger)
+        translator.translate()
+        program = {"instructions": translator.convert_instructions_to_list(), "data": translator.data}
+
+        report, result = profile(program, "", self.logger)
+        self.assertEqual(result.status, HALTED)
+
+        words = {word["word"]: word for word in report["words"]}
+        self.assertEqual((words["OUTER"]["calls"], words["INNER"]["calls"]), (2, 5))
+        self.assertEqual(words["INNER"]["inclusive_ticks"], words["INNER"]["exclusive_ticks"])
+        self.assertEqual(words["OUTER"]["inclusive_ticks"],
+                         words["OUTER"]["exclusive_ticks"] + words["INNER"]["exclusive_ticks"] * 4 // 5)
+
+        collapsed = dict(line.rsplit(' ', 1) for line in report["collapsed"])
+        self.assertEqual(set(collapsed), {"(program)", "(program);OUTER", "(program);OUTER;INNER", "(program);INNER"})
+        self.assertEqual(sum(int(ticks) for ticks in collapsed.values()), report["ticks"])
+        self.assertIn("WORDS:", format_report(report))
+
+
+if __name__ == '__main__':
+    unittest.main()
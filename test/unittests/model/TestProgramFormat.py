@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from src.model import InstructionsMemory
+from src.model import Simulation
+from src.model import configure_logger
+from src.model import get_lab_program_hash
+from src.model import main as model_main
+from src.program_format import dump_binary_program
+from src.program_format import get_annotated_instructions
+from src.program_format import get_data_ranges
+from src.program_format import load_program
+from src.program_format import parse_binary_program
+from src.program_format import parse_binary_program_header
+from src.program_format import save_program
+from src.translatorv2 import main as translator_main
+
+
+class TestProgramFormat(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.golden_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden')
+        self.programs_directory = os.path.join(self.golden_directory, 'programs')
+
+    def test_round_trip(self):
+        """Binary program loads to same instructions and data as JSON .lab, and is much smaller"""
+        for program_name in ['cat.lab', 'hello_world.lab', 'hello_user_name.lab', 'prob1.lab']:
+            program_path = os.path.join(self.programs_directory, program_name)
+            with open(program_path, encoding="utf-8") as program_file:
+                program = json.loads(program_file.read())
+
+            with tempfile.TemporaryDirectory() as folder:
+                binary_path = os.path.join(folder, program_name + 'bin')
+                save_program(program, binary_path)
+                self.assertLess(os.path.getsize(binary_path) * 10, os.path.getsize(program_path))
+                binary_program = load_program(binary_path, with_related_tokens=True)
+
+            self.assertEqual(binary_program["instructions"], program["instructions"])
+            self.assertEqual(bytes(binary_program["data"]), bytes(program["data"]).rstrip(b'\0'))
+
+    def test_instructions_memory_from_segments(self):
+        """Binary program fills instructions memory from its segments as is, same as JSON .lab instructions"""
+        for program_name in ['cat.lab', 'prob1.lab']:
+            program_path = os.path.join(self.programs_directory, program_name)
+            with open(program_path, encoding="utf-8") as program_file:
+                program = json.loads(program_file.read())
+            # cells that are not opcodes and not void: string value, zero with offset
+            program["instructions"][0x0010] = {"value": "text", "offset": 3}
+            program["instructions"][0x0011] = {"value": 0, "offset": 0}
+
+            binary = dump_binary_program(program)
+            # segments keep 9 bytes for every non-void cell, void cells are not kept
+            header, _ = parse_binary_program_header(memoryview(binary))
+            self.assertLess(header[10], len(program["instructions"]) * 9)
+            binary_program = parse_binary_program(binary)
+            self.assertNotIsInstance(binary_program["instructions"], list)
+            self.assertEqual(binary_program["instructions"][0x0010:0x0012], program["instructions"][0x0010:0x0012])
+
+            memories = [InstructionsMemory(), InstructionsMemory()]
+            memories[0].init_data(program["instructions"])
+            memories[1].init_data(binary_program["instructions"])
+            for name in ['opcodes', 'offsets', 'values', 'fused_opcodes', 'fused_lengths']:
+                self.assertEqual(getattr(memories[0], name), getattr(memories[1], name), name)
+            self.assertEqual(memories[1].data[0x0010], {"value": "text", "offset": 3})
+            self.assertEqual(memories[1].data[0xFFFF]["value"], 0x00)
+            self.assertEqual(get_lab_program_hash(binary_program),
+                             get_lab_program_hash({"instructions": [{"value": instruction["value"],
+                                                                     "offset": instruction["offset"]}
+                                                                    for instruction in program["instructions"]]}))
+
+    def test_lazy_debug_info(self):
+        """Instructions of binary program have no related tokens, debug info is read only on first lookup"""
+        with open(os.path.join(self.programs_directory, 'cat.lab'), encoding="utf-8") as program_file:
+            program = json.loads(program_file.read())
+
+        with tempfile.TemporaryDirectory() as folder:
+            binary_path = os.path.join(folder, 'cat.labbin')
+            save_program(program, binary_path)
+            binary_program = load_program(binary_path)
+
+            debug_info = binary_program["debug_info"]
+            self.assertEqual(binary_program["instructions"][0xC0], {"value": "READ", "offset": None})
+            self.assertIsNotNone(debug_info.loader)
+            self.assertEqual(len(debug_info.token_indexes), 0)
+
+            results = []
+            for loaded_program in [program, binary_program]:
+                simulation = Simulation(configure_logger(logging_level=logging.INFO, logger_name="test_lazy_logger"))
+                simulation.cu.need_print_state = False
+                simulation.reset(loaded_program, "foo")
+                results.append((simulation.run().ticks, simulation.cu.output_buffer))
+            self.assertEqual(results[0], results[1])
+            self.assertIsNotNone(debug_info.loader)
+
+            self.assertEqual(debug_info.get_related_token(0xC0),
+                             (program["instructions"][0xC0]["related_token_index"],
+                              program["instructions"][0xC0]["related_token"]))
+            self.assertIsNone(debug_info.loader)
+            self.assertEqual(debug_info.get_related_token(0xFFFF), (-1, "model imem init"))
+            # positions are unknown for programs converted from JSON .lab
+            self.assertIsNone(debug_info.get_token_lines())
+
+    def test_debug_info_of_replaced_file(self):
+        """Debug info is read from mapping of loaded program, not from file that was removed or replaced since"""
+        programs = []
+        for program_name in ['cat.lab', 'hello_world.lab']:
+            with open(os.path.join(self.programs_directory, program_name), encoding="utf-8") as program_file:
+                programs.append(json.loads(program_file.read()))
+
+        with tempfile.TemporaryDirectory() as folder:
+            binary_path = os.path.join(folder, 'program.labbin')
+            save_program(programs[0], binary_path)
+            replaced_program = load_program(binary_path)
+            save_program(programs[0], binary_path)
+            removed_program = load_program(binary_path)
+
+            save_program(programs[1], binary_path)
+            self.assertEqual(load_program(binary_path, with_related_tokens=True)["instructions"],
+                             programs[1]["instructions"])
+            self.assertEqual(replaced_program["instructions"][0xC0], {"value": "READ", "offset": None})
+            os.remove(binary_path)
+
+            for binary_program in [replaced_program, removed_program]:
+                self.assertEqual(get_annotated_instructions(binary_program), programs[0]["instructions"])
+
+    def test_data_ranges(self):
+        """Short gaps of zeroes are kept inside range, long gaps split ranges"""
+        self.assertEqual(get_data_ranges([0, 0, 1, 2, 0, 3, 0, 0]), [(2, 6)])
+        self.assertEqual(get_data_ranges([1] + [0] * 20 + [2, 0]), [(0, 1), (21, 22)])
+        self.assertEqual(get_data_ranges([0] * 10), [])
+
+    def test_not_binary_program(self):
+        """Wrong magic or version is rejected"""
+        binary = bytearray(dump_binary_program({"instructions": [], "data": []}))
+        program = parse_binary_program(binary)
+        self.assertEqual((program["instructions"], program["data"]), ([], bytearray()))
+        binary[8] += 1
+        with self.assertRaises(ValueError):
+            parse_binary_program(binary)
+        with self.assertRaises(ValueError):
+            parse_binary_program(b'{"instructions": []}')
+
+    def test_translate_and_run_binary(self):
+        """Translator writes binary program by extension, model runs it same as JSON .lab, even with DEBUG log"""
+        source_path = os.path.join(self.golden_directory, 'examples', 'cat.forth')
+        input_path = os.path.join(self.golden_directory, 'examples', 'input.txt')
+
+        with tempfile.TemporaryDirectory() as folder:
+            outputs = []
+            for program_name in ['program.lab', 'program.labbin']:
+                program_path = os.path.join(folder, program_name)
+                translator_main(source_path, program_path, configure_logger(
+                    logging_level=logging.INFO, logger_name="test_program_format_translator",
+                    log_folder=os.path.join(folder, 'translator_' + program_name)))
+
+                logger_name = "test_program_format_model_" + program_name
+                log_folder = os.path.join(folder, 'model_' + program_name)
+                output_path = os.path.join(folder, program_name + '.txt')
+                model_main(program_path, input_path, output_path, logger=configure_logger(
+                    logging_level=logging.DEBUG, logger_name=logger_name, log_folder=log_folder))
+
+                with open(output_path, encoding="utf-8") as output_file:
+                    output = output_file.read()
+                with open(os.path.join(log_folder, logger_name + '.log'), encoding="utf-8") as log_file:
+                    outputs.append((output, log_file.read()))
+
+            program = load_program(os.path.join(folder, 'program.lab'))
+            binary_program = load_program(os.path.join(folder, 'program.labbin'), with_related_tokens=True)
+            self.assertEqual(binary_program["instructions"], program["instructions"])
+
+            # translator keeps source position of every token
+            debug_info = load_program(os.path.join(folder, 'program.labbin'))["debug_info"]
+            with open(source_path, encoding="utf-8") as source_file:
+                source_lines = source_file.read().split('\n')
+            for instruction in program["instructions"]:
+                position = debug_info.get_position(instruction["related_token_index"])
+                if position is not None:
+                    line, column = position
+                    token = source_lines[line - 1][column - 1:].split()[0]
+                    # tokens are upper-cased by tokenizer
+                    self.assertTrue(instruction["related_token"].startswith(token.upper()))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("Ticks: 207", outputs[1][1])
+        self.assertIn("rel_inst_index", outputs[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
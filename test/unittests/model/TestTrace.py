@@ -0,0 +1,101 @@
+import io
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+from src.model import TRACE_RECORD_WORDS
+from src.model import Simulation
+from src.model import TraceRecorder
+from src.model import configure_logger
+from src.model import main
+from src.trace_renderer import render
+from src.trace_renderer import render_record
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.programs_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden',
+                                               'programs')
+        self.program_path = os.path.join(self.programs_directory, 'hello_user_name.lab')
+        self.input_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden', 'examples',
+                                       'input.txt')
+
+    def get_debug_lines(self, log_folder):
+        logger_name = "test_trace_debug_logger"
+        logger = configure_logger(logging_level=logging.DEBUG, logger_name=logger_name, log_folder=log_folder)
+        main(self.program_path, self.input_path, os.path.join(log_folder, 'output.txt'), logger=logger)
+
+        with open(os.path.join(log_folder, logger_name + '.log'), encoding="utf-8") as log_file:
+            log = log_file.read()
+
+        # related tokens may be multiline, so state lines are taken from first tick to end of simulation
+        return log[log.index('tick      1:'):log.index('\nHLT')].split('\ntick ')
+
+    def test_render_same_as_debug_log(self):
+        """Rendered binary trace is same as state lines of DEBUG log"""
+        with tempfile.TemporaryDirectory() as folder:
+            debug_lines = self.get_debug_lines(os.path.join(folder, 'debug'))
+
+            trace_path = os.path.join(folder, 'trace.bin')
+            logger = configure_logger(logging_level=logging.INFO, logger_name="test_trace_logger",
+                                      log_folder=os.path.join(folder, 'info'))
+            main(self.program_path, self.input_path, os.path.join(folder, 'output.txt'), logger=logger,
+                 trace_file_path=trace_path)
+
+            output = io.StringIO()
+            render(trace_path, self.program_path, output=output)
+            self.assertEqual(output.getvalue().rstrip('\n').split('\ntick '), debug_lines)
+
+            output = io.StringIO()
+            render(trace_path, self.program_path, first_tick=100, last_tick=199, output=output)
+            self.assertEqual(output.getvalue().rstrip('\n').split('\ntick ')[1:], debug_lines[100:199])
+
+    def test_ring_buffer(self):
+        """Without file only last records are kept in ring buffer"""
+        with open(self.program_path) as program_file:
+            program = json.loads(program_file.read())
+
+        logger = configure_logger(logging_level=logging.INFO, logger_name="test_trace_logger")
+        simulation = Simulation(logger)
+        simulation.cu.imem.init_data(program["instructions"])
+        simulation.cu.ram.init_data(program["data"])
+        simulation.cu.input_buffer = [ord(character) for character in reversed("foo")] + [3]
+        simulation.cu.trace_recorder = TraceRecorder(capacity=1000)
+
+        with self.assertRaises(Exception) as context:
+            simulation.simulate()
+        self.assertTrue(str(context.exception).startswith("HLT"))
+
+        records = simulation.cu.trace_recorder.get_records()
+        self.assertTrue(simulation.cu.trace_recorder.wrapped)
+        self.assertEqual(len(records), 1000 * TRACE_RECORD_WORDS)
+
+        last_line = render_record(records[-TRACE_RECORD_WORDS:], program["instructions"])
+        self.assertTrue(last_line.startswith(f'tick {simulation.cu.ticks: >6}:'))
+        first_line = render_record(records[:TRACE_RECORD_WORDS], program["instructions"])
+        self.assertTrue(first_line.startswith(f'tick {simulation.cu.ticks - 999: >6}:'))
+
+    def test_ticks_over_32_bits(self):
+        """Ticks of long runs are recorded without overflow"""
+        with open(self.program_path) as program_file:
+            program = json.loads(program_file.read())
+
+        logger = configure_logger(logging_level=logging.INFO, logger_name="test_trace_logger")
+        simulation = Simulation(logger)
+        simulation.reset(program, "foo")
+        simulation.cu.ticks = 1 << 40
+        simulation.cu.trace_recorder = TraceRecorder(capacity=10)
+        simulation.cu.update_tracing()
+        simulation.run(max_instructions=5)
+
+        records = simulation.cu.trace_recorder.get_records()
+        last_line = render_record(records[-TRACE_RECORD_WORDS:], program["instructions"])
+        self.assertTrue(last_line.startswith(f'tick {simulation.cu.ticks: >6}:'))
+        self.assertGreater(simulation.cu.ticks, 1 << 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
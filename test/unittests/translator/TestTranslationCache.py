@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.model import configure_logger
+from src.program_format import load_program
+from src.translation_cache import TranslationCache
+from src.translation_cache import get_translation_key
+from src.translatorv2 import Translator
+from src.translatorv2 import main as translator_main
+
+
+class TestTranslationCache(unittest.TestCase):
+    def setUp(self):
+        print(self._testMethodDoc)
+        self.examples_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'golden',
+                                               'examples')
+        self.sources = {}
+        for name in ['cat', 'hello_world', 'hello_user_name', 'prob1']:
+            with open(os.path.join(self.examples_directory, name + '.forth'), encoding="utf-8") as source_file:
+                self.sources[name] = source_file.read()
+
+    def test_hit_does_not_translate(self):
+        """Second request of same source returns cached program without running Translator"""
+        with tempfile.TemporaryDirectory() as folder:
+            cache = TranslationCache(folder)
+            self.assertIsNone(cache.lookup(self.sources['cat']))
+            program_path = cache.get_program_path(self.sources['cat'])
+            self.assertEqual(cache.lookup(self.sources['cat']), program_path)
+
+            with mock.patch('src.translation_cache.Translator', side_effect=AssertionError("translated again")):
+                self.assertEqual(cache.get_program_path(self.sources['cat']), program_path)
+                program = cache.get_program(self.sources['cat'])
+                annotated_program = load_program(program_path, with_related_tokens=True)
+
+        translator = Translator(self.sources['cat'])
+        translator.translate()
+        self.assertEqual(annotated_program["instructions"], translator.convert_instructions_to_list())
+        self.assertEqual(bytes(program["data"]), bytes(translator.data).rstrip(b'\0'))
+
+    def test_key(self):
+        """Key depends on source, translator version and options"""
+        key = get_translation_key(self.sources['cat'])
+        self.assertEqual(key, get_translation_key(self.sources['cat'], {}))
+        self.assertNotEqual(key, get_translation_key(self.sources['cat'] + ' '))
+        self.assertNotEqual(key, get_translation_key(self.sources['cat'], {"option": True}))
+        self.assertEqual(get_translation_key(self.sources['cat'], {"a": 1, "b": 2}),
+                         get_translation_key(self.sources['cat'], {"b": 2, "a": 1}))
+        with mock.patch('src.translation_cache.TRANSLATOR_VERSION', -1):
+            self.assertNotEqual(key, get_translation_key(self.sources['cat']))
+
+    def test_lru_eviction(self):
+        """Least recently used programs are removed when cache is over max_size"""
+        with tempfile.TemporaryDirectory() as folder:
+            cache = TranslationCache(folder)
+            sizes = {name: os.path.getsize(cache.get_program_path(source)) for name, source in self.sources.items()}
+            for name in self.sources:
+                os.remove(cache.lookup(self.sources[name]))
+
+            cache.max_size = sizes['cat'] + sizes['hello_user_name'] + sizes['prob1']
+            first_path = cache.get_program_path(self.sources['cat'])
+            cache.get_program_path(self.sources['hello_world'])
+            cache.get_program_path(self.sources['hello_user_name'])
+            # cat becomes most recently used, so hello_world is the oldest
+            os.utime(first_path, ns=(0, 0))
+            os.utime(cache.lookup(self.sources['hello_world']), ns=(1, 1))
+            self.assertEqual(cache.lookup(self.sources['cat']), first_path)
+
+            cache.get_program_path(self.sources['prob1'])
+
+            self.assertIsNone(cache.lookup(self.sources['hello_world']))
+            self.assertIsNotNone(cache.lookup(self.sources['prob1']))
+            total_size = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+            self.assertLessEqual(total_size, cache.max_size)
+
+            # program bigger than whole cache is kept until next program is stored
+            cache.max_size = 1
+            self.assertIsNotNone(cache.lookup(self.sources['cat']))
+            path = cache.get_program_path(self.sources['cat'] + ' ')
+            self.assertEqual(os.listdir(folder), [os.path.basename(path)])
+
+    def test_translator_main_with_cache(self):
+        """Translator main with cache writes same program as without it"""
+        source_path = os.path.join(self.examples_directory, 'hello_world.forth')
+        with tempfile.TemporaryDirectory() as folder:
+            cache = TranslationCache(os.path.join(folder, 'cache'))
+            programs = []
+            for index, translation_cache in enumerate([None, cache, cache]):
+                program_path = os.path.join(folder, f'program_{index}.lab')
+                logger = configure_logger(logging_level=logging.INFO, logger_name="test_translation_cache_logger",
+                                          log_folder=os.path.join(folder, f'log_{index}'))
+                translator_main(source_path, program_path, logger, translation_cache=translation_cache)
+                with open(program_path, encoding="utf-8") as program_file:
+                    programs.append(json.loads(program_file.read()))
+
+            binary_path = os.path.join(folder, 'program.labbin')
+            translator_main(source_path, binary_path, translation_cache=cache)
+            programs.append(load_program(binary_path, with_related_tokens=True))
+
+        self.assertEqual(programs[0], programs[1])
+        self.assertEqual(programs[1], programs[2])
+        self.assertEqual(programs[0]["instructions"], programs[3]["instructions"])
+
+
+if __name__ == '__main__':
+    unittest.main()
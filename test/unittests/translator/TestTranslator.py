@@ -1,6 +1,12 @@
 import json
 import os
 import unittest
+from src.model import ADDRESS_TABLE_SIZE
+from src.model import OPCODE_BY_NAME
+from src.model import Simulation
+from src.model import opcode_and_offset_to_address
+from src.program_format import dump_binary_program
+from src.program_format import parse_binary_program
 from src.translatorv2 import Translator
 
 
@@ -74,6 +80,197 @@ class TestTranslator(unittest.TestCase):
         with self.assertRaises(SyntaxError):
             translator.translate()
 
+    def test_symbol_tables(self):
+        source = "VARIABLE var :func1 VARIABLE var var @ ; :func2 VARIABLE other ; var @ func1 func2"
+        translator = Translator(source)
+        translator.translate()
+
+        self.assertEqual(sorted(translator.variable_by_name), ["FUNC1.VAR", "FUNC2.OTHER", "VAR"])
+        self.assertEqual([translator.variable_by_name[variable.name] for variable in translator.variables],
+                         translator.variables)
+        self.assertEqual([translator.function_by_name[function.name] for function in translator.functions],
+                         translator.functions)
+
+        # variables of function are visible only inside it, global variables are not visible inside functions
+        for source in ["VARIABLE var :func1 VARIABLE other ; other", "VARIABLE var :func1 var ;"]:
+            with self.assertRaises(SyntaxError):
+                Translator(source).translate()
+
+    def test_constant_pool(self):
+        literals = [str(value) for value in range(2, 42)]
+        source = ' '.join(literals + literals + ["100000", "100000", "200000"])
+        translator = Translator(source, constant_pool=True)
+        translator.translate()
+        instructions = translator.instructions[self.instructions_start_address:]
+
+        # every distinct constant is stored once
+        self.assertEqual(translator.number_of_constants, 40)
+        self.assertEqual(translator.data[0x0800:0x0800 + 40], list(range(2, 42)))
+        self.assertEqual(translator.data[0x0900:0x0906], [0x01, 0x86, 0xA0, 0x03, 0x0D, 0x40])
+
+        def pushes_of(token):
+            return [(instruction.value, instruction.offset) for instruction in instructions
+                    if instruction.related_token == token]
+
+        # first constants take free LOAD table cells and are pushed by one LOAD
+        first_offset = pushes_of("2")[0][1]
+        self.assertEqual(pushes_of("2"), [("LOAD", first_offset), ("LOAD", first_offset)])
+        self.assertEqual(translator.load.data[2 * first_offset:2 * first_offset + 2], [0x08, 0x00])
+        # when first 32 LOAD table cells are taken, constants take cells of extended LOAD table, placed after code
+        last_offset = pushes_of("41")[0][1]
+        self.assertGreaterEqual(last_offset, ADDRESS_TABLE_SIZE)
+        self.assertEqual(pushes_of("41"), [("LOAD", last_offset), ("LOAD", last_offset)])
+        self.assertEqual(translator.load.read_from_offset(last_offset), 0x0827)
+        cell = opcode_and_offset_to_address(OPCODE_BY_NAME["LOAD"], last_offset, translator.extended_tables)
+        self.assertEqual([translator.instructions[cell].value, translator.instructions[cell + 1].value], [0x08, 0x27])
+        # high, mid and low bytes of triple-length constant, each by one LOAD
+        tconstant_offsets = [offset for _, offset in pushes_of("100000")[:3]]
+        self.assertEqual(pushes_of("100000"), 2 * [("LOAD", offset) for offset in tconstant_offsets])
+        self.assertEqual([translator.load.read_from_offset(offset) for offset in tconstant_offsets],
+                         [0x0900, 0x0901, 0x0902])
+
+        # LOAD table is never exceeded silently
+        translator = Translator(source, constant_pool=True)
+        translator.load.max_size = ADDRESS_TABLE_SIZE
+        with self.assertRaises(SyntaxError):
+            translator.translate()
+
+    def get_ticks(self, source, **options):
+        translator = Translator(source, **options)
+        translator.translate()
+        simulation = Simulation(translator.logger)
+        simulation.cu.need_print_state = False
+        simulation.reset(translator.get_program(), "")
+        simulation.run()
+        return simulation.cu.ticks
+
+    def test_constant_pool_push_ticks(self):
+        # more distinct literals than LOAD table cells before program
+        literals = [str(value) for value in range(2, 82)]
+        source = ' '.join(literals)
+        ticks = self.get_ticks(source, constant_pool=True)
+
+        # pushing pooled constant again costs same ticks for the first and the last literal
+        push_ticks = [self.get_ticks(f'{source} {literal}', constant_pool=True) - ticks
+                      for literal in [literals[0], literals[-1]]]
+        self.assertEqual(push_ticks, [5, 5])
+
+    def test_extended_address_tables(self):
+        functions = [f':F{index} 1 + ;' for index in range(40)]
+        calls = [f'S @ F{index} S !' for index in range(40)]
+        branches = [f'{index % 2} IF S @ 1 + S ! THEN' for index in range(40)]
+        source = ' '.join(functions + ['VARIABLE S 0 S !'] + calls + branches + ['S @ .'])
+        translator = Translator(source)
+        translator.translate()
+
+        # offsets after first 32 cells of CALL and JMPA tables point to extended tables, placed right after code
+        self.assertEqual(translator.call.reserved_count, 40)
+        self.assertEqual(translator.jmp.reserved_count, 40)
+        program = translator.get_program()
+        load_table, call_table, jmp_table = program["extended_tables"]
+        self.assertEqual(load_table, call_table)
+        self.assertEqual(jmp_table, call_table + 2 * (40 - ADDRESS_TABLE_SIZE))
+        self.assertEqual(len(translator.instructions), jmp_table + 2 * (40 - ADDRESS_TABLE_SIZE))
+        self.assertEqual(len(translator.instructions),
+                         opcode_and_offset_to_address(OPCODE_BY_NAME["JMPA"], 39, program["extended_tables"]) + 2)
+        self.assertLess(len(translator.instructions), 0x1000)
+
+        call_cell = opcode_and_offset_to_address(OPCODE_BY_NAME["CALL"], 39, program["extended_tables"])
+        self.assertEqual(call_cell, call_table + 2 * (39 - ADDRESS_TABLE_SIZE))
+        function_start = (translator.instructions[call_cell].value << 8) + translator.instructions[call_cell + 1].value
+        self.assertEqual(translator.instructions[function_start + 1].related_token, "1")
+
+        # binary program keeps addresses of extended tables in its header
+        for loaded_program in [program, parse_binary_program(dump_binary_program(program))]:
+            simulation = Simulation(translator.logger)
+            simulation.cu.need_print_state = False
+            simulation.reset(loaded_program, "")
+            simulation.run()
+            self.assertEqual(simulation.cu.output_buffer, [chr(60)])
+
+    def test_peephole(self):
+        source = ('VARIABLE x 5 x ! :dec1 1 - ; x @ 5 = IF OVER DROP 65 . THEN '
+                  'BEGIN x @ DUP DROP SWAP SWAP 1 + . x @ dec1 x ! x @ 0 = UNTIL 66 .')
+        outputs = []
+        for peephole in [False, True]:
+            translator = Translator(source, peephole=peephole)
+            translator.translate()
+            values = [instruction.value for instruction in translator.instructions[self.instructions_start_address:]]
+            simulation = Simulation(translator.logger)
+            simulation.cu.need_print_state = False
+            simulation.reset(translator.get_program(), "")
+            outputs.append((values, simulation.run().status, simulation.cu.output_buffer))
+
+        (values, status, output), (optimized_values, optimized_status, optimized_output) = outputs
+        self.assertEqual((optimized_status, optimized_output), (status, output))
+        self.assertEqual(optimized_output, ['A', '\x06', '\x05', '\x04', '\x03', '\x02', 'B'])
+        # shuffles are removed, "1 +" and "1 -" become INC and DEC
+        self.assertEqual(len(optimized_values), len(values) - 10)
+        self.assertEqual(optimized_values.count("DEC"), values.count("DEC") + 1)
+        self.assertNotIn("SUB", optimized_values)
+
+        # jump into the middle of sequence keeps it
+        translator = Translator("5 DUP BEGIN DROP 0 DUP 0 = UNTIL", peephole=True)
+        translator.translate()
+        values = [instruction.value for instruction in translator.instructions[self.instructions_start_address:]]
+        self.assertEqual(values[values.index("DUP"):values.index("DUP") + 2], ["DUP", "DROP"])
+
+    def test_jump_if_false(self):
+        source = (':count VARIABLE i 3 i ! BEGIN i @ 48 + . i @ 2 = IF 33 . THEN i @ 1 - i ! i @ 0 = UNTIL ; '
+                  'VARIABLE x 2 x ! x @ 2 = IF 1 IF 89 . THEN THEN BEGIN x @ 1 - x ! x @ 0 = UNTIL count')
+        results = []
+        for jump_if_false in [False, True]:
+            translator = Translator(source, jump_if_false=jump_if_false)
+            translator.translate()
+            values = [instruction.value for instruction in translator.instructions[self.instructions_start_address:]]
+            simulation = Simulation(translator.logger)
+            simulation.cu.need_print_state = False
+            simulation.reset(translator.get_program(), "")
+            results.append((values, simulation.run(), simulation.cu.output_buffer))
+
+        (values, result, output), (optimized_values, optimized_result, optimized_output) = results
+        self.assertEqual(optimized_output, output)
+        self.assertEqual(output, ['Y', '3', '2', '!', '1'])
+        self.assertLess(optimized_result.ticks, result.ticks)
+        # every IF is one JFA by JMPA table, every UNTIL is one JFR back to BEGIN
+        self.assertEqual((optimized_values.count("JFA"), optimized_values.count("JFR")), (3, 2))
+        self.assertEqual(optimized_values.count("JMPA"), 0)
+        self.assertEqual(len(optimized_values), len(values) - 5 * 6)
+
+    def test_direct_variables(self):
+        names = [f'v{index}' for index in range(15)]
+        source = ' '.join([f'VARIABLE {name}' for name in names] + [f'{name} @' for name in names]
+                          + [':func1 VARIABLE local local @ ;'])
+        translator = Translator(source, direct_variables=True)
+        translator.translate()
+
+        def address_pushes(instructions, token):
+            pushes = [(instruction.value, instruction.offset) for instruction in instructions
+                      if instruction.related_token == token and instruction.value != "GET"]
+            self.assertEqual([value for value, _ in pushes], ["LOAD", "LOAD"])
+            return [translator.load.data[2 * offset] << 8 | translator.load.data[2 * offset + 1] for _, offset in pushes]
+
+        # address of every variable is pushed by two LOADs of its high and low bytes from constant pool
+        for name in names:
+            variable = translator.get_variable_by_name(name.upper())
+            high_address, low_address = address_pushes(translator.instructions, name.upper())
+            self.assertEqual((translator.data[high_address], translator.data[low_address]),
+                             (variable.address >> 8, variable.address & 0xFF))
+
+        local = translator.variable_by_name["FUNC1.LOCAL"]
+        high_address, low_address = address_pushes(translator.functions[0].instructions, "LOCAL")
+        self.assertEqual(translator.data[low_address], local.address & 0xFF)
+
+    def test_direct_variables_push_ticks(self):
+        # more variables than LOAD table cells before program can keep their address bytes
+        names = [f'v{index}' for index in range(100)]
+        source = ' '.join([f'VARIABLE {name}' for name in names] + [f'{name} @ DROP' for name in names])
+        ticks = self.get_ticks(source, direct_variables=True)
+
+        # address of the first and the last declared variable is pushed by two LOADs
+        push_ticks = [self.get_ticks(f'{source} {name}', direct_variables=True) - ticks for name in [names[0], names[-1]]]
+        self.assertEqual(push_ticks, [10, 10])
+
     def test_function_declaration_inside_function(self):
         source = ":func1 :func2 ; ;"
         translator = Translator(source)
@@ -120,3 +317,11 @@ class TestTranslator(unittest.TestCase):
 
                 self.assertEqual(translated_instructions, expected_instructions)
 
+
+    def test_token_lines(self):
+        source = 'variable a # comment with "quote\n3 a !\n\n"multiline\nstring" . a @ .'
+        translator = Translator(source)
+
+        self.assertEqual(translator.get_token_lines(), [1, 1, 2, 2, 2, 4, 5, 5, 5, 5])
+        translator.drop_out_comments_from_source_code()
+        self.assertEqual(len(translator.tokenize()), len(translator.get_token_lines()))